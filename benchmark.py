@@ -0,0 +1,373 @@
+"""End-to-end benchmarks for the Celonis PQL agent.
+
+Serves a generated Celonis-style documentation site and a stub OpenAI endpoint from
+local HTTP servers, then measures every stage at several corpus sizes:
+
+    python benchmark.py --sizes 50 200 1000 --output benchmark_results.json
+
+Results are written as JSON so runs can be compared over time.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import numpy as np
+
+import celonis_pql_agent as agent
+
+PQL_FUNCTIONS = [
+    ('DATEDIFF', 'calculates the difference between two dates in the given unit',
+     'DATEDIFF(dd, "Activities"."Start", "Activities"."End")'),
+    ('CASE WHEN', 'evaluates conditions in order and returns the first matching result',
+     'CASE WHEN "Activities"."Activity" = \'Create Order\' THEN 1 ELSE 0 END'),
+    ('VARIANT', 'returns the sequence of activities of a case',
+     'VARIANT("Activities"."Activity")'),
+    ('COUNT', 'counts the non-null values of a column',
+     'COUNT(DISTINCT "Cases"."CaseID")'),
+    ('PU_SUM', 'sums a child table column per row of the parent table',
+     'PU_SUM("Cases", "Items"."Amount")'),
+    ('THROUGHPUT', 'calculates the time between two events of a case',
+     'THROUGHPUT(CASE_START TO CASE_END, REMAP_TIMESTAMPS("Activities"."Time", DAYS))'),
+    ('SOURCE', 'refers to the source event of an activity pair',
+     'SOURCE("Activities"."Activity")'),
+    ('FILTER', 'restricts the rows considered by the following queries',
+     'FILTER "Cases"."Status" = \'Completed\';'),
+]
+
+FILLER = ('process mining event log case table activity table data model analysis '
+          'conformance throughput time automation signal execution management').split()
+
+# Boilerplate repeated, nearly verbatim, on every fifth page, like monthly release notes
+RELEASE_NOTE = ' '.join(random.Random(7).choice(FILLER) for _ in range(150))
+
+QUESTIONS = [
+    "How do I calculate the number of days between two activities?",
+    "What does the VARIANT function return?",
+    "How can I count distinct cases in PQL?",
+    "How do I sum child table values per case?",
+    "What is the syntax of CASE WHEN?",
+    "How do I filter completed cases?",
+    "How can I compute throughput time between case start and end?",
+    "Which function refers to the source event?",
+]
+
+
+def generate_site(n_pages: int, links_per_page: int = 5, seed: int = 42) -> Dict[str, bytes]:
+    """Generate n_pages Celonis-style documentation pages keyed by URL path"""
+    rng = random.Random(seed)
+    pages = {}
+    for i in range(n_pages):
+        sections = []
+        for j in range(rng.randint(3, 6)):
+            name, description, example = PQL_FUNCTIONS[(i + j) % len(PQL_FUNCTIONS)]
+            filler = ' '.join(rng.choice(FILLER) for _ in range(rng.randint(60, 220)))
+            sections.append(
+                f"<h2>{name} {i}-{j}</h2>"
+                f"<p>{name} {description}. {filler}.</p>"
+                f"<pre><code>{example}</code></pre>"
+            )
+        if i % 5 == 0:
+            sections.append(f"<h2>Release notes {i}</h2><p>Release {i}: {RELEASE_NOTE}.</p>")
+        # Link to the next page so every page is reachable, plus random cross links
+        targets = [(i + 1) % n_pages] + [rng.randrange(n_pages) for _ in range(links_per_page - 1)]
+        links = ''.join(f'<a href="/pql-function-{target}.html">PQL function</a>' for target in targets)
+        pages[f"/pql-function-{i}.html"] = (
+            f"<html><head><title>PQL Function Reference {i}</title>"
+            f"<script>var analytics = {i};</script></head>"
+            f"<body><nav>Celonis Docs</nav><main><h1>PQL Function Reference {i}</h1>"
+            f"{''.join(sections)}{links}</main></body></html>"
+        ).encode()
+    return pages
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """Serves generated pages from memory with ETag revalidation"""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, delayed ACKs add ~40ms per request
+    disable_nagle_algorithm = True
+    pages: Dict[str, bytes] = {}
+
+    def do_GET(self):
+        body = self.pages.get(self.path.split('?')[0])
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI chat completions endpoint with a fixed generation delay"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    delay = 0.0
+
+    def do_POST(self):
+        json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay)
+        body = json.dumps({
+            'id': 'bench', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'stub',
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': 'Use DATEDIFF(dd, start, end).'}}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(handler) -> ThreadingHTTPServer:
+    """Start an HTTP server on a free local port in a background thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentiles(latencies: List[float]) -> Dict[str, float]:
+    """p50/p99/mean of latencies given in seconds, reported in milliseconds"""
+    values = np.array(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'mean_ms': float(values.mean())
+    }
+
+
+def benchmark_size(n_pages: int, site_url: str, workdir: str, args) -> Dict:
+    """Run every stage against a site of n_pages and return the measurements"""
+    pages = generate_site(n_pages)
+    SiteHandler.pages = pages
+    result = {'pages': n_pages}
+    agent.METRICS.reset()
+
+    # Crawl: fetch, parse and chunk over HTTP, following links breadth first
+    scraper = agent.CelonisDocScraper(max_workers=args.workers, requests_per_second=1e6, burst=1e6,
+                                      cache_path=os.path.join(workdir, f'pages_{n_pages}.db'),
+                                      max_pages=n_pages)
+    seeds = {f'seed_{i}': f"{site_url}/pql-function-{i}.html" for i in range(min(n_pages, 10))}
+    start = time.perf_counter()
+    crawled = scraper.crawl(seeds, max_depth=args.max_depth)
+    elapsed = time.perf_counter() - start
+    chunks = list({chunk.chunk_id: chunk for found in crawled.values() for chunk in found}.values())
+    fetched = scraper.stats.get('fetched', 0)
+    result['crawl'] = {'pages_fetched': fetched, 'seconds': elapsed, 'pages_per_second': fetched / elapsed}
+
+    # Revalidation: a second crawl of an unchanged site should be answered with 304s
+    start = time.perf_counter()
+    scraper.crawl(seeds, max_depth=args.max_depth)
+    elapsed = time.perf_counter() - start
+    result['recrawl'] = {'pages_not_modified': scraper.stats.get('not_modified', 0), 'seconds': elapsed}
+
+    # Near-duplicate suppression ahead of embedding
+    start = time.perf_counter()
+    kept = agent.NearDuplicateFilter().filter(chunks)
+    result['dedup'] = {'chunks': len(chunks), 'duplicates': len(chunks) - len(kept),
+                       'seconds': time.perf_counter() - start}
+    chunks = kept
+
+    # Parse and chunk in-process, per parser
+    bodies = [(f"{site_url}{path}", body) for path, body in pages.items()]
+    result['parse'] = {}
+    for name, fast in (('lxml', True), ('html.parser', False)):
+        if fast and not agent.LXML_AVAILABLE:
+            continue
+        start = time.perf_counter()
+        n_chunks = sum(len(agent.CelonisDocScraper.parse_html(body, url, fast)[0]) for url, body in bodies)
+        elapsed = time.perf_counter() - start
+        result['parse'][name] = {'pages_per_second': len(bodies) / elapsed, 'chunks_per_second': n_chunks / elapsed}
+
+    # Embedding without the cache, so every chunk is encoded
+    store = agent.VectorStore(args.model, embedding_cache_path=None, query_cache_size=0, encoder_backend='torch')
+    texts = [chunk.content for chunk in chunks]
+    start = time.perf_counter()
+    vectors = store.encode_texts(texts)
+    elapsed = time.perf_counter() - start
+    result['embedding'] = {'chunks': len(texts), 'seconds': elapsed, 'chunks_per_second': len(texts) / elapsed}
+
+    # CPU encoder backends against plain torch encoding: sentences/s and vector agreement
+    result['encoders'] = {}
+    for backend in args.encoder_backends:
+        encoder = agent.TextEncoder(args.model, backend, processes=args.encode_processes)
+        try:
+            result['encoders'][backend] = encoder.compare(texts)
+        finally:
+            encoder.close()
+
+    # Index build from precomputed vectors (FAISS, BM25 and the symbol table)
+    start = time.perf_counter()
+    store._append(vectors, chunks)
+    result['index_build'] = {'seconds': time.perf_counter() - start, 'index_kind': store.index_kind}
+
+    # Search latency, with the query cache disabled so every query is encoded
+    latencies = []
+    for i in range(args.queries):
+        question = f"{QUESTIONS[i % len(QUESTIONS)]} ({i})"
+        start = time.perf_counter()
+        store.search(question, k=5)
+        latencies.append(time.perf_counter() - start)
+    result['search'] = percentiles(latencies)
+
+    # Vector recall@10 of the quantized buffers against float32 on the same queries
+    queries = store.encode_texts([f"{QUESTIONS[i % len(QUESTIONS)]} ({i})" for i in range(args.queries)])
+    _, truth = store.index.search(queries, 10)
+    result['quantization'] = {'float32': {'bytes_per_vector': vectors.shape[1] * 4, 'recall@10': 1.0}}
+    for dtype in ('float16', 'int8'):
+        quantized = agent.VectorStore(args.model, embedding_cache_path=None, query_cache_size=0, vector_dtype=dtype)
+        quantized._append(vectors, chunks)
+        _, found = quantized.index.search(queries, 10)
+        recall = np.mean([len(set(t[t >= 0]) & set(f[f >= 0])) / max(1, (t >= 0).sum()) for t, f in zip(truth, found)])
+        result['quantization'][dtype] = {
+            'bytes_per_vector': quantized._buffer.itemsize * vectors.shape[1],
+            'recall@10': float(recall)
+        }
+
+    # Index backends on the same vectors: recall@10 against exact search, query latency and the cost of
+    # updating a few chunks in place (HNSW keeps removed vectors as tombstones instead of rebuilding)
+    result['index_types'] = {}
+    edited = [agent.DocumentChunk(f"{chunk.content} Updated.", chunk.url, chunk.title, chunk.section,
+                                  chunk.chunk_id, chunk.timestamp) for chunk in chunks[:10]]
+    for kind in ('flat', 'hnsw', 'ivf'):
+        indexed = agent.VectorStore(args.model, embedding_cache_path=None, query_cache_size=0, index_type=kind)
+        indexed._append(vectors, chunks)
+        start = time.perf_counter()
+        indexed.upsert_documents(edited, vectors[:len(edited)])
+        update_ms = (time.perf_counter() - start) * 1000
+        result['index_types'][kind] = indexed.benchmark_index(queries=queries)
+        result['index_types'][kind]['update_10_ms'] = update_ms
+
+    # End-to-end answers through the stub LLM, without the answer cache
+    pql_agent = agent.PQLAgent(store, 'benchmark-key')
+    latencies = []
+    for i in range(args.answers):
+        question = f"{QUESTIONS[i % len(QUESTIONS)]} ({i})"
+        start = time.perf_counter()
+        pql_agent.answer_question(question)
+        latencies.append(time.perf_counter() - start)
+    result['answer'] = percentiles(latencies)
+    result['answer']['generation_failed'] = pql_agent._generation_failed
+
+    # Per-stage breakdown from the agent's own instrumentation
+    result['stages'] = agent.METRICS.summary()
+
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args) -> Dict:
+    """Run the benchmarks at every requested corpus size"""
+    site = start_server(SiteHandler)
+    StubLLMHandler.delay = args.llm_delay_ms / 1000
+    llm = start_server(StubLLMHandler)
+    os.environ['OPENAI_BASE_URL'] = f"http://127.0.0.1:{llm.server_address[1]}/v1"
+    site_url = f"http://127.0.0.1:{site.server_address[1]}"
+
+    report = {
+        'started_at': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'model': args.model,
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': []
+    }
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for n_pages in args.sizes:
+                agent.logger.info(f"Benchmarking {n_pages} pages")
+                report['results'].append(benchmark_size(n_pages, site_url, workdir, args))
+    finally:
+        site.shutdown()
+        llm.shutdown()
+
+    return report
+
+
+def print_summary(report: Dict):
+    header = f"{'pages':>6} {'crawl p/s':>10} {'parse p/s':>10} {'embed c/s':>10} {'build s':>8} " \
+             f"{'search p50':>11} {'search p99':>11} {'answer p50':>11} {'answer p99':>11}"
+    print(header)
+    for result in report['results']:
+        parse = result['parse'].get('lxml') or result['parse']['html.parser']
+        print(f"{result['pages']:>6} {result['crawl']['pages_per_second']:>10.1f} {parse['pages_per_second']:>10.1f} "
+              f"{result['embedding']['chunks_per_second']:>10.1f} {result['index_build']['seconds']:>8.3f} "
+              f"{result['search']['p50_ms']:>9.2f}ms {result['search']['p99_ms']:>9.2f}ms "
+              f"{result['answer']['p50_ms']:>9.2f}ms {result['answer']['p99_ms']:>9.2f}ms")
+    for result in report['results']:
+        for kind, index in result['index_types'].items():
+            print(f"{result['pages']:>6} pages, {kind} index: recall@10 {index['recall@10']:.3f}, "
+                  f"p50 {index['p50_ms']:.2f}ms, updating 10 chunks {index['update_10_ms']:.1f}ms")
+        for requested, encoder in result['encoders'].items():
+            print(f"{result['pages']:>6} pages, encoder {requested} (ran {encoder['backend']}): "
+                  f"{encoder['sentences_per_second']:.1f} sentences/s vs {encoder['reference_sentences_per_second']:.1f} "
+                  f"torch, min cosine {encoder['min_cosine']:.4f}, "
+                  f"{'compatible' if encoder['compatible'] else 'OUTSIDE TOLERANCE'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Celonis PQL agent against a local synthetic site")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000], help="Corpus sizes in pages")
+    parser.add_argument('--max-depth', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=8, help="Crawler threads")
+    parser.add_argument('--queries', type=int, default=200, help="Search queries per size")
+    parser.add_argument('--answers', type=int, default=50, help="answer_question calls per size")
+    parser.add_argument('--llm-delay-ms', type=float, default=0.0, help="Simulated generation time of the stub LLM")
+    parser.add_argument('--model', default='all-MiniLM-L6-v2')
+    parser.add_argument('--encoder-backends', nargs='*', default=['torch-int8'], choices=agent.TextEncoder.BACKENDS,
+                        help="Encoder backends compared with torch")
+    parser.add_argument('--encode-processes', type=int, default=1, help="Encode pool size for the backend comparison")
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_summary(report)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
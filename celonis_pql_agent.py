@@ -1,24 +1,78 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from bs4.dammit import UnicodeDammit
 import pandas as pd
 import numpy as np
 from datetime import datetime
 import json
 import re
 import time
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
 import sqlite3
 import hashlib
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator
 import openai
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, CrossEncoder
+import torch
 import faiss
 import pickle
 import os
+import sys
+import argparse
+import asyncio
+import atexit
+import contextlib
+import shutil
+import threading
+import heapq
+import bisect
+from array import array
+import queue
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 import logging
 
+try:
+    import lxml.html
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+try:
+    from transformers import AutoTokenizer
+    TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    TRANSFORMERS_AVAILABLE = False
+
+try:
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, PlainTextResponse
+    from starlette.routing import Route
+    SERVER_AVAILABLE = True
+except ImportError:
+    SERVER_AVAILABLE = False
+
+# On-disk layout version written by VectorStore.save; version 1 stores can still be loaded
+STORE_FORMAT_VERSION = 2
+KNOWLEDGE_BASE_PATH = "pql_knowledge_base"
+LEGACY_KNOWLEDGE_BASE_PATH = "pql_knowledge_base.pkl"
+ANSWER_CACHE_PATH = "pql_answer_cache.npz"
+# Upper bounds on client-supplied sizes in the HTTP API
+MAX_SEARCH_K = 100
+MAX_CONTEXT_TOKENS = 12000
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,23 +80,506 @@ logger = logging.getLogger(__name__)
 @dataclass
 class DocumentChunk:
     """Represents a chunk of documentation with metadata"""
+    # Slotted: no per-instance __dict__ for the many chunks held in memory
+    __slots__ = ('content', 'url', 'title', 'section', 'chunk_id', 'timestamp')
     content: str
     url: str
     title: str
     section: str
     chunk_id: str
     timestamp: datetime
+    
+    def __setstate__(self, state):
+        # Chunks pickled before __slots__ (legacy knowledge base, page cache) carry a plain dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            setattr(self, name, value)
+
+class Metrics:
+    """Process-wide counters, latency histograms and optional tracing spans.
+    
+    When disabled every call returns immediately, so instrumentation can stay in hot paths.
+    """
+    
+    # Histogram bucket upper bounds in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self, enabled: bool = True, trace: bool = False, window: int = 1000, max_spans: int = 2000):
+        self.enabled = enabled
+        self.trace = trace
+        self.window = window
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # stage -> per-bucket counts with +Inf last, then the sum of durations
+        self.recent = {}  # stage -> latest durations, for percentiles
+        self.spans = deque(maxlen=max_spans)
+        self._local = threading.local()
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, stage: str, seconds: float):
+        """Record the duration of one run of a stage"""
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+                self.recent[stage] = deque(maxlen=self.window)
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            self.recent[stage].append(seconds)
+    
+    def timer(self, stage: str):
+        """Context manager timing a stage (and recording a span when tracing)"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+    
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count and recent p50/p95 latency per stage"""
+        with self.lock:
+            recent = {stage: list(durations) for stage, durations in self.recent.items()}
+            counts = {stage: sum(histogram[:-1]) for stage, histogram in self.histograms.items()}
+        return {
+            stage: {
+                'count': counts[stage],
+                'p50_ms': float(np.percentile(durations, 50)) * 1000,
+                'p95_ms': float(np.percentile(durations, 95)) * 1000
+            }
+            for stage, durations in sorted(recent.items()) if durations
+        }
+    
+    def recent_spans(self, n: int = 100) -> List[Dict]:
+        """Most recent tracing spans, newest last"""
+        with self.lock:
+            return list(self.spans)[-n:]
+    
+    def prometheus(self) -> str:
+        """Export everything in the Prometheus text exposition format"""
+        def label_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+        
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {stage: list(histogram) for stage, histogram in self.histograms.items()}
+        
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{name}{label_text(labels)} {value}")
+        
+        if histograms:
+            name = 'pql_stage_duration_seconds'
+            lines.append(f"# HELP {name} Duration of agent stages")
+            lines.append(f"# TYPE {name} histogram")
+            for stage, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram[-1]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {cumulative}')
+        
+        return '\n'.join(lines) + '\n'
+    
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.recent.clear()
+            self.spans.clear()
+
+class _StageTimer:
+    """Times one stage; nested timers on the same thread become child spans"""
+    
+    __slots__ = ('metrics', 'stage', 'start', 'parent', 'traced')
+    
+    def __init__(self, metrics: Metrics, stage: str):
+        self.metrics = metrics
+        self.stage = stage
+        self.parent = None
+        self.traced = metrics.trace
+    
+    def __enter__(self):
+        if self.traced:
+            stack = self.metrics._local.__dict__.setdefault('stack', [])
+            self.parent = stack[-1] if stack else None
+            stack.append(self.stage)
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        self.metrics.observe(self.stage, duration)
+        if self.traced:
+            self.metrics._local.stack.pop()
+            with self.metrics.lock:
+                self.metrics.spans.append({
+                    'stage': self.stage,
+                    'parent': self.parent,
+                    'thread': threading.current_thread().name,
+                    'start': time.time() - duration,
+                    'duration_ms': duration * 1000,
+                    'error': exc_type.__name__ if exc_type else None
+                })
+        return False
+
+_NULL_TIMER = contextlib.nullcontext()
+
+@st.cache_resource(show_spinner=False)
+def get_metrics() -> Metrics:
+    """Process-wide metrics, kept across Streamlit reruns; PQL_METRICS=0 disables, PQL_TRACE=1 records spans"""
+    return Metrics(enabled=os.environ.get('PQL_METRICS', '1') != '0', trace=os.environ.get('PQL_TRACE') == '1')
+
+METRICS = get_metrics()
+
+class TokenBucket:
+    """Thread-safe token bucket used to rate limit requests to a single host"""
+    
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available and consume it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class PageCache:
+    """SQLite cache of raw pages, their HTTP validators and the chunks parsed from them"""
+    
+    def __init__(self, filepath: str):
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    body BLOB,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    chunks TEXT,
+                    links TEXT,
+                    fetched_at TEXT
+                )
+            """)
+            # Chunking settings the cached chunks were made with; added after the first release
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(pages)")]
+            if 'chunker' not in columns:
+                self.conn.execute("ALTER TABLE pages ADD COLUMN chunker TEXT")
+    
+    def get(self, url: str) -> Dict:
+        """Return the cached entry for a URL, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content_hash, chunks, links, chunker FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        
+        etag, last_modified, content_hash, chunks, links, chunker = row
+        return {
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_hash': content_hash,
+            'chunks': [self._chunk_from_dict(c) for c in json.loads(chunks)],
+            'links': json.loads(links),
+            'chunker': chunker
+        }
+    
+    def put(self, url: str, body: bytes, etag: str, last_modified: str, content_hash: str,
+            chunks: List[DocumentChunk], links: List[str], chunker: str = None):
+        """Store a fetched page together with its parsed chunks and links"""
+        chunk_data = json.dumps([self._chunk_to_dict(c) for c in chunks])
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (url, body, etag, last_modified, content_hash, chunks, links, "
+                "fetched_at, chunker) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, body, etag, last_modified, content_hash, chunk_data,
+                 json.dumps(links), datetime.now().isoformat(), chunker)
+            )
+    
+    @staticmethod
+    def _chunk_to_dict(chunk: DocumentChunk) -> Dict:
+        data = {name: getattr(chunk, name) for name in DocumentChunk.__slots__}
+        data['timestamp'] = chunk.timestamp.isoformat()
+        return data
+    
+    @staticmethod
+    def _chunk_from_dict(data: Dict) -> DocumentChunk:
+        data = dict(data)
+        data['timestamp'] = datetime.fromisoformat(data['timestamp'])
+        return DocumentChunk(**data)
+
+class CrawlFrontier:
+    """Priority-ordered crawl frontier that deduplicates normalized URLs across all seeds"""
+    
+    NOISE_QUERY_PARAMS = {'ref', 'source', 'fbclid', 'gclid', 'mc_cid', 'mc_eid'}
+    
+    def __init__(self, max_pages: int = 1000):
+        self.max_pages = max_pages
+        self.seen = set()
+        self.heap = []
+        self.counter = 0
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        """Canonicalize a URL: lowercase scheme/host, drop fragments, tracking params and trailing slashes"""
+        parts = urlsplit(url.strip())
+        path = parts.path or '/'
+        if path != '/' and path.endswith('/'):
+            path = path.rstrip('/')
+        query = sorted(
+            (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key.lower() not in cls.NOISE_QUERY_PARAMS and not key.lower().startswith('utm_')
+        )
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(query), ''))
+    
+    def mark_seen(self, url: str) -> bool:
+        """Record a URL as crawled, returning False if it was already seen"""
+        url = self.normalize_url(url)
+        with self.lock:
+            if url in self.seen:
+                return False
+            self.seen.add(url)
+            return True
+    
+    def push(self, url: str, depth: int, seed: str, priority: int = 0):
+        """Queue a URL unless it was already seen or the page budget is spent"""
+        url = self.normalize_url(url)
+        with self.lock:
+            if url in self.seen or len(self.seen) >= self.max_pages:
+                return
+            self.seen.add(url)
+            # Shallow pages first, then the most PQL-relevant ones, then discovery order
+            heapq.heappush(self.heap, (depth, -priority, self.counter, seed, url))
+            self.counter += 1
+    
+    def pop(self) -> Tuple[int, str, str]:
+        """Return the next (depth, seed, url) to crawl, or None when empty"""
+        with self.lock:
+            if not self.heap:
+                return None
+            depth, _, _, seed, url = heapq.heappop(self.heap)
+            return depth, seed, url
+
+@st.cache_resource(show_spinner=False)
+def get_chunk_tokenizer(model_name: str):
+    """Tokenizer of an embedding model, for sizing chunks; None when it cannot be loaded"""
+    if not TRANSFORMERS_AVAILABLE:
+        return None
+    # Short sentence-transformers names live under that organisation on the Hugging Face hub
+    repo = model_name if '/' in model_name or os.path.isdir(model_name) else f"sentence-transformers/{model_name}"
+    try:
+        return AutoTokenizer.from_pretrained(repo)
+    except Exception as e:
+        logger.warning(f"Falling back to approximate chunk sizes: {str(e)}")
+        return None
+
+class TextChunker:
+    """Splits section text into overlapping windows sized in embedding-model tokens"""
+    
+    # Bumped when chunk ids are derived differently, so pages cached with old ids are parsed again
+    ID_SCHEME = 2
+    
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', chunk_tokens: int = 250, overlap_tokens: int = 50):
+        if not 0 <= overlap_tokens < chunk_tokens:
+            raise ValueError("overlap_tokens must be at least 0 and smaller than chunk_tokens")
+        self.model_name = model_name
+        # all-MiniLM-L6-v2 truncates its input at 256 tokens, two of which are special tokens
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+    
+    @property
+    def key(self) -> str:
+        """Identifies the chunking settings and chunk id scheme, so chunks cached under others are not reused"""
+        return f"{self.model_name}:{self.chunk_tokens}:{self.overlap_tokens}:ids{self.ID_SCHEME}"
+    
+    def token_counts(self, words: List[str]) -> List[int]:
+        """Number of model tokens in each word"""
+        tokenizer = get_chunk_tokenizer(self.model_name)
+        if tokenizer is None:
+            # Roughly four characters per token, the same estimate ContextPacker falls back to
+            return [len(word) // 4 + 1 for word in words]
+        return [len(ids) for ids in tokenizer(words, add_special_tokens=False)['input_ids']]
+    
+    def split(self, text: str) -> List[str]:
+        """Split text into windows of at most chunk_tokens, each repeating the last overlap_tokens of the previous one"""
+        words = text.split()
+        counts = self.token_counts(words)
+        if sum(counts) <= self.chunk_tokens:
+            return [text]
+        
+        windows = []
+        start = 0
+        while start < len(words):
+            end, size = start, 0
+            while end < len(words) and (size + counts[end] <= self.chunk_tokens or end == start):
+                size += counts[end]
+                end += 1
+            windows.append(' '.join(words[start:end]))
+            if end == len(words):
+                break
+            
+            # Step back over up to overlap_tokens worth of words, always moving forward
+            next_start, overlap = end, 0
+            while next_start > start + 1 and overlap + counts[next_start - 1] <= self.overlap_tokens:
+                next_start -= 1
+                overlap += counts[next_start]
+            start = next_start
+        
+        return windows
+
+class NearDuplicateFilter:
+    """Drops chunks whose text nearly repeats a chunk already kept, using MinHash signatures with LSH banding.
+    
+    Signatures are split into bands and only chunks sharing a band bucket are compared, so each
+    check costs about the same however many chunks have been kept.
+    """
+    
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, bands: int = 16, shingle_size: int = 3,
+                 seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        # Estimated Jaccard similarity of word shingles above which a chunk counts as a duplicate
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        
+        # Multiply-shift hash family: h(x) = (a * x + b) mod 2^64, top 32 bits
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        
+        self._buckets = {}  # (band, band bytes) -> positions in _signatures
+        self._signatures = []
+        self._chunk_ids = []
+        self.duplicates = {}  # dropped chunk id -> chunk id of the near-duplicate that was kept
+    
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature of the text's lowercased word shingles"""
+        words = text.lower().split()
+        n = self.shingle_size
+        shingles = {' '.join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        # uint64 arithmetic wraps around, which is the mod 2^64 of the hash family
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) >> np.uint64(32)).min(axis=1)
+    
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+    
+    def add(self, chunk: DocumentChunk, signature: np.ndarray = None):
+        """Keep a chunk, so later near-duplicates of it are dropped"""
+        if signature is None:
+            signature = self.signature(chunk.content)
+        position = len(self._signatures)
+        self._signatures.append(signature)
+        self._chunk_ids.append(chunk.chunk_id)
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(position)
+    
+    def find(self, signature: np.ndarray, chunk_id: str = None) -> str:
+        """Chunk id of a kept near-duplicate of the signature, or None"""
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        
+        best, best_similarity = None, self.threshold
+        for position in candidates:
+            if self._chunk_ids[position] == chunk_id:
+                continue
+            similarity = float(np.mean(self._signatures[position] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = self._chunk_ids[position], similarity
+        return best
+    
+    def filter(self, chunks: List[DocumentChunk]) -> List[DocumentChunk]:
+        """Return the chunks that are not near-duplicates of any kept so far, keeping them in turn"""
+        kept = []
+        for chunk in chunks:
+            signature = self.signature(chunk.content)
+            original = self.find(signature, chunk.chunk_id)
+            if original is None:
+                self.add(chunk, signature)
+                kept.append(chunk)
+            else:
+                self.duplicates[chunk.chunk_id] = original
+        return kept
 
 class CelonisDocScraper:
     """Scrapes Celonis documentation and community content"""
     
-    def __init__(self):
+    pql_keywords = ['pql', 'process', 'query', 'language', 'function', 'operator']
+    heading_tags = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    
+    # Main content selectors, tried in order, with their XPath equivalents for the lxml parser
+    content_selectors = ['main', 'article', '.content', '.documentation', '.markdown-body', '.wiki-content']
+    content_xpaths = ['//main', '//article'] + [
+        f"//*[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+        for name in ['content', 'documentation', 'markdown-body', 'wiki-content']
+    ]
+    
+    def __init__(self, max_workers: int = 8, requests_per_second: float = 4.0, burst: int = 4,
+                 cache_path: str = "pql_page_cache.db", max_pages: int = 1000,
+                 parse_workers: int = 4, fast_parser: bool = True, chunker: TextChunker = None):
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         })
+        # Size the connection pool so concurrent workers can share the session
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # Concurrency and per-host politeness settings
+        self.max_workers = max_workers
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_pages = max_pages
+        self._rate_limiters = {}
+        self._rate_limiters_lock = threading.Lock()
+        
+        # Raw page cache used for conditional revalidation on refresh
+        self.page_cache = PageCache(cache_path) if cache_path else None
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+        
+        # HTML parsing is CPU-bound, so it runs in a process pool next to the fetch threads
+        self.parse_workers = parse_workers
+        self.fast_parser = fast_parser
+        self._parse_pool = None
+        self._parse_pool_lock = threading.Lock()
+        # Sections are split into token-sized windows; the settings travel to the parse workers
+        self.chunker = chunker or TextChunker()
         
-# Key Celonis documentation URLs
         # Key Celonis documentation URLs
         self.doc_urls = {
             'getting_started_celonis_platform': 'https://docs.celonis.com/en/getting-started-with-the-celonis-platform.html',
@@ -79,7 +616,7 @@ class CelonisDocScraper:
             'september_2023_release_notes': 'https://docs.celonis.com/en/september-2023-release-notes.html',
             'august_2023_release_notes': 'https://docs.celonis.com/en/august-2023-release-notes.html',
             'july_2023_release_notes': 'https://docs.celonis.com/en/july-2023-release-notes.html',
-            'june_2023_release_notes': 'https://docs.celonis.com/en/july-2023-release-notes.html',
+            'june_2023_release_notes': 'https://docs.celonis.com/en/june-2023-release-notes.html',
             'may_2023_release_notes': 'https://docs.celonis.com/en/may-2023-release-notes.html',
             'april_2023_release_notes': 'https://docs.celonis.com/en/april-2023-release-notes.html',
             'march_2023_release_notes': 'https://docs.celonis.com/en/march-2023-release-notes.html',
@@ -92,317 +629,3028 @@ class CelonisDocScraper:
             'september_2022_release_notes': 'https://docs.celonis.com/en/september-2022-release-notes.html',
             'august_2022_release_notes': 'https://docs.celonis.com/en/august-2022-release-notes.html',
             'july_2022_release_notes': 'https://docs.celonis.com/en/july-2022-release-notes.html',
-            'june_2022_release_notes': 'https://docs.celonis.com/en/july-2022-release-notes.html',
+            'june_2022_release_notes': 'https://docs.celonis.com/en/june-2022-release-notes.html',
             'may_2022_release_notes': 'https://docs.celonis.com/en/may-2022-release-notes.html',
             'april_2022_release_notes': 'https://docs.celonis.com/en/april-2022-release-notes.html'
         }
         
-    def scrape_documentation(self, url: str, max_depth: int = 2) -> List[DocumentChunk]:
-        """Scrape documentation from a given URL"""
-        chunks = []
-        visited = set()
+    def scrape_documentation(self, url: str, max_depth: int = 2) -> List[DocumentChunk]:
+        """Scrape documentation from a given URL"""
+        return self.crawl({url: url}, max_depth=max_depth)[url]
+    
+    def crawl(self, seed_urls: Dict[str, str], max_depth: int = 2) -> Dict[str, List[DocumentChunk]]:
+        """Crawl several seed URLs concurrently, returning the chunks found per seed name"""
+        results = {name: [] for name in seed_urls}
+        
+        # One frontier for all seeds, so every page is fetched once per crawl
+        frontier = CrawlFrontier(self.max_pages)
+        for name, url in seed_urls.items():
+            frontier.push(url, 0, name)
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            while True:
+                while len(pending) < self.max_workers:
+                    item = frontier.pop()
+                    if item is None:
+                        break
+                    depth, name, url = item
+                    pending[executor.submit(self._scrape_page, url)] = item
+                
+                if not pending:
+                    break
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth, name, url = pending.pop(future)
+                    page_chunks, links, final_url = future.result()
+                    
+                    # Skip pages that redirected onto a URL already crawled
+                    if CrawlFrontier.normalize_url(final_url) != url and not frontier.mark_seen(final_url):
+                        continue
+                    
+                    results[name].extend(page_chunks)
+                    if depth < max_depth:
+                        for link in links:
+                            frontier.push(link, depth + 1, name, self._link_priority(link))
+        
+        self._shutdown_parse_pool()
+        return results
+    
+    def _link_priority(self, url: str) -> int:
+        """Rank links by how many PQL keywords they mention (higher is crawled first)"""
+        url_lower = url.lower()
+        return sum(1 for keyword in self.pql_keywords if keyword in url_lower)
+    
+    def _scrape_page(self, current_url: str) -> Tuple[List[DocumentChunk], List[str], str]:
+        """Fetch and parse a single page, returning its chunks, relevant outgoing links and final URL"""
+        return self._finish_page(self._fetch_page(current_url))
+    
+    def _fetch_page(self, current_url: str) -> Dict:
+        """Fetch a page, revalidating any cached copy.
+        
+        New bodies are returned under 'html' for parsing; unchanged pages carry their cached chunks and links.
+        """
+        page = {'url': current_url, 'final_url': current_url, 'html': None, 'chunks': [], 'links': []}
+        try:
+            cached = self.page_cache.get(current_url) if self.page_cache else None
+            if cached and cached['chunker'] != self.chunker.key:
+                # Chunked under other settings, so the page has to be parsed again
+                cached = None
+            
+            # Revalidate cached pages instead of downloading them again
+            headers = {}
+            if cached:
+                if cached['etag']:
+                    headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    headers['If-Modified-Since'] = cached['last_modified']
+            
+            with METRICS.timer('rate_limit_wait'):
+                self._rate_limiter(current_url).acquire()
+            with METRICS.timer('fetch'):
+                response = self.session.get(current_url, timeout=10, headers=headers)
+            page['final_url'] = response.url or current_url
+            
+            if cached and response.status_code == 304:
+                self._count('not_modified')
+                page.update(chunks=cached['chunks'], links=cached['links'])
+                return page
+            
+            response.raise_for_status()
+            
+            page['content'] = response.content
+            page['content_hash'] = hashlib.sha256(response.content).hexdigest()
+            page['etag'] = response.headers.get('ETag')
+            page['last_modified'] = response.headers.get('Last-Modified')
+            
+            if cached and cached['content_hash'] == page['content_hash']:
+                # Server ignored the validators but the body is identical
+                self._count('unchanged')
+                page.update(chunks=cached['chunks'], links=cached['links'])
+            else:
+                self._count('fetched')
+                page['html'] = response.content
+            
+            return page
+            
+        except Exception as e:
+            logger.error(f"Error scraping {current_url}: {str(e)}")
+            self._count('errors')
+            return page
+    
+    def _finish_page(self, page: Dict) -> Tuple[List[DocumentChunk], List[str], str]:
+        """Parse a fetched page if it changed and record it in the page cache"""
+        try:
+            if page['html'] is not None:
+                with METRICS.timer('parse'):
+                    page['chunks'], page['links'] = self._parse_page(page['html'], page['final_url'])
+            
+            if self.page_cache and 'content' in page:
+                self.page_cache.put(page['url'], page['content'], page['etag'], page['last_modified'],
+                                    page['content_hash'], page['chunks'], page['links'], self.chunker.key)
+            
+            return page['chunks'], page['links'], page['final_url']
+            
+        except Exception as e:
+            logger.error(f"Error scraping {page['url']}: {str(e)}")
+            self._count('errors')
+            return [], [], page['url']
+    
+    def _parse_page(self, html: bytes, current_url: str) -> Tuple[List[DocumentChunk], List[str]]:
+        """Parse a page body, in the process pool when one is available"""
+        pool = self._get_parse_pool()
+        if pool is not None:
+            try:
+                return pool.submit(_parse_page_worker, html, current_url, self.fast_parser, self.chunker).result()
+            except Exception as e:
+                # e.g. unpicklable module under Streamlit or a broken pool; parse in-process from now on
+                logger.warning(f"Parse pool unavailable, parsing in-process: {str(e)}")
+                self._disable_parse_pool()
+        
+        return self.parse_html(html, current_url, self.fast_parser, self.chunker)
+    
+    def _get_parse_pool(self) -> ProcessPoolExecutor:
+        """Lazily start the process pool used for CPU-bound HTML parsing.
+        
+        Spawned rather than forked: it starts from crawl and pipeline threads while other
+        threads (torch, Streamlit, the fetchers) may hold locks a forked child would inherit.
+        """
+        with self._parse_pool_lock:
+            if self._parse_pool is None and self.parse_workers:
+                import multiprocessing
+                self._parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                                       mp_context=multiprocessing.get_context('spawn'))
+            return self._parse_pool
+    
+    def _disable_parse_pool(self):
+        with self._parse_pool_lock:
+            self.parse_workers = 0
+            pool, self._parse_pool = self._parse_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+    
+    def _shutdown_parse_pool(self):
+        with self._parse_pool_lock:
+            pool, self._parse_pool = self._parse_pool, None
+        if pool is not None:
+            pool.shutdown()
+    
+    @classmethod
+    def parse_html(cls, html: bytes, current_url: str, fast: bool = True,
+                   chunker: TextChunker = None) -> Tuple[List[DocumentChunk], List[str]]:
+        """Parse a page body into chunks and relevant outgoing links"""
+        if fast and LXML_AVAILABLE:
+            try:
+                return cls._parse_page_lxml(html, current_url, chunker)
+            except Exception as e:
+                logger.warning(f"Fast parser failed for {current_url}, falling back to html.parser: {str(e)}")
+        
+        return cls._parse_page_bs4(html, current_url, chunker)
+    
+    @classmethod
+    def check_fast_parser(cls, html: bytes, current_url: str) -> bool:
+        """Check that the lxml extractor produces the same chunks and links as the BeautifulSoup one"""
+        def comparable(result):
+            chunks, links = result
+            return [(c.content, c.url, c.title, c.section, c.chunk_id) for c in chunks], links
+        
+        return comparable(cls._parse_page_lxml(html, current_url)) == comparable(cls._parse_page_bs4(html, current_url))
+    
+    @classmethod
+    def _parse_page_bs4(cls, html: bytes, current_url: str,
+                        chunker: TextChunker = None) -> Tuple[List[DocumentChunk], List[str]]:
+        """Reference parser built on BeautifulSoup and html.parser"""
+        page_chunks = []
+        page_links = []
+        
+        soup = BeautifulSoup(html, 'html.parser')
+        
+        # Extract title
+        title = soup.find('title')
+        title_text = title.get_text().strip() if title else "Untitled"
+        
+        # Remove script and style elements
+        for script in soup(["script", "style"]):
+            script.decompose()
+        
+        # Extract main content
+        main_content = None
+        for selector in cls.content_selectors:
+            main_content = soup.select_one(selector)
+            if main_content:
+                break
+        
+        if not main_content:
+            main_content = soup.find('body')
+        
+        if main_content:
+            # Extract text content in chunks
+            sections = cls._extract_sections(main_content, title_text, current_url, chunker)
+            page_chunks.extend(sections)
+        
+        # Find related links for deeper scraping; the crawl frontier orders and bounds them
+        for link in soup.find_all('a', href=True):
+            href = link['href']
+            if cls._is_relevant_link(href, current_url):
+                page_links.append(urljoin(current_url, href))
+        
+        return page_chunks, page_links
+    
+    @classmethod
+    def _parse_page_lxml(cls, html: bytes, current_url: str,
+                         chunker: TextChunker = None) -> Tuple[List[DocumentChunk], List[str]]:
+        """Fast parser built on lxml, producing the same output as _parse_page_bs4"""
+        markup = UnicodeDammit(html, is_html=True).unicode_markup
+        root = lxml.html.document_fromstring(markup)
+        
+        title = root.find('.//title')
+        title_text = title.text_content().strip() if title is not None else "Untitled"
+        
+        # Empty script/style elements but keep their tails, mirroring decompose()
+        for element in root.iter('script', 'style'):
+            element.clear(keep_tail=True)
+        
+        main_content = None
+        for xpath in cls.content_xpaths:
+            found = root.xpath(xpath)
+            if found:
+                main_content = found[0]
+                break
+        
+        if main_content is None:
+            main_content = root.find('.//body')
+        
+        page_chunks = []
+        if main_content is not None:
+            page_chunks = cls._extract_sections_lxml(main_content, title_text, current_url, chunker)
+        
+        page_links = []
+        for link in root.iter('a'):
+            href = link.get('href')
+            if href is not None and cls._is_relevant_link(href, current_url):
+                page_links.append(urljoin(current_url, href))
+        
+        return page_chunks, page_links
+    
+    def _count(self, key: str):
+        """Increment a crawl statistic"""
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+        METRICS.inc('pql_pages_total', status=key)
+    
+    def _rate_limiter(self, url: str) -> 'TokenBucket':
+        """Return the token bucket for the host of the given URL"""
+        host = urlparse(url).netloc
+        with self._rate_limiters_lock:
+            if host not in self._rate_limiters:
+                self._rate_limiters[host] = TokenBucket(self.requests_per_second, self.burst)
+            return self._rate_limiters[host]
+    
+    @classmethod
+    def _extract_sections(cls, content, title: str, url: str, chunker: TextChunker = None) -> List[DocumentChunk]:
+        """Extract sections from HTML content"""
+        chunks = []
+        
+        # Find all headings and their content
+        headings = content.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+        # Headings repeat on a page (every release has "New features"), so ids include the occurrence
+        occurrences = {}
+        
+        for i, heading in enumerate(headings):
+            section_title = heading.get_text().strip()
+            occurrence = occurrences.get(section_title, 0)
+            occurrences[section_title] = occurrence + 1
+            
+            # Get content until next heading
+            content_parts = []
+            current = heading.next_sibling
+            
+            while current:
+                if hasattr(current, 'name') and current.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+                    break
+                
+                if hasattr(current, 'get_text'):
+                    text = current.get_text().strip()
+                    if text:
+                        content_parts.append(text)
+                
+                current = current.next_sibling
+            
+            if content_parts:
+                chunks.extend(cls._make_chunks('\n'.join(content_parts), section_title, title, url, chunker,
+                                               occurrence))
+        
+        return cls._check_unique_ids(chunks, url)
+    
+    @classmethod
+    def _extract_sections_lxml(cls, content, title: str, url: str,
+                               chunker: TextChunker = None) -> List[DocumentChunk]:
+        """Extract sections from an lxml element, walking each heading's sibling run once"""
+        chunks = []
+        occurrences = {}
+        
+        for heading in content.iter('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+            if heading is content:
+                continue
+            section_title = heading.text_content().strip()
+            occurrence = occurrences.get(section_title, 0)
+            occurrences[section_title] = occurrence + 1
+            
+            # Text between siblings lives in the preceding node's tail
+            content_parts = []
+            if heading.tail and heading.tail.strip():
+                content_parts.append(heading.tail.strip())
+            
+            for sibling in heading.itersiblings():
+                if sibling.tag in cls.heading_tags:
+                    break
+                # Comments and processing instructions contribute only their tail
+                if isinstance(sibling.tag, str):
+                    text = sibling.text_content().strip()
+                    if text:
+                        content_parts.append(text)
+                if sibling.tail and sibling.tail.strip():
+                    content_parts.append(sibling.tail.strip())
+            
+            if content_parts:
+                chunks.extend(cls._make_chunks('\n'.join(content_parts), section_title, title, url, chunker,
+                                               occurrence))
+        
+        return cls._check_unique_ids(chunks, url)
+    
+    @staticmethod
+    def _check_unique_ids(chunks: List[DocumentChunk], url: str) -> List[DocumentChunk]:
+        """Make sure no two chunks of a page share an id, since the store keeps one chunk per id"""
+        seen = set()
+        for chunk in chunks:
+            if chunk.chunk_id in seen:
+                logger.warning(f"Chunk id collision in section '{chunk.section}' of {url}, re-keying")
+                suffix = 1
+                while hashlib.md5(f"{chunk.chunk_id}#{suffix}".encode()).hexdigest() in seen:
+                    suffix += 1
+                chunk.chunk_id = hashlib.md5(f"{chunk.chunk_id}#{suffix}".encode()).hexdigest()
+            seen.add(chunk.chunk_id)
+        return chunks
+    
+    @classmethod
+    def _make_chunks(cls, section_content: str, section_title: str, title: str, url: str,
+                     chunker: TextChunker = None, occurrence: int = 0) -> List[DocumentChunk]:
+        """Turn a section into one or more document chunks.
+        
+        occurrence counts earlier sections of the page with the same heading; the first keeps the plain id.
+        """
+        chunks = []
+        key = f"{url}_{section_title}" if not occurrence else f"{url}_{section_title}#{occurrence}"
+        
+        # Split sections longer than one embedding window into overlapping parts
+        parts = (chunker or TextChunker()).split(section_content)
+        if len(parts) > 1:
+            for j, chunk in enumerate(parts):
+                chunk_id = hashlib.md5(f"{key}_{j}".encode()).hexdigest()
+                chunks.append(DocumentChunk(
+                    content=chunk,
+                    url=url,
+                    title=title,
+                    section=f"{section_title} (Part {j+1})",
+                    chunk_id=chunk_id,
+                    timestamp=datetime.now()
+                ))
+        else:
+            chunk_id = hashlib.md5(key.encode()).hexdigest()
+            chunks.append(DocumentChunk(
+                content=section_content,
+                url=url,
+                title=title,
+                section=section_title,
+                chunk_id=chunk_id,
+                timestamp=datetime.now()
+            ))
+        
+        return chunks
+    
+    @classmethod
+    def _is_relevant_link(cls, href: str, base_url: str) -> bool:
+        """Determine if a link is relevant for PQL documentation"""
+        if not href or href.startswith('#'):
+            return False
+        
+        # Check for PQL-related keywords
+        href_lower = href.lower()
+        
+        for keyword in cls.pql_keywords:
+            if keyword in href_lower:
+                return True
+        
+        # Check if it's a Celonis documentation link
+        if 'docs.celonis.com' in href or 'community.celonis.com' in href:
+            return True
+        
+        return False
+
+def _parse_page_worker(html: bytes, url: str, fast: bool, chunker: TextChunker) -> Tuple[List[DocumentChunk], List[str]]:
+    """Process pool entry point for page parsing"""
+    return CelonisDocScraper.parse_html(html, url, fast, chunker)
+
+class EmbeddingCache:
+    """Persistent SQLite cache of embeddings keyed by model name and content hash"""
+    
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_name TEXT,
+                    content_hash TEXT,
+                    embedding BLOB,
+                    PRIMARY KEY (model_name, content_hash)
+                )
+            """)
+    
+    def get_many(self, model_name: str, content_hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Return the cached embeddings found for the given content hashes"""
+        found = {}
+        unique = list(set(content_hashes))
+        with self.lock:
+            # Stay below SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT content_hash, embedding FROM embeddings "
+                    f"WHERE model_name = ? AND content_hash IN ({placeholders})",
+                    [model_name] + batch
+                ).fetchall()
+                for content_hash, blob in rows:
+                    found[content_hash] = np.frombuffer(blob, dtype=np.float32)
+        return found
+    
+    def put_many(self, model_name: str, items: Dict[str, np.ndarray]):
+        """Store embeddings by content hash"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(model_name, content_hash, np.asarray(embedding, dtype=np.float32).tobytes())
+                 for content_hash, embedding in items.items()]
+            )
+    
+    def stats(self) -> Dict[str, int]:
+        """Return cache hit/miss counts"""
+        return {'hits': self.hits, 'misses': self.misses}
+    
+    def __getstate__(self):
+        # Connections and locks cannot be pickled (st.cache_data copies); reopen them instead
+        state = dict(self.__dict__)
+        del state['conn'], state['lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+
+class DocumentTable:
+    """Chunk metadata keyed by stable id; chunks of a saved store are read lazily from SQLite"""
+    
+    def __init__(self, db_path: str = None, ids: List[int] = None, cache_size: int = 1024):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False) if db_path else None
+        self.lock = threading.Lock()
+        self.ids = dict.fromkeys(ids or [])  # live ids, in insertion order
+        self.pending = {}  # chunks added since the table was loaded
+        self.lru = OrderedDict()
+        self.cache_size = cache_size
+        self._keys = None if self.conn else {}  # id -> (chunk_id, content_hash), loaded on demand
+        self._by_chunk = None if self.conn else {}
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['conn'], state['lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False) if self.db_path else None
+        self.lock = threading.Lock()
+    
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self.ids
+    
+    def __iter__(self):
+        return iter(self.ids)
+    
+    def __getitem__(self, doc_id: int) -> DocumentChunk:
+        return self.get_many([doc_id])[0]
+    
+    def __setitem__(self, doc_id: int, chunk: DocumentChunk):
+        # Many chunks share a page's URL and title; keep one copy of each string
+        chunk.url = sys.intern(chunk.url)
+        chunk.title = sys.intern(chunk.title)
+        # Read the stored keys before registering the id, which has no stored row yet
+        keys, by_chunk = self._load_keys()
+        self.ids[doc_id] = None
+        self.pending[doc_id] = chunk
+        keys[doc_id] = (chunk.chunk_id, self.content_hash(chunk))
+        by_chunk[chunk.chunk_id] = doc_id
+    
+    def remove(self, doc_id: int):
+        """Forget a document; its SQLite row is left for the next save to drop"""
+        keys, by_chunk = self._load_keys()
+        chunk_id, _ = keys.pop(doc_id)
+        if by_chunk.get(chunk_id) == doc_id:
+            del by_chunk[chunk_id]
+        del self.ids[doc_id]
+        self.pending.pop(doc_id, None)
+        self.lru.pop(doc_id, None)
+    
+    def id_for_chunk(self, chunk_id: str) -> int:
+        """Return the id currently holding a chunk id, or None"""
+        return self._load_keys()[1].get(chunk_id)
+    
+    def keys_for(self, doc_id: int) -> Tuple[str, str]:
+        """Return (chunk_id, content_hash) of a document without reading its text"""
+        return self._load_keys()[0][doc_id]
+    
+    def get_many(self, ids: List[int]) -> List[DocumentChunk]:
+        """Fetch documents by id, reading any that are not in memory in one query"""
+        found = {}
+        missing = []
+        with self.lock:
+            for doc_id in ids:
+                if doc_id in self.pending:
+                    found[doc_id] = self.pending[doc_id]
+                elif doc_id in self.lru:
+                    self.lru.move_to_end(doc_id)
+                    found[doc_id] = self.lru[doc_id]
+                else:
+                    missing.append(doc_id)
+            
+            if missing:
+                for doc_id, chunk in self._select(missing):
+                    found[doc_id] = chunk
+                    self.lru[doc_id] = chunk
+                while len(self.lru) > self.cache_size:
+                    self.lru.popitem(last=False)
+        
+        return [found[doc_id] for doc_id in ids]
+    
+    def iter_chunks(self, batch_size: int = 500):
+        """Yield (id, chunk) for every live document without caching them"""
+        ids = list(self.ids)
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            stored = {}
+            if self.conn:
+                with self.lock:
+                    stored = dict(self._select([doc_id for doc_id in batch if doc_id not in self.pending]))
+            for doc_id in batch:
+                yield doc_id, self.pending[doc_id] if doc_id in self.pending else stored[doc_id]
+    
+    def recent(self, n: int) -> List[DocumentChunk]:
+        """Return the n most recently scraped documents"""
+        candidates = list(self.pending.values())
+        if self.conn:
+            with self.lock:
+                rows = self.conn.execute("SELECT id, timestamp FROM chunks ORDER BY timestamp DESC").fetchall()
+            newest = [doc_id for doc_id, _ in rows if doc_id in self.ids and doc_id not in self.pending][:n]
+            candidates.extend(self.get_many(newest))
+        return sorted(candidates, key=lambda chunk: chunk.timestamp, reverse=True)[:n]
+    
+    def _select(self, ids: List[int]) -> List[Tuple[int, DocumentChunk]]:
+        rows = []
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows.extend(self.conn.execute(
+                f"SELECT id, content, url, title, section, chunk_id, timestamp FROM chunks "
+                f"WHERE id IN ({','.join('?' * len(batch))})", batch
+            ).fetchall())
+        return [
+            (doc_id, DocumentChunk(content=content, url=sys.intern(url), title=sys.intern(title), section=section,
+                                   chunk_id=chunk_id, timestamp=datetime.fromisoformat(timestamp)))
+            for doc_id, content, url, title, section, chunk_id, timestamp in rows
+        ]
+    
+    def _load_keys(self) -> Tuple[Dict[int, Tuple[str, str]], Dict[str, int]]:
+        # Chunk ids and hashes are only needed for incremental updates, so a
+        # freshly loaded store does not read them until then
+        if self._keys is None:
+            with self.lock:
+                rows = self.conn.execute("SELECT id, chunk_id, content_hash FROM chunks").fetchall()
+            self._keys = {doc_id: (chunk_id, content_hash)
+                          for doc_id, chunk_id, content_hash in rows if doc_id in self.ids}
+            self._by_chunk = {}
+            for doc_id in self.ids:
+                self._by_chunk[self._keys[doc_id][0]] = doc_id
+        return self._keys, self._by_chunk
+    
+    @staticmethod
+    def content_hash(chunk: DocumentChunk) -> str:
+        return hashlib.sha256(chunk.content.encode()).hexdigest()
+    
+    @staticmethod
+    def write(db_path: str, items):
+        """Write (id, chunk) pairs to a new metadata database"""
+        conn = sqlite3.connect(db_path)
+        with conn:
+            conn.execute("""
+                CREATE TABLE chunks (
+                    id INTEGER PRIMARY KEY,
+                    chunk_id TEXT,
+                    content_hash TEXT,
+                    url TEXT,
+                    title TEXT,
+                    section TEXT,
+                    timestamp TEXT,
+                    content TEXT
+                )
+            """)
+            conn.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((doc_id, chunk.chunk_id, DocumentTable.content_hash(chunk), chunk.url, chunk.title,
+                  chunk.section, chunk.timestamp.isoformat(), chunk.content) for doc_id, chunk in items)
+            )
+            conn.execute("CREATE INDEX chunks_timestamp ON chunks (timestamp)")
+        conn.close()
+
+def _open_binary(filepath):
+    """Context manager for a path opened in binary mode, or an already open file (left open)"""
+    if hasattr(filepath, 'read'):
+        return contextlib.nullcontext(filepath)
+    return open(filepath, 'rb')
+
+class BM25Index:
+    """Inverted index with BM25 scoring over chunk text, updated alongside the vector index.
+    
+    Postings are typed arrays (4-byte doc id, 2-byte term frequency) rather than dicts, and
+    document lengths are an array indexed by doc id, so a posting costs 6 bytes instead of ~100.
+    Removal only marks the document's length -1; its postings are skipped by scoring and
+    dropped in one pass once they make up COMPACT_FRACTION of all postings. Doc ids are never
+    reused, so a dead posting cannot come back to life.
+    """
+    
+    COMPACT_FRACTION = 0.25
+    
+    TOKEN_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+')
+    STOPWORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'for', 'from', 'how', 'i',
+                 'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'what', 'with'}
+    
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_df: float = 0.5):
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df
+        self.postings = {}  # term -> (doc ids, term frequencies)
+        self.doc_len = array('i')  # doc id -> token count, -1 for absent documents
+        self.n_docs = 0
+        self.total_len = 0
+        self.n_postings = 0
+        self.dead_postings = 0  # postings of removed documents not yet compacted away
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return [token for token in cls.TOKEN_PATTERN.findall(text.lower()) if token not in cls.STOPWORDS]
+    
+    def add(self, doc_id: int, text: str):
+        tokens = self.tokenize(text)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        with self.lock:
+            for token, tf in counts.items():
+                postings = self.postings.get(token)
+                if postings is None:
+                    postings = self.postings[token] = (array('i'), array('H'))
+                postings[0].append(doc_id)
+                postings[1].append(min(tf, 65535))
+            if doc_id >= len(self.doc_len):
+                self.doc_len.extend([-1] * (doc_id + 1 - len(self.doc_len)))
+            self.doc_len[doc_id] = len(tokens)
+            self.n_docs += 1
+            self.total_len += len(tokens)
+            self.n_postings += len(counts)
+    
+    def remove(self, doc_id: int, text: str):
+        terms = len(set(self.tokenize(text)))
+        with self.lock:
+            if doc_id >= len(self.doc_len) or self.doc_len[doc_id] < 0:
+                return
+            self.total_len -= self.doc_len[doc_id]
+            self.doc_len[doc_id] = -1
+            self.n_docs -= 1
+            self.dead_postings += terms
+            if self.dead_postings > self.COMPACT_FRACTION * self.n_postings:
+                self._compact()
+    
+    def _compact(self):
+        """Drop the postings of removed documents; called with the lock held"""
+        live = np.frombuffer(self.doc_len, dtype=np.int32) >= 0
+        for token in list(self.postings):
+            ids, tfs = self.postings[token]
+            keep = live[np.frombuffer(ids, dtype=np.int32)]
+            if keep.all():
+                continue
+            if not keep.any():
+                del self.postings[token]
+                continue
+            self.postings[token] = (array('i', np.frombuffer(ids, dtype=np.int32)[keep].tobytes()),
+                                    array('H', np.frombuffer(tfs, dtype=np.uint16)[keep].tobytes()))
+        del live
+        self.n_postings = sum(len(ids) for ids, _ in self.postings.values())
+        self.dead_postings = 0
+    
+    def search(self, query: str, k: int = 10, allowed: np.ndarray = None) -> List[Tuple[int, float]]:
+        """Return the top-k (doc_id, score) pairs for a query, optionally only among doc ids where allowed is True"""
+        with self.lock:
+            ids, scores = self._score(query)
+        if not ids:
+            return []
+        
+        # Sum the per-term scores of each document
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        if allowed is not None:
+            keep = ids < len(allowed)
+            keep[keep] = allowed[ids[keep]]
+            ids, totals = ids[keep], totals[keep]
+        top = np.argsort(-totals, kind='stable')[:k]
+        return [(int(ids[i]), float(totals[i])) for i in top]
+    
+    def _score(self, query: str) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        # Works on zero-copy views of the arrays, which must not outlive the lock
+        if not self.n_docs:
+            return [], []
+        n = self.n_docs
+        avg_len = self.total_len / n
+        doc_len = np.frombuffer(self.doc_len, dtype=np.int32)
+        found_ids, found_scores = [], []
+        for token in set(self.tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            ids = np.frombuffer(postings[0], dtype=np.int32)
+            tf = np.frombuffer(postings[1], dtype=np.uint16)
+            # Terms in most chunks carry almost no weight but cost a full postings scan
+            if not self.dead_postings and len(ids) > self.max_df * n:
+                continue
+            lengths = doc_len[ids]
+            if self.dead_postings:
+                live = lengths >= 0
+                ids, tf, lengths = ids[live], tf[live], lengths[live]
+                if not len(ids) or len(ids) > self.max_df * n:
+                    continue
+            tf = tf.astype(np.float32)
+            idf = np.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = tf + self.k1 * (1 - self.b + self.b * lengths / avg_len)
+            found_ids.append(ids.copy())
+            found_scores.append(idf * tf * (self.k1 + 1) / norm)
+        return found_ids, found_scores
+    
+    def save(self, filepath: str):
+        """Write the postings as flat arrays (CSR layout) to an .npz file"""
+        with self.lock:
+            if self.dead_postings:
+                self._compact()
+            terms = list(self.postings)
+            lengths = [len(self.postings[term][0]) for term in terms]
+            np.savez(
+                filepath,
+                # Tokens never contain newlines, so the vocabulary is stored as one joined string
+                terms=np.frombuffer('\n'.join(terms).encode(), dtype=np.uint8),
+                offsets=np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+                ids=np.frombuffer(b''.join(self.postings[term][0].tobytes() for term in terms), dtype=np.int32),
+                tfs=np.frombuffer(b''.join(self.postings[term][1].tobytes() for term in terms), dtype=np.uint16),
+                doc_len=np.frombuffer(self.doc_len, dtype=np.int32).copy()
+            )
+    
+    @classmethod
+    def load(cls, filepath) -> 'BM25Index':
+        """Read a saved index from a path or an open binary file"""
+        index = cls()
+        if str(getattr(filepath, 'name', filepath)).endswith('.json'):
+            # Stores saved before the array layout
+            with _open_binary(filepath) as f:
+                data = json.load(f)
+            for doc_id, length in data['doc_len']:
+                if doc_id >= len(index.doc_len):
+                    index.doc_len.extend([-1] * (doc_id + 1 - len(index.doc_len)))
+                index.doc_len[doc_id] = length
+            for term, postings in data['postings'].items():
+                index.postings[term] = (array('i', [doc_id for doc_id, _ in postings]),
+                                        array('H', [tf for _, tf in postings]))
+        else:
+            with np.load(filepath) as data:
+                offsets, ids, tfs = data['offsets'], data['ids'], data['tfs']
+                index.doc_len = array('i', data['doc_len'].tobytes())
+                terms = data['terms'].tobytes().decode().split('\n') if len(offsets) > 1 else []
+                for i, term in enumerate(terms):
+                    index.postings[term] = (array('i', ids[offsets[i]:offsets[i + 1]].tobytes()),
+                                            array('H', tfs[offsets[i]:offsets[i + 1]].tobytes()))
+        lengths = np.frombuffer(index.doc_len, dtype=np.int32)
+        index.n_docs = int((lengths >= 0).sum())
+        index.total_len = int(lengths[lengths >= 0].sum())
+        del lengths
+        index.n_postings = sum(len(ids) for ids, _ in index.postings.values())
+        return index
+
+class SymbolIndex:
+    """Ingest-time table mapping PQL functions and operators to the chunks that define or use them"""
+    
+    FUNCTION_PATTERN = re.compile(r'\b([A-Z][A-Z0-9_]+)\s*\(')
+    OPERATOR_PATTERNS = {
+        'CASE WHEN': re.compile(r'\bCASE[\s_]+WHEN\b'),
+        'PROCESS EQUALS': re.compile(r'\bPROCESS[\s_]+EQUALS\b'),
+        'FILTER': re.compile(r'\bFILTER\b')
+    }
+    NOT_SYMBOLS = {'AND', 'OR', 'NOT', 'IN', 'IS', 'AS', 'ON', 'THEN', 'ELSE', 'END', 'WHEN', 'FROM', 'WHERE'}
+    # A query word with an optional call parenthesis after it
+    QUERY_TOKEN = re.compile(r'([A-Za-z][A-Za-z0-9_]+)(\s*\()?')
+    
+    def __init__(self):
+        self.symbols = {}  # symbol -> {doc_id: True if the chunk defines it}
+        self.doc_symbols = {}  # doc id -> symbols in order of appearance
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def extract(cls, chunk: DocumentChunk) -> List[str]:
+        """Return the PQL functions and operators mentioned in a chunk, in order of appearance"""
+        found = [(match.start(), match.group(1)) for match in cls.FUNCTION_PATTERN.finditer(chunk.content)
+                 if match.group(1) not in cls.NOT_SYMBOLS]
+        for name, pattern in cls.OPERATOR_PATTERNS.items():
+            match = pattern.search(chunk.content)
+            if match:
+                found.append((match.start(), name))
+        return list(dict.fromkeys(name for _, name in sorted(found)))
+    
+    @staticmethod
+    def _defines(chunk: DocumentChunk, symbol: str) -> bool:
+        """A chunk defines a symbol when its section is named after it or it opens with it"""
+        return symbol in chunk.section.upper() or chunk.content.lstrip().upper().startswith(symbol)
+    
+    def add(self, doc_id: int, chunk: DocumentChunk):
+        symbols = self.extract(chunk)
+        with self.lock:
+            for symbol in symbols:
+                self.symbols.setdefault(symbol, {})[doc_id] = self._defines(chunk, symbol)
+            self.doc_symbols[doc_id] = symbols
+    
+    def remove(self, doc_id: int):
+        with self.lock:
+            for symbol in self.doc_symbols.pop(doc_id, []):
+                docs = self.symbols.get(symbol)
+                if docs is not None:
+                    docs.pop(doc_id, None)
+                    if not docs:
+                        del self.symbols[symbol]
+    
+    @classmethod
+    def query_symbols(cls, query: str) -> set:
+        """Names in the query written like PQL identifiers: upper case, with an underscore, or called.
+        
+        Plain words such as "count" or "filter" are left to dense and BM25 search.
+        """
+        names = {token.upper() for token, call in cls.QUERY_TOKEN.findall(query)
+                 if token.isupper() or '_' in token or call}
+        names.update(name for name, pattern in cls.OPERATOR_PATTERNS.items() if pattern.search(query))
+        return names - cls.NOT_SYMBOLS
+    
+    def lookup(self, query: str) -> Dict[int, bool]:
+        """Return {doc_id: defines} for every chunk mentioning a symbol named in the query"""
+        names = self.query_symbols(query)
+        
+        matches = {}
+        with self.lock:
+            for name in names:
+                for doc_id, defines in self.symbols.get(name, {}).items():
+                    matches[doc_id] = matches.get(doc_id, False) or defines
+        return matches
+    
+    def save(self, filepath: str):
+        with self.lock, open(filepath, 'w') as f:
+            json.dump({
+                'symbols': {symbol: list(docs.items()) for symbol, docs in self.symbols.items()},
+                'doc_symbols': list(self.doc_symbols.items())
+            }, f)
+    
+    @classmethod
+    def load(cls, filepath) -> 'SymbolIndex':
+        """Read a saved table from a path or an open binary file"""
+        with _open_binary(filepath) as f:
+            data = json.load(f)
+        index = cls()
+        index.symbols = {symbol: dict(docs) for symbol, docs in data['symbols'].items()}
+        if 'doc_symbols' in data:
+            index.doc_symbols = dict(data['doc_symbols'])
+        else:
+            # Tables saved keyed by chunk id: rebuild per-document lists from the symbol table
+            for symbol, docs in index.symbols.items():
+                for doc_id in docs:
+                    index.doc_symbols.setdefault(doc_id, []).append(symbol)
+        return index
+
+class ShardMap:
+    """Partitions documents into shards by source category and date, so filtered searches only scan matching shards.
+    
+    A chunk's category comes from its URL and title, matched against the kinds of source in
+    CelonisDocScraper.doc_urls; its date is the month or year named there ('2025-06', '2024').
+    """
+    
+    MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september',
+              'october', 'november', 'december']
+    MONTH_YEAR = re.compile(r'\b(' + '|'.join(MONTHS) + r')[\s_-]+(20\d\d)\b')
+    YEAR = re.compile(r'\b(20\d\d)\b')
+    DATE_FILTER = re.compile(r'^\d{4}(-(0[1-9]|1[0-2]))?$')
+    FILTER_KEYS = {'category', 'since', 'until'}
+    # Checked in order; anything else is general documentation
+    CATEGORIES = [
+        ('release_notes', re.compile(r'release[\s_-]*notes?')),
+        ('planned_releases', re.compile(r'planned[\s_-]*releases?')),
+        ('release_types', re.compile(r'release[\s_-]*types?|(private|public)[\s_-]*preview')),
+        ('getting_started', re.compile(r'getting[\s_-]*started')),
+        ('troubleshooting', re.compile(r'troubleshoot')),
+        ('user_profile', re.compile(r'user[\s_-]*profile'))
+    ]
+    
+    def __init__(self):
+        self.keys = []  # shard number -> (category, date)
+        self.numbers = {}  # (category, date) -> shard number
+        self.doc_shard = array('i')  # doc id -> shard number, -1 for absent documents
+        self._members = None  # shard number -> doc ids, rebuilt after changes
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def find_date(cls, text: str) -> str:
+        """'YYYY-MM' for the first month and year named in the text, else 'YYYY', else ''"""
+        text = text.lower()
+        match = cls.MONTH_YEAR.search(text)
+        if match:
+            return f"{match.group(2)}-{cls.MONTHS.index(match.group(1)) + 1:02d}"
+        match = cls.YEAR.search(text)
+        return match.group(1) if match else ''
+    
+    @classmethod
+    def metadata(cls, chunk: DocumentChunk) -> Tuple[str, str]:
+        """(category, date) of a chunk, from its URL path, page title and section"""
+        source = f"{urlparse(chunk.url).path} {chunk.title}".lower()
+        category = next((name for name, pattern in cls.CATEGORIES if pattern.search(source)), 'docs')
+        # Pages covering a whole year date their sections by month
+        date = cls.find_date(source)
+        if len(date) < 7:
+            date = cls.find_date(chunk.section) or date
+        return category, date
+    
+    @classmethod
+    def filters_from_question(cls, question: str) -> Dict:
+        """Filters implied by a question about a month's or year's release, e.g. "June 2025 release"; {} if none"""
+        lowered = question.lower()
+        # A bare year is often just data in a PQL question, so it only counts next to "release"
+        if not (cls.MONTH_YEAR.search(lowered) or 'release' in lowered):
+            return {}
+        date = cls.find_date(lowered)
+        if not date:
+            return {}
+        filters = {'since': date, 'until': date}
+        if cls.CATEGORIES[0][1].search(lowered):
+            filters['category'] = 'release_notes'
+        return filters
+    
+    @staticmethod
+    def _date_range(date: str) -> Tuple[str, str]:
+        return (date, date) if len(date) > 4 else (f"{date}-01", f"{date}-12")
+    
+    def matches(self, shard: int, filters: Dict) -> bool:
+        """Whether a shard can hold chunks matching filters {'category': str or list, 'since'/'until': date}"""
+        category, date = self.keys[shard]
+        wanted = filters.get('category')
+        if wanted and category not in ([wanted] if isinstance(wanted, str) else wanted):
+            return False
+        since, until = filters.get('since'), filters.get('until')
+        if since or until:
+            if not date:
+                return False
+            start, end = self._date_range(date)
+            if since and end < self._date_range(since)[0]:
+                return False
+            if until and start > self._date_range(until)[1]:
+                return False
+        return True
+    
+    def select(self, filters: Dict) -> List[int]:
+        """Shard numbers matching the filters"""
+        unknown = set(filters) - self.FILTER_KEYS
+        if unknown:
+            raise ValueError(f"Unknown filters {sorted(unknown)}, expected some of {sorted(self.FILTER_KEYS)}")
+        wanted = filters.get('category')
+        if wanted and not (isinstance(wanted, str) or
+                           isinstance(wanted, (list, tuple)) and all(isinstance(name, str) for name in wanted)):
+            raise ValueError(f"Filter 'category' must be a category name or a list of names, not {wanted!r}")
+        for key in ('since', 'until'):
+            value = filters.get(key)
+            if value and not (isinstance(value, str) and self.DATE_FILTER.match(value)):
+                raise ValueError(f"Filter '{key}' must be a date string like '2025' or '2025-06', not {value!r}")
+        with self.lock:
+            return [shard for shard in range(len(self.keys)) if self.matches(shard, filters)]
+    
+    def add(self, doc_id: int, chunk: DocumentChunk):
+        key = self.metadata(chunk)
+        with self.lock:
+            shard = self.numbers.get(key)
+            if shard is None:
+                shard = self.numbers[key] = len(self.keys)
+                self.keys.append(key)
+            if doc_id >= len(self.doc_shard):
+                self.doc_shard.extend([-1] * (doc_id + 1 - len(self.doc_shard)))
+            self.doc_shard[doc_id] = shard
+            self._members = None
+    
+    def remove(self, doc_id: int):
+        with self.lock:
+            if doc_id < len(self.doc_shard):
+                self.doc_shard[doc_id] = -1
+                self._members = None
+    
+    def members(self) -> Dict[int, np.ndarray]:
+        """Doc ids of every non-empty shard, grouped with one sort after each change"""
+        with self.lock:
+            if self._members is None:
+                shards = np.array(self.doc_shard, dtype=np.int32)
+                ids = np.flatnonzero(shards >= 0)
+                order = np.argsort(shards[ids], kind='stable')
+                ids, shards = ids[order], shards[ids[order]]
+                bounds = np.flatnonzero(np.diff(shards)) + 1
+                self._members = {int(group_shards[0]): group_ids.astype(np.int64)
+                                 for group_ids, group_shards in zip(np.split(ids, bounds), np.split(shards, bounds))
+                                 if len(group_ids)}
+            return self._members
+    
+    def allowed(self, shards: List[int]) -> np.ndarray:
+        """Boolean mask over doc ids that are in the given shards"""
+        with self.lock:
+            return np.isin(np.array(self.doc_shard, dtype=np.int32), shards)
+    
+    def describe(self) -> List[Dict]:
+        """Category, date and size of every non-empty shard"""
+        members = self.members()
+        return [{'category': self.keys[shard][0], 'date': self.keys[shard][1], 'documents': len(ids)}
+                for shard, ids in sorted(members.items(), key=lambda item: self.keys[item[0]])]
+    
+    def save(self, filepath: str):
+        with self.lock:
+            np.savez(
+                filepath,
+                keys=np.frombuffer('\n'.join(f"{category}\t{date}" for category, date in self.keys).encode(),
+                                   dtype=np.uint8),
+                doc_shard=np.frombuffer(self.doc_shard, dtype=np.int32).copy()
+            )
+    
+    @classmethod
+    def load(cls, filepath) -> 'ShardMap':
+        """Read a saved shard map from a path or an open binary file"""
+        shard_map = cls()
+        with np.load(filepath) as data:
+            text = data['keys'].tobytes().decode()
+            shard_map.keys = [tuple(line.split('\t')) for line in text.split('\n')] if text else []
+            shard_map.doc_shard = array('i', data['doc_shard'].tobytes())
+        shard_map.numbers = {key: shard for shard, key in enumerate(shard_map.keys)}
+        return shard_map
+
+@st.cache_resource(show_spinner=False)
+def resource_timings() -> Dict[str, float]:
+    """Process-wide record of how long shared resources took to load, in seconds"""
+    return {}
+
+# Quantized ONNX export shipped with the sentence-transformers models (AVX2 is the widest baseline)
+ONNX_INT8_FILE = 'onnx/model_quint8_avx2.onnx'
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_model(model_name: str, backend: str = 'torch') -> SentenceTransformer:
+    """Load an embedding model once per process and share it across sessions and reruns.
+    
+    'torch-int8' quantizes the linear layers to int8; 'onnx' and 'onnx-int8' run the model through
+    ONNX Runtime and need sentence-transformers>=3.2 with optimum[onnxruntime].
+    """
+    start = time.perf_counter()
+    if backend == 'torch':
+        model = SentenceTransformer(model_name)
+    elif backend == 'torch-int8':
+        model = torch.quantization.quantize_dynamic(SentenceTransformer(model_name, device='cpu'),
+                                                    {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == 'onnx':
+        model = SentenceTransformer(model_name, device='cpu', backend='onnx')
+    elif backend == 'onnx-int8':
+        model = SentenceTransformer(model_name, device='cpu', backend='onnx',
+                                    model_kwargs={'file_name': ONNX_INT8_FILE})
+    else:
+        raise ValueError(f"Unknown encoder backend '{backend}', expected one of {TextEncoder.BACKENDS}")
+    key = f'model_load:{model_name}' if backend == 'torch' else f'model_load:{model_name}:{backend}'
+    resource_timings()[key] = time.perf_counter() - start
+    logger.info(f"Loaded embedding model {model_name} ({backend})")
+    return model
+
+def _init_encode_worker(threads: int):
+    # Split the cores between the pool's processes instead of oversubscribing them
+    torch.set_num_threads(threads)
+
+def _encode_worker(model_name: str, backend: str, texts: List[str], batch_tokens: int,
+                   max_batch_size: int) -> np.ndarray:
+    """Process pool entry point for bulk encoding"""
+    return TextEncoder(model_name, backend, batch_tokens, max_batch_size)._encode_local(texts)
+
+class TextEncoder:
+    """Embeds texts with a selectable CPU backend, in length-sorted batches sized by a token budget.
+    
+    Short texts go through in large batches and long ones in small batches with little padding.
+    Jobs of at least pool_min_texts are split across a pool of `processes` spawned processes.
+    Every backend encodes the same model, so vectors stay compatible with existing indexes
+    within the tolerance checked by compare().
+    """
+    
+    BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+    
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', backend: str = 'torch', batch_tokens: int = 16384,
+                 max_batch_size: int = 256, processes: int = 1, pool_min_texts: int = 256,
+                 max_tokens: int = 512):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown encoder backend '{backend}', expected one of {self.BACKENDS}")
+        self.model_name = model_name
+        self.requested_backend = backend
+        # Backend actually in use; falls back to torch when the requested one cannot load
+        self.backend = backend
+        self.batch_tokens = batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_tokens = max_tokens
+        self.processes = max(1, processes)
+        self.pool_min_texts = pool_min_texts
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.sentences = 0
+        self.seconds = 0.0
+    
+    @property
+    def model(self) -> SentenceTransformer:
+        """Shared model for the active backend, loaded on first use"""
+        if self.backend != 'torch':
+            try:
+                return get_embedding_model(self.model_name, self.backend)
+            except Exception as e:
+                logger.warning(f"Encoder backend {self.backend} unavailable, using torch: {str(e)}")
+                self.backend = 'torch'
+        return get_embedding_model(self.model_name)
+    
+    def batches(self, texts: List[str]) -> List[np.ndarray]:
+        """Text positions grouped into batches, longest first, each within the token budget"""
+        # Roughly four characters per token; the model truncates beyond max_tokens
+        lengths = np.minimum(np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts)) // 4 + 2,
+                             self.max_tokens)
+        order = np.argsort(-lengths, kind='stable')
+        batches = []
+        start = 0
+        while start < len(order):
+            # The first text of a batch is its longest, so it sets the padded width
+            size = max(1, min(self.max_batch_size, self.batch_tokens // int(lengths[order[start]])))
+            batches.append(order[start:start + size])
+            start += size
+        return batches
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts as float32 rows in input order"""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        start = time.perf_counter()
+        vectors = None
+        if self.processes > 1 and len(texts) >= self.pool_min_texts:
+            pool = self._get_pool()
+            if pool is not None:
+                try:
+                    vectors = self._encode_pool(pool, texts)
+                except Exception as e:
+                    # e.g. unpicklable module under Streamlit or a broken pool; encode in-process from now on
+                    logger.warning(f"Encode pool unavailable, encoding in-process: {str(e)}")
+                    self._disable_pool()
+        if vectors is None:
+            vectors = self._encode_local(texts)
+        with self._stats_lock:
+            self.sentences += len(texts)
+            self.seconds += time.perf_counter() - start
+        return vectors
+    
+    def _encode_local(self, texts: List[str]) -> np.ndarray:
+        model = self.model
+        vectors = None
+        for batch in self.batches(texts):
+            encoded = np.asarray(model.encode([texts[i] for i in batch], batch_size=len(batch),
+                                              show_progress_bar=False), dtype=np.float32)
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[batch] = encoded
+        return vectors
+    
+    def _encode_pool(self, pool: ProcessPoolExecutor, texts: List[str]) -> np.ndarray:
+        # Deal texts out by length so every process gets a similar share of the work
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        parts = [order[worker::self.processes] for worker in range(self.processes)]
+        futures = [(part, pool.submit(_encode_worker, self.model_name, self.backend, [texts[i] for i in part],
+                                      self.batch_tokens, self.max_batch_size))
+                   for part in parts if len(part)]
+        vectors = None
+        for part, future in futures:
+            encoded = future.result()
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[part] = encoded
+        return vectors
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """Lazily start the encode pool; spawned, as forking after torch starts its threads can hang"""
+        # Load the model here first, so a backend that cannot load falls back before workers inherit it
+        self.model
+        with self._pool_lock:
+            if self._pool is None and self.processes > 1:
+                import multiprocessing
+                threads = max(1, (os.cpu_count() or 1) // self.processes)
+                self._pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_encode_worker, initargs=(threads,))
+            return self._pool
+    
+    def _disable_pool(self):
+        with self._pool_lock:
+            self.processes = 1
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+    
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+    
+    def throughput(self) -> Dict:
+        """Texts encoded so far and the rate, for comparing backends"""
+        with self._stats_lock:
+            return {
+                'backend': self.backend,
+                'processes': self.processes,
+                'sentences': self.sentences,
+                'seconds': self.seconds,
+                'sentences_per_second': self.sentences / self.seconds if self.seconds else 0.0
+            }
+    
+    def compare(self, texts: List[str], reference: str = 'torch', tolerance: float = 0.02, k: int = 10) -> Dict:
+        """Check this encoder against the plain model.encode path of a reference backend on sample texts.
+        
+        Compatible when every vector is within `tolerance` cosine distance of the reference one;
+        neighbour recall is the overlap of each text's top-k neighbours under both.
+        """
+        reference_encoder = TextEncoder(self.model_name, reference)
+        reference_model = reference_encoder.model
+        # Warm up first so model loads and pool start-up don't count against either rate
+        reference_model.encode(texts[:1])
+        self.encode(texts if self.processes > 1 else texts[:1])
+        
+        start = time.perf_counter()
+        reference_vectors = np.asarray(reference_model.encode(texts, batch_size=64, show_progress_bar=False), dtype=np.float32)
+        reference_rate = len(texts) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        vectors = self.encode(texts)
+        rate = len(texts) / (time.perf_counter() - start)
+        
+        norms = np.linalg.norm(reference_vectors, axis=1) * np.linalg.norm(vectors, axis=1)
+        cosine = (reference_vectors * vectors).sum(axis=1) / np.maximum(norms, 1e-12)
+        k = min(k, len(texts) - 1)
+        recall = 1.0
+        if k > 0:
+            neighbours = []
+            for matrix in (reference_vectors, vectors):
+                scores = matrix @ matrix.T
+                np.fill_diagonal(scores, -np.inf)
+                neighbours.append(np.argsort(-scores, axis=1)[:, :k])
+            recall = float(np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(*neighbours)]))
+        
+        return {
+            'backend': self.backend,
+            'reference': reference_encoder.backend,
+            'processes': self.processes,
+            'texts': len(texts),
+            'min_cosine': float(cosine.min()),
+            'mean_cosine': float(cosine.mean()),
+            'neighbour_recall': recall,
+            'k': k,
+            'tolerance': tolerance,
+            'compatible': bool(1.0 - cosine.min() <= tolerance),
+            'sentences_per_second': rate,
+            'reference_sentences_per_second': reference_rate,
+            'speedup': rate / reference_rate
+        }
+
+@st.cache_resource(show_spinner=False)
+def get_text_encoder(model_name: str, backend: str = 'torch', processes: int = 1,
+                     max_batch_size: int = 256) -> TextEncoder:
+    """Encoder shared by every vector store in the process, so its pool is only started once"""
+    return TextEncoder(model_name, backend, max_batch_size=max_batch_size, processes=processes)
+
+class BufferIndex:
+    """Exact search straight over a VectorStore's vector buffer, standing in for a FAISS flat index.
+    
+    Vectors are never copied into it: adds and removals are already reflected in the buffer.
+    """
+    
+    def __init__(self, store: 'VectorStore'):
+        self.store = store
+    
+    @property
+    def ntotal(self) -> int:
+        return len(self.store._docs)
+    
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray):
+        pass
+    
+    def remove_ids(self, ids: np.ndarray):
+        pass
+    
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.store._exact_search(np.ascontiguousarray(queries, dtype=np.float32), k)
+
+class VectorStore:
+    """Vector store for document embeddings using FAISS"""
+    
+    INDEX_TYPES = ('auto', 'flat', 'hnsw', 'ivf', 'ivfpq')
+    VECTOR_DTYPES = ('float32', 'float16', 'int8')
+    
+    # Rows scored per block by the exact search over quantized vectors
+    SEARCH_BLOCK = 16384
+    # Filtered searches scan the selected shards exactly up to this many documents,
+    # and search ANN indexes with an id selector beyond it
+    FILTER_SCAN_MAX = 100000
+    # Selected shards are scanned in parallel once they hold this many documents
+    SHARD_PARALLEL_MIN = 20000
+    # HNSW graphs keep removed vectors as tombstones until they are this fraction of the graph
+    TOMBSTONE_REBUILD = 0.25
+    # Trained indexes (IVF lists, scalar-quantizer ranges) are retrained from the buffer once
+    # the corpus is this many times the size they were trained on
+    RETRAIN_GROWTH = 4
+    
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2',
+                 embedding_cache_path: str = "pql_embedding_cache.db", batch_size: int = 256,
+                 index_type: str = 'auto', hnsw_m: int = 32, ef_search: int = 64, nprobe: int = 16,
+                 query_cache_size: int = 1024, hybrid: bool = True, rrf_k: int = 60,
+                 use_symbols: bool = True, vector_dtype: str = 'float32', shard_workers: int = None,
+                 encoder_backend: str = None, encode_processes: int = None):
+        if index_type not in self.INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{index_type}', expected one of {self.INDEX_TYPES}")
+        if vector_dtype not in self.VECTOR_DTYPES:
+            raise ValueError(f"Unknown vector dtype '{vector_dtype}', expected one of {self.VECTOR_DTYPES}")
+        
+        self.model_name = model_name
+        # Storage type of the vector buffer; int8 and float16 trade a little recall for 4x/2x less memory
+        self.vector_dtype = vector_dtype
+        self.index = None
+        # Files of a loaded store that are parsed on first use, by name ('index' while the index
+        # is memory-mapped, which FAISS treats as read-only). Open handles keep reading the loaded
+        # store even after a later save() replaces its directory.
+        self._side_files = {}
+        self._side_files_lock = threading.Lock()
+        # Number of vectors a trained index was trained on, 0 for indexes without training
+        self._trained_size = 0
+        # Most texts per encode batch; batches are otherwise sized by the encoder's token budget
+        self.batch_size = batch_size
+        # CPU encoder backend and bulk-encoding processes, e.g. PQL_ENCODER_BACKEND=torch-int8
+        self.encoder = get_text_encoder(model_name, encoder_backend or os.environ.get('PQL_ENCODER_BACKEND', 'torch'),
+                                        encode_processes or int(os.environ.get('PQL_ENCODE_PROCESSES', '1')),
+                                        batch_size)
+        
+        # Index backend and its search-time parameters
+        self.index_type = index_type
+        self.index_kind = None
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        
+        # Documents and vectors are keyed by stable FAISS ids; vectors live in a
+        # preallocated buffer that grows geometrically so appends stay O(batch).
+        # Flat search scans the buffer directly, so it is then the only copy of the vectors.
+        # HNSW and IVF keep a second copy in FAISS storage (same dtype as the buffer, or PQ
+        # codes for ivfpq): their graph and list searches read vectors from inside FAISS.
+        self._docs = DocumentTable()
+        self._id_rows = np.empty(0, dtype=np.int64)  # doc id -> buffer row, -1 once removed
+        self._row_ids = np.empty(0, dtype=np.int64)  # buffer row -> doc id, -1 for dead rows
+        self._buffer = None
+        self._used = 0
+        self._next_id = 0
+        # Changes whenever the contents change, so dependent caches can invalidate
+        self.version = uuid.uuid4().hex
+        self.embedding_cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+        
+        # Bounded LRU of query embeddings so repeated questions skip encoding
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        
+        # Sparse BM25 index fused with dense results (reciprocal rank fusion)
+        self.hybrid = hybrid
+        self.rrf_k = rrf_k
+        self._bm25 = BM25Index()
+        
+        # PQL function/operator table for direct lookups
+        self.use_symbols = use_symbols
+        self._symbols = SymbolIndex()
+        
+        # Category/date shards for filtered search, scanned in parallel on a small thread pool
+        self._shards = ShardMap()
+        self.shard_workers = shard_workers or min(8, os.cpu_count() or 4)
+        self._shard_pool = None
+        self._shard_pool_lock = threading.Lock()
+    
+    @property
+    def model(self) -> SentenceTransformer:
+        """Shared embedding model, loaded on first use"""
+        return self.encoder.model
+    
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed texts, encoding only those missing from the embedding cache"""
+        if self.embedding_cache is None:
+            METRICS.inc('pql_texts_encoded_total', len(texts))
+            with METRICS.timer('encode'):
+                return self.encoder.encode(texts)
+        
+        hashes = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+        cached = self.embedding_cache.get_many(self.model_name, hashes)
+        
+        # Encode each distinct missing text once
+        missing = {}
+        for content_hash, text in zip(hashes, texts):
+            if content_hash not in cached and content_hash not in missing:
+                missing[content_hash] = text
+        
+        if missing:
+            METRICS.inc('pql_texts_encoded_total', len(missing))
+            with METRICS.timer('encode'):
+                encoded = self.encoder.encode(list(missing.values()))
+            fresh = dict(zip(missing.keys(), encoded))
+            self.embedding_cache.put_many(self.model_name, fresh)
+            cached.update(fresh)
+        
+        self.embedding_cache.misses += len(missing)
+        self.embedding_cache.hits += len(texts) - len(missing)
+        
+        return np.vstack([cached[content_hash] for content_hash in hashes])
+    
+    def __len__(self) -> int:
+        return len(self._docs)
+    
+    @property
+    def documents(self) -> List[DocumentChunk]:
+        """Documents currently in the store, in insertion order (reads every chunk)"""
+        return [chunk for _, chunk in self._docs.iter_chunks()]
+    
+    def recent_documents(self, n: int = 5) -> List[DocumentChunk]:
+        """Most recently scraped documents"""
+        return self._docs.recent(n)
+    
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Embeddings of the current documents, aligned with self.documents"""
+        if not self._docs:
+            return None
+        return self._vectors(self._live_rows())
+    
+    def _live_rows(self) -> np.ndarray:
+        """Buffer rows of the current documents, in document order"""
+        return self._id_rows[np.fromiter(self._docs, dtype=np.int64, count=len(self._docs))]
+    
+    def _vectors(self, rows) -> np.ndarray:
+        """float32 vectors for buffer rows (a slice or an index array)"""
+        return self._dequantize(self._buffer[rows])
+    
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        """Convert float32 vectors to the storage dtype"""
+        if self.vector_dtype == 'int8':
+            # Embeddings are unit length, so every component fits in [-1, 1]
+            return np.clip(np.rint(vectors * 127), -127, 127).astype(np.int8)
+        return vectors.astype(self.vector_dtype, copy=False)
+    
+    @staticmethod
+    def _dequantize(vectors: np.ndarray) -> np.ndarray:
+        if vectors.dtype == np.int8:
+            return vectors.astype(np.float32) / 127
+        return np.asarray(vectors, dtype=np.float32)
+    
+    def _exact_search(self, queries: np.ndarray, k: int, mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Brute-force inner product search over the buffer (rows where mask is True), in FAISS (scores, ids) form"""
+        used = self._used
+        if self._buffer.dtype == np.float32:
+            scores = queries @ self._buffer[:used].T
+        else:
+            scores = np.empty((len(queries), used), dtype=np.float32)
+            for start in range(0, used, self.SEARCH_BLOCK):
+                end = min(start + self.SEARCH_BLOCK, used)
+                scores[:, start:end] = queries @ self._vectors(slice(start, end)).T
+        
+        row_ids = self._row_ids[:used]
+        scores[:, row_ids < 0] = -np.inf
+        if mask is not None:
+            scores[:, ~mask[:used]] = -np.inf
+        return self._top_k(scores, row_ids, k)
+    
+    def _exact_search_ids(self, queries: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Brute-force search restricted to the given doc ids, in FAISS (scores, ids) form"""
+        scores = np.empty((len(queries), len(ids)), dtype=np.float32)
+        for start in range(0, len(ids), self.SEARCH_BLOCK):
+            end = min(start + self.SEARCH_BLOCK, len(ids))
+            scores[:, start:end] = queries @ self._vectors(self._id_rows[ids[start:end]]).T
+        return self._top_k(scores, ids, k)
+    
+    @staticmethod
+    def _top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Best k columns of each row of scores, best first; -inf scores come back as id -1.
+        
+        ids labels the columns, either once for all rows or per row (when merging results).
+        """
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return np.empty((len(scores), 0), dtype=np.float32), np.empty((len(scores), 0), dtype=np.int64)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        found = np.take_along_axis(ids, top, axis=1) if ids.ndim == 2 else ids[top]
+        return top_scores, np.where(np.isfinite(top_scores), found, -1)
+    
+    def _filtered_search(self, queries: np.ndarray, k: int, shards: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Search only the documents in the given shards, in FAISS (scores, ids) form"""
+        members = self.shard_map.members()
+        groups = [members[shard] for shard in shards if shard in members]
+        total = sum(len(ids) for ids in groups)
+        if not total:
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        
+        if self.index_kind != 'flat' and total > self.FILTER_SCAN_MAX:
+            return self._selector_search(queries, k, np.concatenate(groups), total / len(self._docs))
+        if self.index_kind == 'flat' and total > self._used // 4:
+            # Gathering scattered rows costs more than a contiguous scan of the whole buffer
+            mask = np.zeros(self._used, dtype=bool)
+            mask[self._id_rows[np.concatenate(groups)]] = True
+            return self._exact_search(queries, k, mask)
+        
+        if len(groups) > 1 and total >= self.SHARD_PARALLEL_MIN:
+            # Shards are independent: scan each on its own thread (numpy releases the GIL) and merge
+            results = list(self._shard_executor().map(lambda ids: self._exact_search_ids(queries, ids, k), groups))
+            return self._top_k(np.hstack([scores for scores, _ in results]),
+                               np.hstack([ids for _, ids in results]), k) if len(results) > 1 else results[0]
+        return self._exact_search_ids(queries, np.concatenate(groups), k)
+    
+    def _selector_search(self, queries: np.ndarray, k: int, ids: np.ndarray,
+                         fraction: float) -> Tuple[np.ndarray, np.ndarray]:
+        """ANN search limited to ids, widening the search as the selection gets sparser"""
+        selector = faiss.IDSelectorBatch(ids)
+        widen = 1 / max(fraction, 1e-3)
+        if self.index_kind == 'hnsw':
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=int(min(1024, max(k, self.ef_search * widen))))
+        else:
+            nlist = faiss.extract_index_ivf(self.index).nlist
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=int(min(nlist, self.nprobe * widen)))
+        return self.index.search(queries, k, params=params)
+    
+    def _shard_executor(self) -> ThreadPoolExecutor:
+        with self._shard_pool_lock:
+            if self._shard_pool is None:
+                self._shard_pool = ThreadPoolExecutor(max_workers=self.shard_workers)
+            return self._shard_pool
+    
+    def add_documents(self, chunks: List[DocumentChunk]) -> List[int]:
+        """Add document chunks to the vector store, returning their ids"""
+        if not chunks:
+            return []
+        
+        # Extract text content
+        texts = [chunk.content for chunk in chunks]
+        
+        # Generate embeddings
+        new_embeddings = self.encode_texts(texts)
+        
+        return self._append(new_embeddings, chunks)
+    
+    def _append(self, vectors: np.ndarray, chunks: List[DocumentChunk]) -> List[int]:
+        """Append vectors straight into the buffer and the FAISS index"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        self._ensure_writable_index()
+        
+        # Grow the buffer geometrically instead of re-stacking on every add
+        if self._buffer is None or self._used + n > len(self._buffer):
+            capacity = max(1024, self._used + n, 2 * (len(self._buffer) if self._buffer is not None else 0))
+            buffer = np.empty((capacity, dim), dtype=self.vector_dtype)
+            row_ids = np.full(capacity, -1, dtype=np.int64)
+            if self._buffer is not None:
+                buffer[:self._used] = self._buffer[:self._used]
+                row_ids[:self._used] = self._row_ids[:self._used]
+            self._buffer = buffer
+            self._row_ids = row_ids
+        
+        ids = np.arange(self._next_id, self._next_id + n, dtype=np.int64)
+        rows = np.arange(self._used, self._used + n, dtype=np.int64)
+        self._buffer[rows] = self._quantize(vectors)
+        self._row_ids[rows] = ids
+        if self._next_id + n > len(self._id_rows):
+            id_rows = np.full(max(1024, self._next_id + n, 2 * len(self._id_rows)), -1, dtype=np.int64)
+            id_rows[:len(self._id_rows)] = self._id_rows
+            self._id_rows = id_rows
+        self._id_rows[ids] = rows
+        
+        lexical, symbols, shards = self.lexical_index, self.symbol_index, self.shard_map
+        for doc_id, chunk in zip(ids.tolist(), chunks):
+            self._docs[doc_id] = chunk
+            lexical.add(doc_id, chunk.content)
+            symbols.add(doc_id, chunk)
+            shards.add(doc_id, chunk)
+        
+        self._used += n
+        self._next_id += n
+        self.version = uuid.uuid4().hex
+        
+        # Rebuild only when the corpus crosses into a different index type or outgrows its training
+        if (self.index is None or self._choose_index_type(len(self._docs)) != self.index_kind
+                or self._needs_retrain(len(self._docs))):
+            self._rebuild_index()
+        else:
+            self.index.add_with_ids(vectors, ids)
+        
+        return ids.tolist()
+    
+    def _choose_index_type(self, n: int) -> str:
+        """Pick the index backend for a corpus of n vectors"""
+        if self.index_type != 'auto':
+            return self.index_type
+        if n < 20000:
+            return 'flat'
+        if n < 500000:
+            return 'hnsw'
+        return 'ivfpq'
+    
+    def _build_index(self, kind: str, vectors: np.ndarray) -> faiss.Index:
+        """Create (and train, for IVF) an empty index of the given kind"""
+        n, dim = vectors.shape
+        
+        if kind == 'flat':
+            return BufferIndex(self)
+        
+        # Quantized stores use scalar-quantized FAISS storage to match
+        sq_type = {'float16': faiss.ScalarQuantizer.QT_fp16, 'int8': faiss.ScalarQuantizer.QT_8bit}.get(self.vector_dtype)
+        if kind == 'hnsw':
+            if sq_type is None:
+                return faiss.IndexIDMap(faiss.IndexHNSWFlat(dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT))
+            index = faiss.IndexHNSWSQ(dim, sq_type, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+            return faiss.IndexIDMap(index)
+        
+        # IVF needs roughly 39 training points per list
+        nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        if kind == 'ivf' and sq_type is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, sq_type, faiss.METRIC_INNER_PRODUCT)
+        elif kind == 'ivf':
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            m = next(m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1) if dim % m == 0)
+            nbits = max(1, min(8, int(np.log2(max(n, 2))) - 1))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        return index
+    
+    def _rebuild_index(self):
+        """Rebuild the index from the live vectors, keeping their ids"""
+        if not self._docs:
+            self.index = None
+            self.index_kind = None
+            return
+        
+        ids = np.fromiter(self._docs, dtype=np.int64, count=len(self._docs))
+        self.index_kind = self._choose_index_type(len(ids))
+        self._close_side_file('index')
+        if self.index_kind == 'flat':
+            # Searches the buffer in place; nothing to copy
+            self.index = self._build_index('flat', self._buffer[:0])
+        else:
+            vectors = np.ascontiguousarray(self.embeddings)
+            self.index = self._build_index(self.index_kind, vectors)
+            self.index.add_with_ids(vectors, ids)
+        self._trained_size = len(ids) if self._is_trained_index() else 0
+        self.set_search_params()
+        logger.info(f"Built {self.index_kind} index over {len(ids)} vectors")
+    
+    def _inner_index(self) -> faiss.Index:
+        """The index without its id mapping layer"""
+        return faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+    
+    def _is_trained_index(self) -> bool:
+        """Whether the index learned parameters from the vectors it was built from"""
+        return self.index is not None and isinstance(self._inner_index(), (faiss.IndexIVF, faiss.IndexHNSWSQ))
+    
+    def _needs_retrain(self, n: int) -> bool:
+        """Whether a trained index no longer fits a corpus of n vectors"""
+        if not self._trained_size:
+            return False
+        if n > self.RETRAIN_GROWTH * self._trained_size:
+            return True
+        # More IVF lists than the remaining vectors can fill
+        return getattr(self._inner_index(), 'nlist', 1) > max(1, n // 39)
+    
+    def _ensure_writable_index(self):
+        """Swap a memory-mapped index for an in-memory copy before it is modified"""
+        with self._side_files_lock:
+            index_file = self._side_files.pop('index', None)
+        if index_file is None:
+            return
+        # Read from the handle opened by load(): the path may hold a newer store by now
+        with index_file:
+            index_file.seek(0)
+            self.index = faiss.read_index(faiss.PyCallbackIOReader(index_file.read))
+        self.set_search_params()
+    
+    def set_search_params(self, ef_search: int = None, nprobe: int = None):
+        """Tune search-time accuracy/latency (efSearch for HNSW, nprobe for IVF)"""
+        if ef_search is not None:
+            self.ef_search = ef_search
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if self.index is None:
+            return
+        
+        inner = self._inner_index()
+        if hasattr(inner, 'hnsw'):
+            inner.hnsw.efSearch = self.ef_search
+        if hasattr(inner, 'nprobe'):
+            inner.nprobe = self.nprobe
+    
+    def benchmark_index(self, k: int = 10, n_queries: int = 200, queries: np.ndarray = None) -> Dict:
+        """Report recall@k of the current index against exact search, and p50/p99 query latency"""
+        if self.index is None:
+            return {}
+        
+        vectors = np.ascontiguousarray(self.embeddings)
+        ids = np.fromiter(self._docs, dtype=np.int64, count=len(self._docs))
+        if queries is None:
+            # Perturbed copies of stored vectors stand in for real queries
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+            queries = sample + rng.normal(scale=0.05, size=sample.shape).astype(np.float32)
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        
+        exact = faiss.IndexIDMap(faiss.IndexFlatIP(vectors.shape[1]))
+        exact.add_with_ids(vectors, ids)
+        
+        def timed(search):
+            latencies, found = [], []
+            for query in queries:
+                start = time.perf_counter()
+                _, result = search(query[None, :], k)
+                latencies.append((time.perf_counter() - start) * 1000)
+                found.append(result[0])
+            return np.array(latencies), found
+        
+        exact_latency, truth = timed(exact.search)
+        index_latency, approx = timed(self._index_search)
+        # Tombstoned neighbours are dropped, as search_batch does
+        approx = [np.array([doc_id for doc_id in a if doc_id in self._docs][:k], dtype=np.int64) for a in approx]
+        
+        recall = np.mean([
+            len(set(t[t >= 0]) & set(a[a >= 0])) / max(1, len(t[t >= 0]))
+            for t, a in zip(truth, approx)
+        ])
+        
+        return {
+            'index_type': self.index_kind,
+            'vectors': len(ids),
+            'tombstones': self._tombstones(),
+            'queries': len(queries),
+            f'recall@{k}': float(recall),
+            'p50_ms': float(np.percentile(index_latency, 50)),
+            'p99_ms': float(np.percentile(index_latency, 99)),
+            'flat_p50_ms': float(np.percentile(exact_latency, 50)),
+            'flat_p99_ms': float(np.percentile(exact_latency, 99))
+        }
+    
+    def remove_ids(self, ids: List[int]):
+        """Remove documents by their stable ids"""
+        ids = [doc_id for doc_id in ids if doc_id in self._docs]
+        if not ids:
+            return
+        self._ensure_writable_index()
+        
+        lexical, symbols, shards = self.lexical_index, self.symbol_index, self.shard_map
+        for chunk, doc_id in zip(self._docs.get_many(ids), ids):
+            lexical.remove(doc_id, chunk.content)
+            symbols.remove(doc_id)
+            shards.remove(doc_id)
+            self._docs.remove(doc_id)
+        removed = np.array(ids, dtype=np.int64)
+        self._row_ids[self._id_rows[removed]] = -1
+        self._id_rows[removed] = -1
+        self.version = uuid.uuid4().hex
+        
+        # Reclaim buffer rows once more than half of them are dead
+        if len(self._docs) < self._used // 2:
+            self._compact()
+        
+        if not self._docs or self._needs_retrain(len(self._docs)):
+            self._rebuild_index()
+        elif self.index_kind == 'hnsw':
+            # HNSW graphs cannot delete vectors: removed ones stay in the graph and are skipped
+            # by search, and the graph is rebuilt from the buffer once too much of it is dead
+            if self._tombstones() > self.TOMBSTONE_REBUILD * self.index.ntotal:
+                self._rebuild_index()
+        else:
+            self.index.remove_ids(np.array(ids, dtype=np.int64))
+    
+    def _tombstones(self) -> int:
+        """Removed vectors still held by the index"""
+        return self.index.ntotal - len(self._docs) if self.index is not None else 0
+    
+    def _index_search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the index, asking for enough extra neighbours to make up for tombstones"""
+        tombstones = self._tombstones()
+        if tombstones:
+            k += int(np.ceil(2 * k * tombstones / self.index.ntotal)) + 1
+        return self.index.search(queries, k)
+    
+    def remove_chunks(self, chunk_ids: List[str]):
+        """Remove documents by chunk id"""
+        ids = [self._docs.id_for_chunk(chunk_id) for chunk_id in chunk_ids]
+        self.remove_ids([doc_id for doc_id in ids if doc_id is not None])
+    
+    def _compact(self):
+        """Pack live vectors to the front of the buffer; ids are unchanged"""
+        ids = np.fromiter(self._docs, dtype=np.int64, count=len(self._docs))
+        rows = self._id_rows[ids]
+        self._buffer[:len(rows)] = self._buffer[rows]
+        self._row_ids[:] = -1
+        self._row_ids[:len(rows)] = ids
+        self._id_rows[ids] = np.arange(len(rows), dtype=np.int64)
+        self._used = len(rows)
+    
+    @property
+    def lexical_index(self) -> BM25Index:
+        """BM25 index over chunk text; a saved one is read (or rebuilt) on first use"""
+        if self._bm25 is None:
+            with self._side_files_lock:
+                if self._bm25 is None:
+                    bm25 = self._read_side_file('bm25', BM25Index.load)
+                    if bm25 is None:
+                        bm25 = BM25Index()
+                        for doc_id, chunk in self._docs.iter_chunks():
+                            bm25.add(doc_id, chunk.content)
+                    self._bm25 = bm25
+        return self._bm25
+    
+    @property
+    def symbol_index(self) -> SymbolIndex:
+        """PQL symbol table; a saved one is read (or rebuilt) on first use"""
+        if self._symbols is None:
+            with self._side_files_lock:
+                if self._symbols is None:
+                    symbols = self._read_side_file('symbols', SymbolIndex.load)
+                    if symbols is None:
+                        symbols = SymbolIndex()
+                        for doc_id, chunk in self._docs.iter_chunks():
+                            symbols.add(doc_id, chunk)
+                    self._symbols = symbols
+        return self._symbols
+    
+    @property
+    def shard_map(self) -> ShardMap:
+        """Category/date partitioning of the documents; a saved one is read (or rebuilt) on first use"""
+        if self._shards is None:
+            with self._side_files_lock:
+                if self._shards is None:
+                    shards = self._read_side_file('shards', ShardMap.load)
+                    if shards is None:
+                        shards = ShardMap()
+                        for doc_id, chunk in self._docs.iter_chunks():
+                            shards.add(doc_id, chunk)
+                    self._shards = shards
+        return self._shards
+    
+    def _read_side_file(self, name: str, loader):
+        """Parse and close a file opened by load(); None if the store has no such file"""
+        f = self._side_files.pop(name, None)
+        if f is None:
+            return None
+        with f:
+            return loader(f)
+    
+    def _close_side_file(self, name: str):
+        with self._side_files_lock:
+            f = self._side_files.pop(name, None)
+        if f is not None:
+            f.close()
+    
+    def shards(self) -> List[Dict]:
+        """Category, date and size of every shard"""
+        return self.shard_map.describe()
+    
+    def embeddings_for(self, doc_ids: List[int]) -> np.ndarray:
+        """Stored embeddings of documents by id (as returned by search with_ids), in the same order"""
+        return self._vectors(self._id_rows[np.asarray(doc_ids, dtype=np.int64)])
+    
+    def symbols_for(self, doc_id: int) -> List[str]:
+        """PQL functions and operators mentioned in a stored document, by id"""
+        return self.symbol_index.doc_symbols.get(doc_id, [])
+    
+    def _reset(self):
+        self.version = uuid.uuid4().hex
+        self.index = None
+        self.index_kind = None
+        self._trained_size = 0
+        for name in list(self._side_files):
+            self._close_side_file(name)
+        self._bm25 = BM25Index()
+        self._symbols = SymbolIndex()
+        self._shards = ShardMap()
+        self._docs = DocumentTable()
+        self._id_rows = np.empty(0, dtype=np.int64)
+        self._row_ids = np.empty(0, dtype=np.int64)
+        self._buffer = None
+        self._used = 0
+        self._next_id = 0
+    
+    def sync_documents(self, chunks: List[DocumentChunk]) -> Dict[str, int]:
+        """Incrementally update the store to match a fresh set of chunks, embedding only new or changed ones"""
+        new_chunks = {chunk.chunk_id: chunk for chunk in chunks}
+        if len(new_chunks) < len(chunks):
+            logger.warning(f"{len(chunks) - len(new_chunks)} chunks share an id with another chunk and were skipped")
+        report = self.upsert_documents(list(new_chunks.values()))
+        report['deleted'] = self.prune_documents(set(new_chunks))
+        return report
+    
+    def upsert_documents(self, chunks: List[DocumentChunk], vectors: np.ndarray = None) -> Dict[str, int]:
+        """Add new chunks and replace changed ones, leaving every other chunk in place.
+        
+        Precomputed vectors for all of the chunks may be passed in; otherwise only new or changed ones are embedded.
+        """
+        to_embed = []
+        rows = []
+        to_remove = []
+        report = {'added': 0, 'updated': 0, 'unchanged': 0}
+        
+        for row, chunk in enumerate(chunks):
+            doc_id = self._docs.id_for_chunk(chunk.chunk_id)
+            if doc_id is None:
+                report['added'] += 1
+            elif self._docs.keys_for(doc_id)[1] != DocumentTable.content_hash(chunk):
+                to_remove.append(doc_id)
+                report['updated'] += 1
+            else:
+                report['unchanged'] += 1
+                continue
+            to_embed.append(chunk)
+            rows.append(row)
+        
+        self.remove_ids(to_remove)
+        if to_embed:
+            if vectors is None:
+                self._append(self.encode_texts([chunk.content for chunk in to_embed]), to_embed)
+            else:
+                self._append(vectors[rows], to_embed)
+        
+        return report
+    
+    def prune_documents(self, keep_chunk_ids: set) -> int:
+        """Remove chunks whose id is not in keep_chunk_ids, and stale duplicates of a chunk id"""
+        to_remove = []
+        deleted = 0
+        for doc_id in self._docs:
+            chunk_id = self._docs.keys_for(doc_id)[0]
+            if chunk_id not in keep_chunk_ids:
+                to_remove.append(doc_id)
+                deleted += 1
+            elif self._docs.id_for_chunk(chunk_id) != doc_id:
+                to_remove.append(doc_id)
+        
+        self.remove_ids(to_remove)
+        return deleted
+    
+    def content_hashes(self) -> Dict[str, str]:
+        """Snapshot of chunk id -> content hash for every stored chunk"""
+        return dict(self._docs.keys_for(doc_id) for doc_id in self._docs)
+    
+    def search(self, query: str, k: int = 5, filters: Dict = None, with_ids: bool = False) -> List[Tuple]:
+        """Search for similar documents"""
+        with METRICS.timer('search'):
+            return self.search_batch([query], k, filters, with_ids)[0]
+    
+    def search_batch(self, queries: List[str], k: int = 5, filters: Dict = None,
+                     with_ids: bool = False) -> List[List[Tuple]]:
+        """Search several queries with one encode call and one index search.
+        
+        Each hit is (chunk, score), or (doc_id, chunk, score) with_ids.
+        filters ({'category': name or list, 'since': date, 'until': date}, dates as 'YYYY' or
+        'YYYY-MM') restrict every query to the matching shards, which alone are scanned.
+        """
+        if self.index is None or not queries:
+            return [[] for _ in queries]
+        
+        allowed = None
+        if filters:
+            shards = self.shard_map.select(filters)
+            if not shards:
+                return [[] for _ in queries]
+            allowed = self.shard_map.allowed(shards)
+        
+        query_embeddings = self.encode_queries(queries)
+        candidates = 2 * k if self.hybrid else k
+        
+        with METRICS.timer('index_search'):
+            if filters:
+                scores, indices = self._filtered_search(query_embeddings, candidates, shards)
+            else:
+                scores, indices = self._index_search(query_embeddings, candidates)
+        
+        hits = []
+        for i, (row_scores, row_ids) in enumerate(zip(scores, indices)):
+            dense = [(int(doc_id), float(score)) for score, doc_id in zip(row_scores, row_ids)
+                     if doc_id in self._docs][:candidates]
+            rankings = []
+            if self.hybrid:
+                with METRICS.timer('bm25_search'):
+                    rankings.append(self.lexical_index.search(queries[i], candidates, allowed))
+            if self.use_symbols:
+                # Chunks for PQL symbols named in the query are a third ranking, fused with the others
+                matches = self.symbol_index.lookup(queries[i])
+                if matches and allowed is not None:
+                    matches = {doc_id: defines for doc_id, defines in matches.items()
+                               if doc_id < len(allowed) and allowed[doc_id]}
+                if matches:
+                    rankings.append(self._rank_symbol_matches(query_embeddings[i], matches)[:candidates])
+            hits.append((self._fuse(query_embeddings[i], dense, *rankings) if rankings else dense)[:k])
+        
+        # Only the hits' text is read from the metadata store, in one lookup for the whole batch
+        chunks = iter(self._docs.get_many([doc_id for row in hits for doc_id, _ in row]))
+        if with_ids:
+            return [[(doc_id, next(chunks), score) for doc_id, score in row] for row in hits]
+        return [[(next(chunks), score) for _, score in row] for row in hits]
+    
+    def _rank_symbol_matches(self, query_embedding: np.ndarray, matches: Dict[int, bool]) -> List[Tuple[int, float]]:
+        """Order symbol-table hits: defining chunks first, then by cosine similarity"""
+        ids = [doc_id for doc_id in matches if doc_id in self._docs]
+        similarities = self._vectors(self._id_rows[ids]) @ query_embedding
+        ranked = sorted(zip(ids, similarities.tolist()), key=lambda item: (not matches[item[0]], -item[1]))
+        return [(doc_id, float(score)) for doc_id, score in ranked]
+    
+    def _fuse(self, query_embedding: np.ndarray, dense: List[Tuple[int, float]],
+              *rankings: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+        """Reciprocal rank fusion of the dense ranking with BM25 and symbol rankings, scored by cosine similarity"""
+        fused = {}
+        for ranking in (dense,) + rankings:
+            for rank, (doc_id, _) in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        
+        # Report the dense similarity so scores keep their meaning for lexical-only hits
+        dense_scores = dict(dense)
+        ordered = sorted((doc_id for doc_id in fused if doc_id in self._docs), key=lambda doc_id: -fused[doc_id])
+        return [
+            (doc_id, dense_scores[doc_id] if doc_id in dense_scores
+             else float(np.dot(self._vectors(self._id_rows[doc_id]), query_embedding)))
+            for doc_id in ordered
+        ]
+    
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Embed queries, reusing recently seen ones from the LRU cache"""
+        with self._query_cache_lock:
+            cached = {}
+            for query in queries:
+                if query in self._query_cache:
+                    self._query_cache.move_to_end(query)
+                    cached[query] = self._query_cache[query]
+        
+        missing = list(dict.fromkeys(query for query in queries if query not in cached))
+        if missing:
+            with METRICS.timer('query_encode'):
+                encoded = self.encoder.encode(missing)
+            with self._query_cache_lock:
+                for query, embedding in zip(missing, encoded):
+                    cached[query] = embedding
+                    self._query_cache[query] = embedding
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        
+        return np.ascontiguousarray(np.vstack([cached[query] for query in queries]), dtype=np.float32)
+    
+    def save(self, path: str):
+        """Save the vector store as a versioned directory (index, embeddings, metadata)"""
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        
+        ids = np.fromiter(self._docs, dtype=np.int64, count=len(self._docs))
+        # Vectors are written in their storage dtype; flat stores have no separate index file
+        np.save(os.path.join(tmp_path, 'ids.npy'), ids)
+        np.save(os.path.join(tmp_path, 'embeddings.npy'),
+                self._buffer[self._id_rows[ids]] if len(ids) else np.empty((0, 0), dtype=self.vector_dtype))
+        if self.index is not None and self.index_kind != 'flat':
+            faiss.write_index(self.index, os.path.join(tmp_path, 'index.faiss'))
+        DocumentTable.write(os.path.join(tmp_path, 'metadata.sqlite'), self._docs.iter_chunks())
+        self.lexical_index.save(os.path.join(tmp_path, 'bm25.npz'))
+        self.symbol_index.save(os.path.join(tmp_path, 'symbols.json'))
+        self.shard_map.save(os.path.join(tmp_path, 'shards.npz'))
+        
+        manifest = {
+            'format_version': STORE_FORMAT_VERSION,
+            'model_name': self.model_name,
+            'count': len(ids),
+            'next_id': self._next_id,
+            'index_kind': self.index_kind,
+            'trained_size': self._trained_size,
+            'vector_dtype': self.vector_dtype,
+            'encoder_backend': self.encoder.backend,
+            'version': self.version,
+            'saved_at': datetime.now().isoformat()
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        
+        # Swap the finished directory into place
+        old_path = path + '.old'
+        if os.path.exists(path):
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+    
+    def load(self, path: str):
+        """Load a vector store saved with save(); memory-maps vectors and reads chunk text lazily"""
+        if os.path.isfile(path):
+            self._load_pickle(path)
+            return
+        
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['format_version'] not in (1, STORE_FORMAT_VERSION):
+            raise ValueError(f"Unsupported knowledge base format {manifest['format_version']}")
+        if manifest['model_name'] != self.model_name:
+            raise ValueError(f"Knowledge base was built with {manifest['model_name']}, not {self.model_name}")
+        if manifest.get('encoder_backend', 'torch') != self.encoder.requested_backend:
+            logger.info(f"Knowledge base was encoded with the {manifest.get('encoder_backend', 'torch')} backend, "
+                        f"new texts use {self.encoder.requested_backend}")
+        
+        self._reset()
+        ids = np.load(os.path.join(path, 'ids.npy'))
+        if not len(ids):
+            return
+        
+        # Copy-on-write mapping: pages are only read when touched and never written back
+        self._buffer = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='c')
+        if self._buffer.dtype != np.dtype(self.vector_dtype):
+            logger.info(f"Converting stored {self._buffer.dtype} vectors to {self.vector_dtype}")
+            self._buffer = self._quantize(self._dequantize(self._buffer))
+        self._used = len(ids)
+        self._next_id = manifest['next_id']
+        self._row_ids = ids.astype(np.int64)
+        self._id_rows = np.full(self._next_id, -1, dtype=np.int64)
+        self._id_rows[ids] = np.arange(len(ids), dtype=np.int64)
+        self._docs = DocumentTable(os.path.join(path, 'metadata.sqlite'), ids.tolist())
+        # Opened now, parsed on first use. Stores saved before sharding have no shards.npz and
+        # rebuild the shard map from the chunks when first needed.
+        for name, filename in (('bm25', 'bm25.npz'), ('bm25', 'bm25.json'), ('symbols', 'symbols.json'),
+                               ('shards', 'shards.npz')):
+            if name not in self._side_files and os.path.exists(os.path.join(path, filename)):
+                self._side_files[name] = open(os.path.join(path, filename), 'rb')
+        self._bm25 = None
+        self._symbols = None
+        self._shards = None
+        
+        self.index_kind = manifest['index_kind']
+        if self.index_kind == 'flat':
+            # Version 1 stores also carry a FAISS flat copy, which is no longer needed
+            self.index = BufferIndex(self)
+        else:
+            index_path = os.path.join(path, 'index.faiss')
+            try:
+                self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+                # Only IVF lists are mapped; other kinds are read into memory regardless
+                if isinstance(self.index, faiss.IndexIVF):
+                    self._side_files['index'] = open(index_path, 'rb')
+            except Exception:
+                self.index = faiss.read_index(index_path)
+            # Stores saved before trained sizes were recorded count as trained on their contents
+            self._trained_size = manifest.get('trained_size', len(ids)) if self._is_trained_index() else 0
+        self.version = manifest.get('version', self.version)
+        self.set_search_params()
+    
+    def _load_pickle(self, filepath: str):
+        """Load the legacy pickle format; only use on files you created yourself"""
+        with open(filepath, 'rb') as f:
+            data = pickle.load(f)
+        
+        self._reset()
+        if data['embeddings'] is not None and len(data['documents']):
+            self._append(data['embeddings'], data['documents'])
+
+class IngestionPipeline:
+    """Streaming fetch -> parse -> embed -> index ingestion with bounded queues and resumable checkpoints.
+    
+    Each stage runs in its own threads and hands work on through a bounded queue, so a slow
+    stage throttles the ones before it and only a few pages' worth of data is in flight. The
+    store is saved to '<path>.partial' every checkpoint_every pages together with the crawl
+    state, and an interrupted run picks up from there; the finished store replaces <path>.
+    Chunks that nearly repeat one already ingested (above duplicate_threshold) are dropped
+    before embedding; None keeps them all.
+    """
+    
+    _DONE = object()
+    
+    def __init__(self, scraper: CelonisDocScraper, vector_store: VectorStore, path: str = KNOWLEDGE_BASE_PATH,
+                 fetch_workers: int = None, parse_workers: int = None, embed_batch_size: int = 256,
+                 queue_size: int = 32, checkpoint_every: int = 100, duplicate_threshold: float = 0.9):
+        self.scraper = scraper
+        self.vector_store = vector_store
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.checkpoint_path = path + '.checkpoint.json'
+        self.fetch_workers = fetch_workers or scraper.max_workers
+        self.parse_workers = parse_workers or max(1, scraper.parse_workers)
+        self.embed_batch_size = embed_batch_size
+        self.queue_size = queue_size
+        self.checkpoint_every = checkpoint_every
+        self.duplicate_threshold = duplicate_threshold
+        self.stats = {}
+    
+    def run(self, seed_urls: Dict[str, str], max_depth: int = 1, resume: bool = True,
+            progress=None) -> Dict[str, int]:
+        """Ingest everything reachable from seed_urls and save the store; progress(stats) is called periodically"""
+        self._start(seed_urls, max_depth, resume)
+        
+        parse_queue = queue.Queue(self.queue_size)
+        chunk_queue = queue.Queue(self.queue_size)
+        index_queue = queue.Queue(max(1, self.queue_size // 4))
+        
+        fetchers = [threading.Thread(target=self._fetch_stage, args=(parse_queue,), daemon=True)
+                    for _ in range(self.fetch_workers)]
+        parsers = [threading.Thread(target=self._parse_stage, args=(parse_queue, chunk_queue), daemon=True)
+                   for _ in range(self.parse_workers)]
+        embedder = threading.Thread(target=self._embed_stage, args=(chunk_queue, index_queue), daemon=True)
+        indexer = threading.Thread(target=self._index_stage, args=(index_queue,), daemon=True)
+        for thread in fetchers + parsers + [embedder, indexer]:
+            thread.start()
+        
+        # Each stage learns it is finished once every upstream thread has stopped
+        def close(threads, stage_queue, count):
+            for thread in threads:
+                thread.join()
+            for _ in range(count):
+                stage_queue.put(self._DONE)
+        
+        closers = [
+            threading.Thread(target=close, args=(fetchers, parse_queue, len(parsers)), daemon=True),
+            threading.Thread(target=close, args=(parsers, chunk_queue, 1), daemon=True)
+        ]
+        for thread in closers:
+            thread.start()
+        
+        while indexer.is_alive():
+            indexer.join(1.0)
+            if progress:
+                progress(dict(self.stats))
+        self.scraper._shutdown_parse_pool()
+        
+        if self._error is not None:
+            raise self._error
+        
+        # The crawl finished, so chunks that were not seen again are gone from the site;
+        # a crawl that found nothing (e.g. the site was unreachable) leaves the store alone
+        self.stats['deleted'] = 0
+        if self.stats['chunks']:
+            self.stats['deleted'] = self.vector_store.prune_documents(self._chunk_ids)
+            self.vector_store.save(self.path)
+        self._clear_checkpoint()
+        self.stats['elapsed'] = time.perf_counter() - self._started
+        return dict(self.stats)
+    
+    def _start(self, seed_urls: Dict[str, str], max_depth: int, resume: bool):
+        self.max_depth = max_depth
+        self._seed_key = [list(item) for item in sorted(seed_urls.items())]
+        self.frontier = CrawlFrontier(self.scraper.max_pages)
+        self._discovered = {}  # url -> (depth, seed, priority) of every page queued this run
+        self._completed = set()  # pages whose chunks are in the store
+        self._chunk_ids = set()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._error = None
+        self._started = time.perf_counter()
+        self.stats = {'pages': 0, 'chunks': 0, 'embedded': 0, 'added': 0, 'updated': 0, 'unchanged': 0,
+                      'duplicates': 0, 'checkpoints': 0, 'resumed_pages': 0,
+                      'seeds': {name: 0 for name in seed_urls}}
+        self.duplicate_filter = NearDuplicateFilter(self.duplicate_threshold) if self.duplicate_threshold else None
+        
+        checkpoint = self._load_checkpoint(max_depth) if resume else None
+        if checkpoint is None:
+            self._clear_checkpoint()
+            for name, url in seed_urls.items():
+                self._push(url, 0, name)
+        else:
+            self.vector_store.load(self.partial_path)
+            self._completed = set(checkpoint['completed'])
+            self._chunk_ids = set(checkpoint['chunk_ids'])
+            self.stats.update(checkpoint['stats'])
+            self.stats['resumed_pages'] = len(self._completed)
+            if self.duplicate_filter is not None:
+                for chunk in self.vector_store.documents:
+                    if chunk.chunk_id in self._chunk_ids:
+                        self.duplicate_filter.add(chunk)
+            for url in self._completed:
+                self.frontier.mark_seen(url)
+            for url, (depth, seed, priority) in checkpoint['discovered'].items():
+                self._discovered[url] = (depth, seed, priority)
+                if url not in self._completed:
+                    self.frontier.push(url, depth, seed, priority)
+            logger.info(f"Resuming ingestion with {len(self._completed)} pages already indexed")
         
-        def scrape_page(current_url: str, depth: int = 0) -> List[DocumentChunk]:
-            if depth > max_depth or current_url in visited:
-                return []
+        # Unchanged chunks are recognised by content hash and never reach the encoder
+        self._known_hashes = self.vector_store.content_hashes()
+    
+    def _push(self, url: str, depth: int, seed: str, priority: int = 0):
+        url = CrawlFrontier.normalize_url(url)
+        with self._cond:
+            if url not in self._discovered and len(self._discovered) < self.scraper.max_pages:
+                self._discovered[url] = (depth, seed, priority)
+        self.frontier.push(url, depth, seed, priority)
+    
+    def _fetch_stage(self, parse_queue: queue.Queue):
+        """Pop pages off the frontier and download them"""
+        while not self._stop.is_set():
+            with self._cond:
+                item = self.frontier.pop()
+                if item is None:
+                    # Pages still being parsed may add links, so only stop once nothing is in flight
+                    if self._in_flight == 0:
+                        return
+                    self._cond.wait(0.1)
+                    continue
+                self._in_flight += 1
             
-            visited.add(current_url)
-            page_chunks = []
+            depth, seed, url = item
+            page = self.scraper._fetch_page(url)
+            parse_queue.put((depth, seed, page))
+    
+    def _parse_stage(self, parse_queue: queue.Queue, chunk_queue: queue.Queue):
+        """Parse fetched pages into chunks and queue their links"""
+        while True:
+            item = parse_queue.get()
+            if item is self._DONE:
+                return
             
+            depth, seed, page = item
             try:
-                response = self.session.get(current_url, timeout=10)
-                response.raise_for_status()
-                
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
-                # Extract title
-                title = soup.find('title')
-                title_text = title.get_text().strip() if title else "Untitled"
-                
-                # Remove script and style elements
-                for script in soup(["script", "style"]):
-                    script.decompose()
-                
-                # Extract main content
-                content_selectors = [
-                    'main', 'article', '.content', '.documentation', 
-                    '.markdown-body', '.wiki-content'
-                ]
+                chunks, links, final_url = self.scraper._finish_page(page)
                 
-                main_content = None
-                for selector in content_selectors:
-                    main_content = soup.select_one(selector)
-                    if main_content:
-                        break
-                
-                if not main_content:
-                    main_content = soup.find('body')
+                # Skip pages that redirected onto a URL already crawled
+                if CrawlFrontier.normalize_url(final_url) != page['url'] and not self.frontier.mark_seen(final_url):
+                    chunks, links = [], []
                 
-                if main_content:
-                    # Extract text content in chunks
-                    sections = self._extract_sections(main_content, title_text, current_url)
-                    page_chunks.extend(sections)
+                if depth < self.max_depth:
+                    for link in links:
+                        self._push(link, depth + 1, seed, self.scraper._link_priority(link))
                 
-                # Find related links for deeper scraping
-                if depth < max_depth:
-                    links = soup.find_all('a', href=True)
-                    for link in links[:10]: # Limit to prevent infinite scraping
-                        href = link['href']
-                        if self._is_relevant_link(href, current_url):
-                            full_url = urljoin(current_url, href)
-                            page_chunks.extend(scrape_page(full_url, depth + 1))
-                
-                time.sleep(1) # Rate limiting
+                chunk_queue.put((page['url'], seed, chunks))
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+    
+    def _embed_stage(self, chunk_queue: queue.Queue, index_queue: queue.Queue):
+        """Embed new and changed chunks in batches spanning several pages"""
+        pages, chunks = [], []
+        while True:
+            item = chunk_queue.get()
+            done = item is self._DONE
+            if not done:
+                url, seed, page_chunks = item
+                pages.append((url, seed, len(page_chunks)))
+                chunks.extend(page_chunks)
+            
+            # Flush full batches, and partial ones whenever the upstream stages are idle
+            if pages and (done or len(chunks) >= self.embed_batch_size or chunk_queue.empty()):
+                # After a failure, keep draining so upstream stages are not left blocked
+                if self._error is None:
+                    try:
+                        if self.duplicate_filter is not None:
+                            kept = self.duplicate_filter.filter(chunks)
+                            self.stats['duplicates'] += len(chunks) - len(kept)
+                            chunks = kept
+                        to_embed = [chunk for chunk in chunks
+                                    if self._known_hashes.get(chunk.chunk_id) != DocumentTable.content_hash(chunk)]
+                        vectors = self.vector_store.encode_texts([chunk.content for chunk in to_embed]) if to_embed else None
+                        index_queue.put((pages, chunks, to_embed, vectors))
+                    except Exception as e:
+                        self._fail(e)
+                pages, chunks = [], []
+            
+            if done:
+                index_queue.put(self._DONE)
+                return
+    
+    def _index_stage(self, index_queue: queue.Queue):
+        """Single writer: apply embedded batches to the store and checkpoint periodically"""
+        since_checkpoint = 0
+        while True:
+            item = index_queue.get()
+            if item is self._DONE:
+                return
+            if self._error is not None:
+                continue
+            
+            pages, chunks, to_embed, vectors = item
+            try:
+                if to_embed:
+                    report = self.vector_store.upsert_documents(to_embed, vectors)
+                    self.stats['added'] += report['added']
+                    self.stats['updated'] += report['updated']
+                    self.stats['embedded'] += len(to_embed)
+                self.stats['unchanged'] += len(chunks) - len(to_embed)
+                self.stats['chunks'] += len(chunks)
+                self._chunk_ids.update(chunk.chunk_id for chunk in chunks)
+                for url, seed, count in pages:
+                    self._completed.add(url)
+                    self.stats['seeds'][seed] = self.stats['seeds'].get(seed, 0) + count
+                self.stats['pages'] += len(pages)
                 
+                since_checkpoint += len(pages)
+                if since_checkpoint >= self.checkpoint_every:
+                    self._checkpoint()
+                    since_checkpoint = 0
             except Exception as e:
-                logger.error(f"Error scraping {current_url}: {str(e)}")
-            
-            return page_chunks
-        
-        return scrape_page(url)
+                self._fail(e)
     
-    def _extract_sections(self, content, title: str, url: str) -> List[DocumentChunk]:
-        """Extract sections from HTML content"""
-        chunks = []
-        
-        # Find all headings and their content
-        headings = content.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-        
-        for i, heading in enumerate(headings):
-            section_title = heading.get_text().strip()
+    def _fail(self, error: Exception):
+        """Stop feeding the pipeline after an unrecoverable stage error"""
+        logger.error(f"Ingestion failed: {str(error)}")
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+    
+    def _checkpoint(self):
+        """Save the store and crawl state so an interrupted run can resume"""
+        self.vector_store.save(self.partial_path)
+        with self._cond:
+            discovered = dict(self._discovered)
+        state = {
+            'seed_urls': self._seed_key,
+            'max_depth': self.max_depth,
+            'discovered': discovered,
+            'completed': sorted(self._completed),
+            'chunk_ids': sorted(self._chunk_ids),
+            'stats': {key: value for key, value in self.stats.items() if key not in ('checkpoints', 'resumed_pages')},
+            'saved_at': datetime.now().isoformat()
+        }
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.stats['checkpoints'] += 1
+        logger.info(f"Checkpointed ingestion after {len(self._completed)} pages")
+    
+    def _load_checkpoint(self, max_depth: int) -> Dict:
+        if not (os.path.exists(self.checkpoint_path) and os.path.exists(self.partial_path)):
+            return None
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable ingestion checkpoint: {str(e)}")
+            return None
+        # A checkpoint only applies to the same crawl
+        if checkpoint['seed_urls'] != self._seed_key or checkpoint['max_depth'] != max_depth:
+            return None
+        return checkpoint
+    
+    def _clear_checkpoint(self):
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        if os.path.exists(self.partial_path):
+            shutil.rmtree(self.partial_path, ignore_errors=True)
+
+@st.cache_resource(show_spinner=False)
+def get_token_encoding(model: str):
+    """tiktoken encoding for a model, or None when tiktoken or its data is unavailable"""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        logger.warning(f"Falling back to approximate token counts: {str(e)}")
+        return None
+
+@st.cache_resource(show_spinner=False)
+def get_cross_encoder(model_name: str) -> CrossEncoder:
+    """Load a cross-encoder once per process"""
+    start = time.perf_counter()
+    model = CrossEncoder(model_name)
+    resource_timings()[f'model_load:{model_name}'] = time.perf_counter() - start
+    return model
+
+@st.cache_resource(show_spinner=False)
+def get_reranker() -> 'CrossEncoderReranker':
+    """Process-wide re-ranker, so its latency estimate and timings are shared"""
+    return CrossEncoderReranker()
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str):
+    """One long-lived OpenAI client per API key, so HTTP connections and TLS sessions are reused"""
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+class AnswerCache:
+    """Semantic answer cache keyed on question embeddings, with LRU/TTL eviction.
+    
+    With a filepath the cache is persisted as .npz (embeddings as one float32 matrix, everything else
+    as JSON) by a background thread, at most once per save_delay seconds, so puts never wait on disk.
+    """
+    
+    def __init__(self, threshold: float = 0.95, max_entries: int = 512, ttl_seconds: float = 24 * 3600,
+                 filepath: str = None, save_delay: float = 2.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.filepath = filepath
+        self.save_delay = save_delay
+        self.entries = OrderedDict()
+        self.kb_version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._saver = None
+        if filepath and os.path.exists(filepath):
+            self._load()
+        if filepath:
+            # Write any change still waiting for the saver before the process exits
+            atexit.register(self.flush)
+    
+    def get(self, embedding: np.ndarray, kb_version: str, mode: str) -> Dict:
+        """Return the cached result for a similar enough question, or None"""
+        with self.lock:
+            self._validate(kb_version)
+            now = time.time()
+            for key in [key for key, entry in self.entries.items() if now - entry['created'] > self.ttl_seconds]:
+                del self.entries[key]
             
-            # Get content until next heading
-            content_parts = []
-            current = heading.next_sibling
+            best_key, best_score = None, self.threshold
+            for key, entry in self.entries.items():
+                if entry['mode'] != mode:
+                    continue
+                score = float(np.dot(entry['embedding'], embedding))
+                if score >= best_score:
+                    best_key, best_score = key, score
             
-            while current:
-                if hasattr(current, 'name') and current.name in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-                    break
-                
-                if hasattr(current, 'get_text'):
-                    text = current.get_text().strip()
-                    if text:
-                        content_parts.append(text)
-                
-                current = current.next_sibling
+            if best_key is None:
+                self.misses += 1
+                return None
             
-            if content_parts:
-                section_content = '\n'.join(content_parts)
-                
-                # Create chunks for large sections
-                chunk_size = 1000
-                if len(section_content) > chunk_size:
-                    for j, chunk in enumerate(self._split_text(section_content, chunk_size)):
-                        chunk_id = hashlib.md5(f"{url}_{section_title}_{j}".encode()).hexdigest()
-                        chunks.append(DocumentChunk(
-                            content=chunk,
-                            url=url,
-                            title=title,
-                            section=f"{section_title} (Part {j+1})",
-                            chunk_id=chunk_id,
-                            timestamp=datetime.now()
-                        ))
-                else:
-                    chunk_id = hashlib.md5(f"{url}_{section_title}".encode()).hexdigest()
-                    chunks.append(DocumentChunk(
-                        content=section_content,
-                        url=url,
-                        title=title,
-                        section=section_title,
-                        chunk_id=chunk_id,
-                        timestamp=datetime.now()
-                    ))
-        
-        return chunks
+            self.entries.move_to_end(best_key)
+            self.hits += 1
+            return self.entries[best_key]['result']
     
-    def _split_text(self, text: str, chunk_size: int) -> List[str]:
-        """Split text into chunks of specified size"""
-        words = text.split()
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for word in words:
-            if current_length + len(word) + 1 > chunk_size and current_chunk:
-                chunks.append(' '.join(current_chunk))
-                current_chunk = [word]
-                current_length = len(word)
-            else:
-                current_chunk.append(word)
-                current_length += len(word) + 1
-        
-        if current_chunk:
-            chunks.append(' '.join(current_chunk))
-        
-        return chunks
+    def put(self, question: str, embedding: np.ndarray, kb_version: str, mode: str, result: Dict):
+        with self.lock:
+            self._validate(kb_version)
+            self.entries[(mode, question)] = {
+                'embedding': np.asarray(embedding, dtype=np.float32),
+                'mode': mode,
+                'result': result,
+                'created': time.time()
+            }
+            self.entries.move_to_end((mode, question))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.filepath:
+                self._schedule_save()
     
-    def _is_relevant_link(self, href: str, base_url: str) -> bool:
-        """Determine if a link is relevant for PQL documentation"""
-        if not href or href.startswith('#'):
-            return False
-        
-        # Check for PQL-related keywords
-        pql_keywords = ['pql', 'process', 'query', 'language', 'function', 'operator']
-        href_lower = href.lower()
-        
-        for keyword in pql_keywords:
-            if keyword in href_lower:
-                return True
-        
-        # Check if it's a Celonis documentation link
-        if 'docs.celonis.com' in href or 'community.celonis.com' in href:
-            return True
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+    
+    def _validate(self, kb_version: str):
+        # Answers are only valid for the knowledge base they were generated from
+        if kb_version != self.kb_version:
+            self.entries.clear()
+            self.kb_version = kb_version
+    
+    def _schedule_save(self):
+        self._dirty.set()
+        if self._saver is None:
+            self._saver = threading.Thread(target=self._save_loop, name='answer-cache-saver', daemon=True)
+            self._saver.start()
+    
+    def _save_loop(self):
+        while True:
+            self._dirty.wait()
+            # Let a burst of puts land before writing them all at once
+            time.sleep(self.save_delay)
+            self.flush()
+    
+    def flush(self):
+        """Write pending changes to disk now"""
+        with self._save_lock:
+            if not self._dirty.is_set():
+                return
+            self._dirty.clear()
+            try:
+                self._save()
+            except Exception as e:
+                logger.error(f"Error saving answer cache: {str(e)}")
+    
+    def _save(self):
+        # Only the snapshot is taken under the lock; serializing and writing happen outside it
+        with self.lock:
+            kb_version = self.kb_version
+            items = [(question, entry) for (_, question), entry in self.entries.items()]
         
-        return False
+        meta = {
+            'kb_version': kb_version,
+            'entries': [{'question': question, 'mode': entry['mode'], 'result': entry['result'],
+                         'created': entry['created']} for question, entry in items]
+        }
+        embeddings = (np.vstack([entry['embedding'] for _, entry in items]) if items
+                      else np.empty((0, 0), dtype=np.float32))
+        tmp_path = self.filepath + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, embeddings=embeddings, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8))
+        os.replace(tmp_path, self.filepath)
+    
+    def _load(self):
+        try:
+            with np.load(self.filepath) as data:
+                embeddings = data['embeddings']
+                meta = json.loads(data['meta'].tobytes().decode())
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Error loading answer cache: {str(e)}")
+            return
+        self.kb_version = meta['kb_version']
+        for entry, embedding in zip(meta['entries'], embeddings):
+            self.entries[(entry['mode'], entry['question'])] = {
+                'embedding': embedding,
+                'mode': entry['mode'],
+                'result': entry['result'],
+                'created': entry['created']
+            }
 
-class VectorStore:
-    """Vector store for document embeddings using FAISS"""
+class ContextPacker:
+    """Packs retrieved chunks into a model-token budget, skipping near-duplicates with MMR"""
     
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
-        self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.documents = []
-        self.embeddings = None
+    def __init__(self, max_tokens: int = 1500, mmr_lambda: float = 0.7, duplicate_threshold: float = 0.95,
+                 model: str = "gpt-3.5-turbo"):
+        self.max_tokens = max_tokens
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
+        self.model = model
+        self.separator = '\n\n---\n\n'
     
-    def add_documents(self, chunks: List[DocumentChunk]):
-        """Add document chunks to the vector store"""
-        if not chunks:
-            return
+    def count_tokens(self, text: str) -> int:
+        encoding = get_token_encoding(self.model)
+        if encoding is None:
+            # Roughly four characters per token for English text
+            return len(text) // 4 + 1
+        return len(encoding.encode(text))
+    
+    def truncate(self, text: str, max_tokens: int) -> str:
+        encoding = get_token_encoding(self.model)
+        if encoding is None:
+            return text[:max_tokens * 4]
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+    
+    def pack(self, candidates: List[Tuple[DocumentChunk, float]], embeddings: np.ndarray,
+             max_tokens: int = None, relevance: List[float] = None) -> List[Tuple[DocumentChunk, float, str]]:
+        """Pick chunks by maximal marginal relevance until the token budget is full.
         
-        # Extract text content
-        texts = [chunk.content for chunk in chunks]
+        Relevance defaults to the retrieval scores. Returns (chunk, score, context part)
+        triples in selection order.
+        """
+        budget = max_tokens or self.max_tokens
+        relevance = relevance if relevance is not None else [score for _, score in candidates]
+        separator_tokens = self.count_tokens(self.separator)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
         
-        # Generate embeddings
-        new_embeddings = self.model.encode(texts)
+        remaining = list(range(len(candidates)))
+        selected = []
+        packed = []
+        used = 0
         
-        if self.embeddings is None:
-            self.embeddings = new_embeddings
-            self.documents = chunks
-        else:
-            self.embeddings = np.vstack([self.embeddings, new_embeddings])
-            self.documents.extend(chunks)
+        while remaining and used < budget:
+            # Relevance is the retrieval score, redundancy the closest already-selected chunk
+            best, best_value = None, None
+            for i in remaining:
+                redundancy = max((float(embeddings[i] @ embeddings[j]) for j in selected), default=0.0)
+                value = self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * redundancy
+                if best_value is None or value > best_value:
+                    best, best_value = i, value
+            remaining.remove(best)
+            
+            if any(float(embeddings[best] @ embeddings[j]) >= self.duplicate_threshold for j in selected):
+                continue
+            
+            doc, score = candidates[best]
+            part = f"Source: {doc.title} - {doc.section}\n{doc.content}"
+            cost = self.count_tokens(part) + (separator_tokens if packed else 0)
+            if used + cost > budget:
+                # Fill what is left of the budget with the start of the chunk
+                room = budget - used - (separator_tokens if packed else 0)
+                if room < 50:
+                    continue
+                part = self.truncate(part, room)
+                cost = budget - used
+            
+            selected.append(best)
+            packed.append((doc, score, part))
+            used += cost
         
-        # Build FAISS index
-        self.index = faiss.IndexFlatIP(self.embeddings.shape[1])
-        self.index.add(self.embeddings.astype(np.float32))
+        return packed
+
+class CrossEncoderReranker:
+    """Optional cross-encoder re-ranking of search candidates under a latency budget"""
     
-    def search(self, query: str, k: int = 5) -> List[Tuple[DocumentChunk, float]]:
-        """Search for similar documents"""
-        if self.index is None:
-            return []
+    def __init__(self, model_name: str = 'cross-encoder/ms-marco-MiniLM-L-6-v2', candidates: int = 20,
+                 latency_budget_ms: float = 300.0, batch_size: int = 32):
+        self.model_name = model_name
+        self.candidates = candidates
+        self.latency_budget_ms = latency_budget_ms
+        self.batch_size = batch_size
+        self.ms_per_pair = None  # running estimate used to avoid starting batches that would overrun
+        self.timings = deque(maxlen=200)
+        self.lock = threading.Lock()
+    
+    def rerank(self, question: str, results: List[Tuple[DocumentChunk, float]], latency_budget_ms: float = None
+               ) -> Tuple[List[Tuple[DocumentChunk, float]], List[float], Dict]:
+        """Reorder results by cross-encoder score, within latency_budget_ms (default self.latency_budget_ms).
         
-        query_embedding = self.model.encode([query])
-        scores, indices = self.index.search(query_embedding.astype(np.float32), k)
+        Returns the results, their relevance in [0, 1] (None when falling back to
+        bi-encoder order) and the timing record for this query.
+        """
+        if latency_budget_ms is None:
+            latency_budget_ms = self.latency_budget_ms
+        start = time.perf_counter()
+        model = get_cross_encoder(self.model_name)
+        pairs = [(question, doc.content) for doc, _ in results]
         
-        results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < len(self.documents):
-                results.append((self.documents[idx], float(score)))
+        scores = []
+        fell_back = False
+        for offset in range(0, len(pairs), self.batch_size):
+            batch = pairs[offset:offset + self.batch_size]
+            elapsed = (time.perf_counter() - start) * 1000
+            if self.ms_per_pair is not None and elapsed + self.ms_per_pair * len(batch) > latency_budget_ms:
+                fell_back = True
+                break
+            
+            batch_start = time.perf_counter()
+            with METRICS.timer('rerank_batch'):
+                scores.extend(float(score) for score in model.predict(batch))
+            per_pair = (time.perf_counter() - batch_start) * 1000 / len(batch)
+            with self.lock:
+                self.ms_per_pair = per_pair if self.ms_per_pair is None else 0.8 * self.ms_per_pair + 0.2 * per_pair
         
-        return results
-    
-    def save(self, filepath: str):
-        """Save vector store to file"""
-        data = {
-            'embeddings': self.embeddings,
-            'documents': self.documents
+        timing = {
+            'candidates': len(pairs),
+            'scored': len(scores),
+            'ms': (time.perf_counter() - start) * 1000,
+            'fell_back': fell_back
         }
-        with open(filepath, 'wb') as f:
-            pickle.dump(data, f)
-    
-    def load(self, filepath: str):
-        """Load vector store from file"""
-        with open(filepath, 'rb') as f:
-            data = pickle.load(f)
+        self.timings.append(timing)
         
-        self.embeddings = data['embeddings']
-        self.documents = data['documents']
+        if fell_back:
+            return results, None, timing
         
-        if self.embeddings is not None:
-            self.index = faiss.IndexFlatIP(self.embeddings.shape[1])
-            self.index.add(self.embeddings.astype(np.float32))
+        order = sorted(range(len(results)), key=lambda i: -scores[i])
+        relevance = [1.0 / (1.0 + np.exp(-scores[i])) for i in order]
+        return [results[i] for i in order], relevance, timing
+    
+    def stats(self) -> Dict:
+        """Summary of recent re-rank timings"""
+        if not self.timings:
+            return {}
+        latencies = [timing['ms'] for timing in self.timings]
+        return {
+            'queries': len(latencies),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'fallback_rate': sum(timing['fell_back'] for timing in self.timings) / len(latencies)
+        }
 
 class PQLAgent:
     """AI Agent for answering PQL questions"""
     
-    def __init__(self, vector_store: VectorStore, openai_api_key: str = None):
+    def __init__(self, vector_store: VectorStore, openai_api_key: str = None, answer_cache: AnswerCache = None,
+                 context_packer: ContextPacker = None, candidates: int = 10,
+                 reranker: CrossEncoderReranker = None, auto_filters: bool = True, rerank_budget_ms: float = None):
         self.vector_store = vector_store
         self.openai_api_key = openai_api_key
+        self.answer_cache = answer_cache
+        self.context_packer = context_packer or ContextPacker()
+        self.candidates = candidates
+        self.reranker = reranker
+        # Per-agent budget, since the re-ranker itself is shared across sessions; None keeps its default
+        self.rerank_budget_ms = rerank_budget_ms
+        # Narrow the search to the month or year a question asks about, e.g. "June 2025 release"
+        self.auto_filters = auto_filters
+        self._generation_failed = False
         if openai_api_key:
             openai.api_key = openai_api_key
     
-    def answer_question(self, question: str, max_context_length: int = 3000) -> Dict:
+    def answer_question(self, question: str, max_context_tokens: int = None, stream: bool = False,
+                        filters: Dict = None) -> Dict:
+        """Answer a PQL question using RAG, reusing cached answers to similar questions.
+        
+        With stream=True, result['answer'] is an iterator of text pieces as they are generated.
+        filters restrict retrieval as in VectorStore.search; without them, filters implied by the
+        question are tried first and dropped if nothing matches.
+        """
+        with METRICS.timer('answer'):
+            return self._answer_with_cache(question, max_context_tokens, stream, filters)
+    
+    def _answer_with_cache(self, question: str, max_context_tokens: int = None, stream: bool = False,
+                           filters: Dict = None) -> Dict:
+        strict = filters is not None
+        if not strict and self.auto_filters:
+            filters = ShardMap.filters_from_question(question) or None
+        if self.answer_cache is None:
+            return self._answer_question(question, max_context_tokens, stream, filters, strict)
+        
+        # Answers to near-identical questions about different months must not be shared
+        mode = 'openai' if self.openai_api_key else 'simple'
+        if filters:
+            mode += ':' + json.dumps(filters, sort_keys=True)
+        embedding = self.vector_store.encode_queries([question])[0]
+        cached = self.answer_cache.get(embedding, self.vector_store.version, mode)
+        METRICS.inc('pql_answer_cache_total', result='hit' if cached is not None else 'miss')
+        if cached is not None:
+            result = dict(cached, cached=True)
+            if stream:
+                result['answer'] = iter([result['answer']])
+            return result
+        
+        self._generation_failed = False
+        result = self._answer_question(question, max_context_tokens, stream, filters, strict)
+        if result['sources']:
+            if stream:
+                result['answer'] = self._cache_when_done(result['answer'], question, embedding, mode, result)
+            elif not self._generation_failed:
+                # Don't pin fallback answers given while the API was failing
+                self.answer_cache.put(question, embedding, self.vector_store.version, mode, result)
+        return result
+    
+    def _cache_when_done(self, pieces: Iterator[str], question: str, embedding: np.ndarray, mode: str,
+                         result: Dict) -> Iterator[str]:
+        """Pass a streamed answer through, caching it once it has been fully generated"""
+        answer = []
+        for piece in pieces:
+            answer.append(piece)
+            yield piece
+        if not self._generation_failed:
+            self.answer_cache.put(question, embedding, self.vector_store.version, mode,
+                                  dict(result, answer=''.join(answer)))
+    
+    def _answer_question(self, question: str, max_context_tokens: int = None, stream: bool = False,
+                         filters: Dict = None, strict: bool = True) -> Dict:
         """Answer a PQL question using RAG"""
-        # Search for relevant documents
-        relevant_docs = self.vector_store.search(question, k=5)
+        # Search for relevant documents; retrieve extra candidates for the re-ranker and context packer
+        k = max(self.candidates, self.reranker.candidates) if self.reranker else self.candidates
+        hits = self.vector_store.search(question, k=k, filters=filters, with_ids=True)
+        if not hits and filters and not strict:
+            # Inferred filters that match nothing fall back to the whole knowledge base
+            filters = None
+            hits = self.vector_store.search(question, k=k, with_ids=True)
+        relevant_docs = [(doc, score) for _, doc, score in hits]
+        # Re-ranking reorders the chunk objects themselves, so their ids are tracked by identity
+        doc_ids = {id(doc): doc_id for doc_id, doc, _ in hits}
         
         if not relevant_docs:
+            answer = "I couldn't find relevant information in the Celonis documentation. Please try rephrasing your question."
             return {
-                'answer': "I couldn't find relevant information in the Celonis documentation. Please try rephrasing your question.",
+                'answer': iter([answer]) if stream else answer,
                 'sources': [],
                 'confidence': 0.0
             }
         
-        # Prepare context
-        context_parts = []
-        sources = []
-        
-        for doc, score in relevant_docs:
-            if len('\n'.join(context_parts)) < max_context_length:
-                context_parts.append(f"Source: {doc.title} - {doc.section}\n{doc.content}")
-                sources.append({
-                    'title': doc.title,
-                    'section': doc.section,
-                    'url': doc.url,
-                    'score': score
-                })
+        relevance = None
+        rerank_timing = None
+        if self.reranker:
+            try:
+                relevant_docs, relevance, rerank_timing = self.reranker.rerank(
+                    question, relevant_docs, self.rerank_budget_ms)
+            except Exception as e:
+                logger.error(f"Re-ranking failed, keeping bi-encoder order: {str(e)}")
+        
+        # Prepare context within the token budget, skipping near-duplicate chunks
+        with METRICS.timer('pack_context'):
+            embeddings = self.vector_store.embeddings_for([doc_ids[id(doc)] for doc, _ in relevant_docs])
+            packed = self.context_packer.pack(relevant_docs, embeddings, max_context_tokens, relevance)
         
-        context = '\n\n---\n\n'.join(context_parts)
+        context_parts = [part for _, _, part in packed]
+        sources = [
+            {
+                'title': doc.title,
+                'section': doc.section,
+                'url': doc.url,
+                'score': score
+            }
+            for doc, score, _ in packed
+        ]
+        
+        context = self.context_packer.separator.join(context_parts)
         
         # Generate answer
-        if self.openai_api_key:
+        if self.openai_api_key and stream:
+            answer = self._stream_answer_with_openai(question, context)
+        elif self.openai_api_key:
             answer = self._generate_answer_with_openai(question, context)
         else:
-            answer = self._generate_answer_simple(question, context, relevant_docs)
+            answer = self._generate_answer_simple(question, context, relevant_docs, doc_ids[id(relevant_docs[0][0])])
+            if stream:
+                answer = iter([answer])
         
-        return {
+        result = {
             'answer': answer,
             'sources': sources,
             'confidence': max([score for _, score in relevant_docs]) if relevant_docs else 0.0
         }
+        if rerank_timing is not None:
+            result['rerank'] = rerank_timing
+        if filters:
+            result['filters'] = filters
+        return result
+    
+    def _build_messages(self, question: str, context: str) -> List[Dict]:
+        return [
+            {
+                "role": "system",
+                "content": """You are a Celonis PQL (Process Query Language) expert. 
+                Answer questions about PQL based on the provided documentation context. 
+                Be precise, provide code examples when relevant, and explain concepts clearly.
+                If the context doesn't contain enough information, say so."""
+            },
+            {
+                "role": "user",
+                "content": f"Context from Celonis documentation:\n{context}\n\nQuestion: {question}"
+            }
+        ]
     
     def _generate_answer_with_openai(self, question: str, context: str) -> str:
         """Generate answer using OpenAI API"""
         try:
-            # Updated to use the new OpenAI client
-            from openai import OpenAI
-            client = OpenAI(api_key=self.openai_api_key)
-            
+            client = get_openai_client(self.openai_api_key)
+            with METRICS.timer('llm'):
+                response = client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=self._build_messages(question, context),
+                    max_tokens=500,
+                    temperature=0.3
+                )
+            return response.choices[0].message.content
+        except Exception as e:
+            logger.error(f"OpenAI API error: {str(e)}")
+            METRICS.inc('pql_llm_errors_total')
+            self._generation_failed = True
+            return self._generate_answer_simple(question, context, [])
+    
+    def _stream_answer_with_openai(self, question: str, context: str) -> Iterator[str]:
+        """Stream answer tokens from the OpenAI API as they arrive"""
+        started = False
+        try:
+            client = get_openai_client(self.openai_api_key)
+            start = time.perf_counter()
             response = client.chat.completions.create(
                 model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": """You are a Celonis PQL (Process Query Language) expert. 
-                        Answer questions about PQL based on the provided documentation context. 
-                        Be precise, provide code examples when relevant, and explain concepts clearly.
-                        If the context doesn't contain enough information, say so."""
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Context from Celonis documentation:\n{context}\n\nQuestion: {question}"
-                    }
-                ],
+                messages=self._build_messages(question, context),
                 max_tokens=500,
-                temperature=0.3
+                temperature=0.3,
+                stream=True
             )
-            return response.choices[0].message.content
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not started:
+                        METRICS.observe('llm_first_token', time.perf_counter() - start)
+                    started = True
+                    yield chunk.choices[0].delta.content
         except Exception as e:
             logger.error(f"OpenAI API error: {str(e)}")
-            return self._generate_answer_simple(question, context, [])
+            METRICS.inc('pql_llm_errors_total')
+            self._generation_failed = True
+            if not started:
+                yield self._generate_answer_simple(question, context, [])
     
-    def _generate_answer_simple(self, question: str, context: str, relevant_docs: List) -> str:
-        """Generate a simple answer without OpenAI API"""
+    def _generate_answer_simple(self, question: str, context: str, relevant_docs: List,
+                                best_doc_id: int = None) -> str:
+        """Generate a simple answer without OpenAI API; best_doc_id is the stored id of relevant_docs[0]"""
         # Extract key information from the most relevant document
         if relevant_docs:
             best_doc, score = relevant_docs[0]
@@ -410,9 +3658,8 @@ class PQLAgent:
             # Look for code examples or function definitions
             content = best_doc.content
             
-            # Simple pattern matching for PQL functions
-            function_pattern = r'([A-Z_]+)\s*\([^)]*\)'
-            functions = re.findall(function_pattern, content)
+            # PQL functions were extracted into the symbol table at ingest time
+            functions = self.vector_store.symbols_for(best_doc_id) if best_doc_id is not None else []
             
             answer_parts = [f"Based on the Celonis documentation from '{best_doc.title}':"]
             
@@ -445,6 +3692,11 @@ def main():
         # OpenAI API Key
         openai_key = st.text_input("OpenAI API Key (optional)", type="password")
         
+        # Optional cross-encoder re-ranking
+        use_reranker = st.checkbox("Re-rank results with cross-encoder", value=False)
+        # Kept in this session's widget state; the shared re-ranker only supplies the model and latency estimate
+        rerank_budget_ms = st.slider("Re-rank latency budget (ms)", 50, 2000, 300, step=50) if use_reranker else None
+        
         # Data source refresh
         if st.button("Refresh Documentation"):
             with st.spinner("Scraping Celonis documentation..."):
@@ -452,7 +3704,8 @@ def main():
     
     # Initialize components
     vector_store = initialize_vector_store()
-    agent = PQLAgent(vector_store, openai_key if openai_key else None)
+    agent = PQLAgent(vector_store, openai_key if openai_key else None, answer_cache=get_answer_cache(),
+                     reranker=get_reranker() if use_reranker else None, rerank_budget_ms=rerank_budget_ms)
     
     # Main interface
     col1, col2 = st.columns([2, 1])
@@ -471,6 +3724,15 @@ def main():
         
         selected_sample = st.selectbox("Sample questions:", [""] + sample_questions)
         
+        # Optional metadata filters; without them, a month or year in the question narrows the search
+        with st.expander("Search scope"):
+            categories = sorted({shard['category'] for shard in vector_store.shards()})
+            selected_categories = st.multiselect("Sources", categories)
+            scope_since = st.text_input("From (YYYY or YYYY-MM)", "").strip()
+            scope_until = st.text_input("Until (YYYY or YYYY-MM)", "").strip()
+        filters = {key: value for key, value in (('category', selected_categories), ('since', scope_since),
+                                                 ('until', scope_until)) if value} or None
+        
         # User input
         user_question = st.text_area(
             "Your PQL question:",
@@ -481,16 +3743,32 @@ def main():
         
         if st.button("Get Answer", type="primary"):
             if user_question.strip():
-                with st.spinner("Searching documentation and generating answer..."):
-                    result = agent.answer_question(user_question)
+                with st.spinner("Searching documentation..."):
+                    try:
+                        result = agent.answer_question(user_question, stream=True, filters=filters)
+                    except ValueError as e:
+                        st.error(str(e))
+                        st.stop()
                 
-                # Display answer
+                # Display answer as it streams in
                 st.subheader("Answer")
-                st.write(result['answer'])
+                answer_placeholder = st.empty()
+                answer = ''
+                for piece in result['answer']:
+                    answer += piece
+                    answer_placeholder.write(answer)
                 
                 # Display confidence
                 confidence = result['confidence']
                 st.metric("Confidence", f"{confidence:.2%}")
+                if result.get('cached'):
+                    st.caption("Answer served from cache")
+                if result.get('filters'):
+                    st.caption("Searched only " + ', '.join(f"{key} {value}" for key, value in result['filters'].items()))
+                if result.get('rerank'):
+                    rerank = result['rerank']
+                    st.caption(f"Re-ranked {rerank['scored']}/{rerank['candidates']} candidates in {rerank['ms']:.0f} ms"
+                               + (" (budget exceeded, kept bi-encoder order)" if rerank['fell_back'] else ""))
                 
                 # Display sources
                 if result['sources']:
@@ -506,12 +3784,12 @@ def main():
         st.header("Documentation Status")
         
         # Display vector store statistics
-        if vector_store.documents:
-            st.metric("Documents in Knowledge Base", len(vector_store.documents))
+        if len(vector_store):
+            st.metric("Documents in Knowledge Base", len(vector_store))
             
             # Show recent documents
             st.subheader("Recent Sources")
-            recent_docs = sorted(vector_store.documents, key=lambda x: x.timestamp, reverse=True)[:5]
+            recent_docs = vector_store.recent_documents(5)
             
             for doc in recent_docs:
                 st.write(f"📄 **{doc.title}**")
@@ -521,6 +3799,10 @@ def main():
         else:
             st.info("No documents loaded. Use 'Refresh Documentation' to load data.")
         
+        timings = resource_timings()
+        if timings:
+            st.caption("Load times: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in sorted(timings.items())))
+        
         # PQL Quick Reference
         st.subheader("PQL Quick Reference")
         with st.expander("Common PQL Functions"):
@@ -543,26 +3825,74 @@ COUNT("Table"."CaseID")
 AVG("Table"."Duration")
 SUM("Table"."Amount")
             """)
+    
+    # Rendered last so it includes this run's question
+    with st.sidebar:
+        render_performance_panel()
+
+def render_performance_panel():
+    """Sidebar panel with recent p50/p95 latency per stage"""
+    st.subheader("Performance")
+    # METRICS is shared by every session, so collection is set per process by PQL_METRICS, not from one session's UI
+    if not METRICS.enabled:
+        st.caption("Metrics collection is off for this server (PQL_METRICS=0).")
+        return
+    summary = METRICS.summary()
+    if not summary:
+        st.caption("No timings recorded yet.")
+        return
+    
+    st.dataframe(pd.DataFrame([
+        {'stage': stage, 'count': stats['count'], 'p50 (ms)': round(stats['p50_ms'], 1),
+         'p95 (ms)': round(stats['p95_ms'], 1)}
+        for stage, stats in summary.items()
+    ]), hide_index=True, width='stretch')
+    encoder = initialize_vector_store().encoder.throughput()
+    if encoder['sentences']:
+        st.caption(f"Encoder {encoder['backend']}: {encoder['sentences']} texts at "
+                   f"{encoder['sentences_per_second']:.0f} sentences/s")
+    with st.expander("Prometheus metrics"):
+        st.code(METRICS.prometheus(), language="text")
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache() -> AnswerCache:
+    """Process-wide answer cache shared by all sessions"""
+    return AnswerCache(filepath=ANSWER_CACHE_PATH)
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
 def initialize_vector_store():
-    """Initialize or load the vector store"""
+    """Initialize or load the vector store, shared read-only by all sessions"""
+    start = time.perf_counter()
     vector_store = VectorStore()
     
     # Try to load existing data
-    if os.path.exists("pql_knowledge_base.pkl"):
-        try:
-            vector_store.load("pql_knowledge_base.pkl")
+    try:
+        if load_knowledge_base(vector_store):
             logger.info("Loaded existing knowledge base")
-        except Exception as e:
-            logger.error(f"Error loading knowledge base: {str(e)}")
-            # Create new one if loading fails
+        else:
             create_initial_knowledge_base(vector_store)
-    else:
+    except Exception as e:
+        logger.error(f"Error loading knowledge base: {str(e)}")
+        # Create new one if loading fails
         create_initial_knowledge_base(vector_store)
     
+    resource_timings()['knowledge_base_load'] = time.perf_counter() - start
     return vector_store
 
+def load_knowledge_base(vector_store: VectorStore) -> bool:
+    """Load the saved knowledge base, migrating the legacy pickle if needed"""
+    if os.path.exists(KNOWLEDGE_BASE_PATH):
+        vector_store.load(KNOWLEDGE_BASE_PATH)
+        return True
+    
+    if os.path.exists(LEGACY_KNOWLEDGE_BASE_PATH):
+        vector_store.load(LEGACY_KNOWLEDGE_BASE_PATH)
+        vector_store.save(KNOWLEDGE_BASE_PATH)
+        logger.info(f"Migrated {LEGACY_KNOWLEDGE_BASE_PATH} to {KNOWLEDGE_BASE_PATH}")
+        return True
+    
+    return False
+
 def create_initial_knowledge_base(vector_store: VectorStore):
     """Create initial knowledge base with sample PQL content"""
     # Sample PQL documentation chunks
@@ -613,7 +3943,7 @@ def create_initial_knowledge_base(vector_store: VectorStore):
     
     # Save the initial knowledge base
     try:
-        vector_store.save("pql_knowledge_base.pkl")
+        vector_store.save(KNOWLEDGE_BASE_PATH)
         logger.info("Created and saved initial knowledge base")
     except Exception as e:
         logger.error(f"Error saving knowledge base: {str(e)}")
@@ -621,32 +3951,345 @@ def create_initial_knowledge_base(vector_store: VectorStore):
 def refresh_documentation():
     """Refresh documentation from Celonis sources"""
     scraper = CelonisDocScraper()
-    vector_store = VectorStore() # This creates a new, empty vector_store object for scraping
+    vector_store = VectorStore()
+    
+    # Start from the stored knowledge base so unchanged chunks keep their embeddings
+    try:
+        load_knowledge_base(vector_store)
+    except Exception as e:
+        logger.error(f"Error loading knowledge base: {str(e)}")
     
-    all_chunks = []
+    # Stream pages through the ingestion pipeline; an interrupted refresh resumes from its checkpoint
+    pipeline = IngestionPipeline(scraper, vector_store, KNOWLEDGE_BASE_PATH)
+    st.write(f"Scraping {len(scraper.doc_urls)} documentation sources with {pipeline.fetch_workers} workers...")
+    status = st.empty()
     
-    # Scrape main documentation URLs
-    for name, url in scraper.doc_urls.items():
-        st.write(f"Scraping {name}...")
-        try:
-            chunks = scraper.scrape_documentation(url, max_depth=1)
-            all_chunks.extend(chunks)
-            st.write(f"Found {len(chunks)} chunks from {name}")
-        except Exception as e:
-            st.error(f"Error scraping {name}: {str(e)}")
+    def progress(stats):
+        status.write(f"{stats['pages']} pages, {stats['chunks']} chunks processed ({stats['embedded']} embedded)")
+    
+    try:
+        report = pipeline.run(scraper.doc_urls, max_depth=1, progress=progress)
+    except Exception as e:
+        st.error(f"Error scraping documentation: {str(e)}")
+        return
     
-    if all_chunks:
-        # Before saving, clear the cache for initialize_vector_store
-        # This ensures that when st.rerun() happens, initialize_vector_store
-        # will actually reload the updated pql_knowledge_base.pkl
-        initialize_vector_store.clear() # <--- ADD THIS LINE
+    if report['resumed_pages']:
+        st.write(f"Resumed an interrupted refresh with {report['resumed_pages']} pages already processed")
+    for name, count in report['seeds'].items():
+        st.write(f"Found {count} chunks from {name}")
+    if report['duplicates']:
+        st.write(f"Dropped {report['duplicates']} near-duplicate chunks")
+    st.write(f"Page cache: {scraper.stats.get('not_modified', 0)} not modified, "
+             f"{scraper.stats.get('unchanged', 0)} unchanged, {scraper.stats.get('fetched', 0)} fetched")
+    
+    if report['chunks']:
+        # The pipeline has saved the knowledge base; clear the cache for initialize_vector_store
+        # so that when st.rerun() happens it will actually reload the updated knowledge base
+        initialize_vector_store.clear()
         
-        vector_store.add_documents(all_chunks)
-        vector_store.save("pql_knowledge_base.pkl")
-        st.success(f"Successfully updated knowledge base with {len(all_chunks)} document chunks!")
+        if vector_store.embedding_cache is not None:
+            cache_stats = vector_store.embedding_cache.stats()
+            st.write(f"Embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} encoded")
+        st.success(f"Successfully updated knowledge base: {report['added']} added, {report['updated']} updated, "
+                   f"{report['deleted']} deleted, {report['unchanged']} unchanged")
         st.rerun()
     else:
         st.warning("No new content was scraped.")
 
+class QAService:
+    """Headless question answering over one shared vector store, for the HTTP API and bulk CLI"""
+    
+    def __init__(self, vector_store: VectorStore = None, openai_api_key: str = None, workers: int = None,
+                 answer_cache: AnswerCache = None, reranker: CrossEncoderReranker = None):
+        self.vector_store = vector_store or initialize_vector_store()
+        self.openai_api_key = openai_api_key or os.environ.get('OPENAI_API_KEY')
+        self.answer_cache = answer_cache if answer_cache is not None else get_answer_cache()
+        self.reranker = reranker
+        # Encoding, FAISS search and the OpenAI call release the GIL, so threads overlap on all cores
+        self.workers = workers or os.cpu_count() or 4
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+    
+    def answer(self, question: str, max_context_tokens: int = None, filters: Dict = None) -> Dict:
+        """Answer one question; a fresh agent per call keeps per-request state out of shared objects"""
+        agent = PQLAgent(self.vector_store, self.openai_api_key, answer_cache=self.answer_cache,
+                         reranker=self.reranker)
+        start = time.perf_counter()
+        result = agent.answer_question(question, max_context_tokens, filters=filters)
+        return {
+            'question': question,
+            'answer': result['answer'],
+            'sources': [dict(source, score=float(source['score'])) for source in result['sources']],
+            'confidence': float(result['confidence']),
+            'cached': bool(result.get('cached', False)),
+            'filters': result.get('filters'),
+            'latency_ms': (time.perf_counter() - start) * 1000
+        }
+    
+    def search(self, query: str, k: int = 5, filters: Dict = None) -> List[Dict]:
+        """Raw retrieval results as plain dicts"""
+        return [
+            {'title': doc.title, 'section': doc.section, 'url': doc.url, 'content': doc.content, 'score': float(score)}
+            for doc, score in self.vector_store.search(query, k=k, filters=filters)
+        ]
+    
+    async def run(self, func, *args):
+        """Run a blocking call on the worker pool without blocking the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    
+    def answer_file(self, input_path: str, output_path: str, batch_size: int = 64) -> Dict[str, int]:
+        """Answer a JSONL file of {"question": ...} records in order, at most batch_size in memory.
+        
+        Extra fields (e.g. an id) are copied to the output record; errors are reported per line.
+        """
+        stats = {'answered': 0, 'failed': 0}
+        start = time.perf_counter()
+        
+        def answer_record(record: Dict) -> Dict:
+            if 'error' in record:
+                return record
+            try:
+                question = record['question']
+                return dict(record, **self.answer(question, record.get('max_context_tokens'), record.get('filters')))
+            except Exception as e:
+                return dict(record, error=str(e))
+        
+        def flush(batch: List[Dict], out):
+            for result in self.executor.map(answer_record, batch):
+                stats['failed' if 'error' in result else 'answered'] += 1
+                out.write(json.dumps(result) + '\n')
+            out.flush()
+        
+        with open(input_path) as f, open(output_path, 'w') as out:
+            batch = []
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    batch.append({'line': line.strip(), 'error': f"Invalid JSON: {str(e)}"})
+                if len(batch) >= batch_size:
+                    flush(batch, out)
+                    batch = []
+            if batch:
+                flush(batch, out)
+        
+        elapsed = time.perf_counter() - start
+        stats['questions_per_second'] = (stats['answered'] + stats['failed']) / elapsed if elapsed else 0.0
+        return stats
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.answer_cache.flush()
+
+def _text_field(body: Dict, key: str) -> str:
+    """A required non-empty string field of a request body"""
+    value = body.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'"{key}" must be a non-empty string')
+    return value
+
+def _int_field(body: Dict, key: str, default: int, limit: int) -> int:
+    """An optional integer field of a request body, between 1 and limit"""
+    value = body.get(key)
+    if value is None:
+        return default
+    # bool is an int subclass, but true/false is never a meant size
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= limit:
+        raise ValueError(f'"{key}" must be an integer between 1 and {limit}')
+    return value
+
+def _int_param(params, key: str, default: int, limit: int) -> int:
+    """An optional integer query parameter, between 1 and limit"""
+    value = params.get(key)
+    if value is None:
+        return default
+    if not value.isdigit() or not 1 <= int(value) <= limit:
+        raise ValueError(f'"{key}" must be an integer between 1 and {limit}')
+    return int(value)
+
+def _filters_field(body: Dict) -> Dict:
+    """The optional filters object of a request body"""
+    filters = body.get('filters')
+    if filters is not None and not isinstance(filters, dict):
+        raise ValueError('"filters" must be an object')
+    return filters
+
+def create_app(service: QAService = None) -> 'Starlette':
+    """Build the HTTP API: POST /answer, POST /search, GET /shards, GET /health, GET /metrics (Prometheus), GET /traces"""
+    if not SERVER_AVAILABLE:
+        raise RuntimeError("The HTTP service needs starlette and uvicorn installed")
+    if service is None:
+        workers = os.environ.get('PQL_SERVICE_WORKERS')
+        service = QAService(workers=int(workers) if workers else None)
+    
+    async def read_body(request) -> Dict:
+        try:
+            body = await request.json()
+        except Exception:
+            raise ValueError('Expected a JSON body')
+        if not isinstance(body, dict):
+            raise ValueError('Expected a JSON object body')
+        return body
+    
+    async def answer(request):
+        try:
+            body = await read_body(request)
+            question = _text_field(body, 'question')
+            max_context_tokens = _int_field(body, 'max_context_tokens', None, MAX_CONTEXT_TOKENS)
+            filters = _filters_field(body)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        try:
+            result = await service.run(service.answer, question, max_context_tokens, filters)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        return JSONResponse(result)
+    
+    async def search(request):
+        try:
+            body = await read_body(request)
+            query = _text_field(body, 'query')
+            k = _int_field(body, 'k', 5, MAX_SEARCH_K)
+            filters = _filters_field(body)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        try:
+            results = await service.run(service.search, query, k, filters)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        return JSONResponse({'query': query, 'results': results})
+    
+    async def metrics(request):
+        return PlainTextResponse(METRICS.prometheus(), media_type='text/plain; version=0.0.4')
+    
+    async def traces(request):
+        try:
+            n = _int_param(request.query_params, 'n', 100, METRICS.spans.maxlen)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        return JSONResponse({'enabled': METRICS.trace, 'spans': METRICS.recent_spans(n)})
+    
+    async def shards(request):
+        return JSONResponse({'shards': await service.run(service.vector_store.shards)})
+    
+    async def health(request):
+        return JSONResponse({
+            'status': 'ok',
+            'documents': len(service.vector_store),
+            'version': service.vector_store.version,
+            'workers': service.workers
+        })
+    
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        service.close()
+    
+    app = Starlette(routes=[
+        Route('/answer', answer, methods=['POST']),
+        Route('/search', search, methods=['POST']),
+        Route('/shards', shards, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/traces', traces, methods=['GET'])
+    ], lifespan=lifespan)
+    app.state.service = service
+    return app
+
+def serve(host: str = '127.0.0.1', port: int = 8000, workers: int = None, processes: int = 1):
+    """Run the HTTP API; extra processes share the memory-mapped knowledge base pages"""
+    if not SERVER_AVAILABLE:
+        raise RuntimeError("The HTTP service needs starlette and uvicorn installed")
+    if workers:
+        os.environ['PQL_SERVICE_WORKERS'] = str(workers)
+    if processes > 1:
+        # Each process builds its own app from the import string
+        uvicorn.run(f"{__name__}:create_app", factory=True, host=host, port=port, workers=processes)
+    else:
+        uvicorn.run(create_app(), host=host, port=port)
+
+def cli(argv: List[str] = None):
+    """Headless entry point: `serve` runs the HTTP API, `answer` processes a JSONL file, `ingest` crawls,
+    `check-encoder` compares an encoder backend with the torch one"""
+    parser = argparse.ArgumentParser(description="Celonis PQL agent without the Streamlit UI")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    serve_parser = commands.add_parser('serve', help="Run the HTTP API")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--workers', type=int, default=None, help="Worker threads per process")
+    serve_parser.add_argument('--processes', type=int, default=1)
+    
+    answer_parser = commands.add_parser('answer', help="Answer a JSONL file of questions")
+    answer_parser.add_argument('input', help='JSONL file with one {"question": ...} per line')
+    answer_parser.add_argument('output', help="JSONL file to write answers to")
+    answer_parser.add_argument('--workers', type=int, default=None, help="Questions answered concurrently")
+    answer_parser.add_argument('--batch-size', type=int, default=64)
+    
+    ingest_parser = commands.add_parser('ingest', help="Crawl the documentation into the knowledge base")
+    ingest_parser.add_argument('--max-depth', type=int, default=1)
+    ingest_parser.add_argument('--fresh', action='store_true', help="Ignore any checkpoint from an interrupted run")
+    ingest_parser.add_argument('--checkpoint-every', type=int, default=100, help="Pages between checkpoints")
+    ingest_parser.add_argument('--chunk-tokens', type=int, default=250, help="Embedding-model tokens per chunk")
+    ingest_parser.add_argument('--chunk-overlap', type=int, default=50, help="Tokens repeated between adjacent chunks")
+    ingest_parser.add_argument('--duplicate-threshold', type=float, default=0.9,
+                               help="Similarity above which near-duplicate chunks are dropped (0 keeps all)")
+    ingest_parser.add_argument('--encoder-backend', choices=TextEncoder.BACKENDS, default=None,
+                               help="CPU encoder backend (default: PQL_ENCODER_BACKEND or torch)")
+    ingest_parser.add_argument('--encode-processes', type=int, default=None, help="Processes for bulk encoding")
+    
+    check_parser = commands.add_parser('check-encoder',
+                                       help="Compare an encoder backend's vectors and speed with the torch backend")
+    check_parser.add_argument('--backend', choices=TextEncoder.BACKENDS, default='torch-int8')
+    check_parser.add_argument('--processes', type=int, default=1)
+    check_parser.add_argument('--texts', type=int, default=1000, help="Knowledge base chunks to encode")
+    check_parser.add_argument('--tolerance', type=float, default=0.02, help="Largest allowed cosine distance")
+    
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        serve(args.host, args.port, args.workers, args.processes)
+    elif args.command == 'answer':
+        service = QAService(workers=args.workers)
+        try:
+            stats = service.answer_file(args.input, args.output, args.batch_size)
+        finally:
+            service.close()
+        logger.info(f"Answered {stats['answered']} questions ({stats['failed']} failed) "
+                    f"at {stats['questions_per_second']:.1f} questions/s")
+    elif args.command == 'ingest':
+        vector_store = VectorStore(encoder_backend=args.encoder_backend, encode_processes=args.encode_processes)
+        scraper = CelonisDocScraper(chunker=TextChunker(vector_store.model_name, args.chunk_tokens, args.chunk_overlap))
+        load_knowledge_base(vector_store)
+        pipeline = IngestionPipeline(scraper, vector_store, KNOWLEDGE_BASE_PATH,
+                                     checkpoint_every=args.checkpoint_every,
+                                     duplicate_threshold=args.duplicate_threshold or None)
+        report = pipeline.run(scraper.doc_urls, max_depth=args.max_depth, resume=not args.fresh)
+        logger.info(f"Ingested {report['pages']} pages in {report['elapsed']:.1f}s: {report['added']} added, "
+                    f"{report['updated']} updated, {report['deleted']} deleted, {report['unchanged']} unchanged, "
+                    f"{report['duplicates']} near-duplicates dropped")
+        encoder = vector_store.encoder.throughput()
+        logger.info(f"Encoded {encoder['sentences']} texts with {encoder['backend']} "
+                    f"at {encoder['sentences_per_second']:.0f} sentences/s")
+    elif args.command == 'check-encoder':
+        vector_store = VectorStore(encoder_backend=args.backend, encode_processes=args.processes)
+        if not load_knowledge_base(vector_store) or not len(vector_store):
+            parser.error("No knowledge base to sample texts from; run `ingest` first")
+        texts = []
+        for _, chunk in vector_store._docs.iter_chunks():
+            texts.append(chunk.content)
+            if len(texts) >= args.texts:
+                break
+        try:
+            report = vector_store.encoder.compare(texts, tolerance=args.tolerance)
+        finally:
+            vector_store.encoder.close()
+        print(json.dumps(report, indent=2))
+        if not report['compatible']:
+            sys.exit(1)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in ('serve', 'answer', 'ingest', 'check-encoder'):
+        cli(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,36 @@
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import celonis_pql_agent as agent
+
+
+class HashingModel:
+    """Stands in for the sentence-transformers model: normalised bags of hashed words"""
+    
+    dim = 64
+    
+    def encode(self, texts, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in agent.BM25Index.tokenize(text):
+                vectors[row, zlib.crc32(word.encode()) % self.dim] += 1.0
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+@pytest.fixture(autouse=True)
+def offline_models(monkeypatch):
+    # No model downloads in tests: approximate chunk sizes and token counts, hashed embeddings
+    monkeypatch.setattr(agent, 'get_chunk_tokenizer', lambda model_name: None)
+    monkeypatch.setattr(agent, 'get_token_encoding', lambda model: None)
+    monkeypatch.setattr(agent, 'get_embedding_model', lambda model_name, backend='torch': HashingModel())
+
+
+@pytest.fixture
+def store():
+    return agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
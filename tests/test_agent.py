@@ -0,0 +1,60 @@
+import time
+from datetime import datetime
+
+import numpy as np
+
+import celonis_pql_agent as agent
+
+
+def chunk(i, content):
+    return agent.DocumentChunk(content, f"https://docs/{i}", 'PQL', f"Section {i}", f"chunk-{i}", datetime(2025, 6, 1))
+
+
+def test_answering_from_a_loaded_store_keeps_keys_lazy(tmp_path):
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    store.add_documents([chunk(i, f"DATEDIFF example {i} computes days between activities") for i in range(30)])
+    store.save(str(tmp_path / 'kb'))
+    
+    loaded = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    loaded.load(str(tmp_path / 'kb'))
+    result = agent.PQLAgent(loaded).answer_question("How do I use DATEDIFF between activities?")
+    assert result['sources']
+    # Context packing reads vectors by doc id, without loading every chunk's keys
+    assert loaded._docs._keys is None
+
+
+def test_embeddings_for_follows_search_ids():
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    store.add_documents([chunk(i, f"topic {i} about throughput") for i in range(10)])
+    hits = store.search("topic 3 about throughput", k=4, with_ids=True)
+    vectors = store.embeddings_for([doc_id for doc_id, _, _ in hits])
+    expected = store.encode_texts([doc.content for _, doc, _ in hits])
+    assert np.allclose(vectors, expected, atol=1e-6)
+
+
+class SlowCrossEncoder:
+    def predict(self, pairs):
+        time.sleep(0.002 * len(pairs))
+        return np.arange(len(pairs), dtype=np.float32)
+
+
+def test_rerank_budget_is_per_agent_not_shared(monkeypatch):
+    monkeypatch.setattr(agent, 'get_cross_encoder', lambda model_name: SlowCrossEncoder())
+    shared = agent.CrossEncoderReranker(latency_budget_ms=1000, batch_size=4)
+    results = [(chunk(i, f"candidate {i}"), 1.0) for i in range(12)]
+    _, relevance, timing = shared.rerank("q", results)
+    assert relevance is not None and not timing['fell_back']
+    
+    # A tight budget for one call falls back without touching the shared default
+    _, relevance, timing = shared.rerank("q", results, latency_budget_ms=1)
+    assert relevance is None and timing['fell_back']
+    assert shared.latency_budget_ms == 1000
+    
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    store.add_documents([chunk(i, f"DATEDIFF example {i} computes days") for i in range(12)])
+    tight = agent.PQLAgent(store, reranker=shared, rerank_budget_ms=1)
+    tight.answer_question("How does DATEDIFF compute days?")
+    assert shared.timings[-1]['fell_back']
+    relaxed = agent.PQLAgent(store, reranker=shared)
+    relaxed.answer_question("How does DATEDIFF count days?")
+    assert not shared.timings[-1]['fell_back']
@@ -0,0 +1,37 @@
+import time
+
+import numpy as np
+
+import celonis_pql_agent as agent
+
+
+def embedding(seed, dim=384):
+    vector = np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_puts_do_not_wait_for_disk_and_reload(tmp_path):
+    path = str(tmp_path / 'answers.npz')
+    cache = agent.AnswerCache(filepath=path, save_delay=0.05)
+    start = time.perf_counter()
+    for i in range(512):
+        cache.put(f"question {i}", embedding(i), 'kb1', 'default', {'answer': f"answer {i}"})
+    assert time.perf_counter() - start < 1.0
+    
+    cache.flush()
+    reloaded = agent.AnswerCache(filepath=path)
+    assert reloaded.stats()['entries'] == 512
+    assert reloaded.get(embedding(7), 'kb1', 'default') == {'answer': 'answer 7'}
+    assert reloaded.get(embedding(7), 'kb2', 'default') is None
+
+
+def test_background_saver_writes_atomically(tmp_path):
+    path = tmp_path / 'answers.npz'
+    cache = agent.AnswerCache(filepath=str(path), save_delay=0.01)
+    cache.put('q', embedding(1), 'kb1', 'default', {'answer': 'a'})
+    deadline = time.time() + 5
+    while not path.exists() and time.time() < deadline:
+        time.sleep(0.01)
+    assert path.exists()
+    assert not (tmp_path / 'answers.npz.tmp').exists()
+    assert agent.AnswerCache(filepath=str(path)).get(embedding(1), 'kb1', 'default') == {'answer': 'a'}
@@ -0,0 +1,46 @@
+import numpy as np
+
+import celonis_pql_agent as agent
+
+TEXTS = [f"case {i} throughput time between activity {i % 7} and activity {i % 5} in table {i % 3}"
+         for i in range(200)]
+
+
+def fresh_index(doc_ids):
+    index = agent.BM25Index(max_df=1.0)
+    for doc_id in doc_ids:
+        index.add(doc_id, TEXTS[doc_id])
+    return index
+
+
+def test_removed_documents_score_like_a_fresh_index():
+    index = fresh_index(range(len(TEXTS)))
+    index.COMPACT_FRACTION = 1.0  # keep every tombstone, so scoring has to skip them
+    removed = set(range(0, len(TEXTS), 3))
+    for doc_id in removed:
+        index.remove(doc_id, TEXTS[doc_id])
+    assert index.dead_postings
+
+    expected = fresh_index([doc_id for doc_id in range(len(TEXTS)) if doc_id not in removed])
+    for query in ["activity 3 table 1", "case 10 throughput", "activity 6"]:
+        hits, fresh = index.search(query, k=20), expected.search(query, k=20)
+        assert not removed & {doc_id for doc_id, _ in hits}
+        assert [doc_id for doc_id, _ in hits] == [doc_id for doc_id, _ in fresh]
+        assert np.allclose([score for _, score in hits], [score for _, score in fresh])
+
+
+def test_dead_postings_are_compacted(tmp_path):
+    index = fresh_index(range(len(TEXTS)))
+    total = index.n_postings
+    for doc_id in range(100):
+        index.remove(doc_id, TEXTS[doc_id])
+        assert index.dead_postings <= index.COMPACT_FRACTION * index.n_postings
+    assert index.n_postings < total
+    assert sum(len(ids) for ids, _ in index.postings.values()) == index.n_postings
+
+    index.save(str(tmp_path / 'bm25.npz'))
+    loaded = agent.BM25Index.load(str(tmp_path / 'bm25.npz'))
+    loaded.max_df = index.max_df
+    assert loaded.dead_postings == 0 and loaded.n_docs == 100
+    assert all(doc_id >= 100 for ids, _ in loaded.postings.values() for doc_id in ids)
+    assert loaded.search("activity 3 table 1", k=10) == index.search("activity 3 table 1", k=10)
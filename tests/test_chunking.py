@@ -0,0 +1,153 @@
+import random
+from datetime import datetime
+
+import pytest
+
+import celonis_pql_agent as agent
+
+VOCABULARY = ['PU_SUM', 'throughput', 'activity', 'DATEDIFF', 'case', 'the', 'between', 'REMAP_TIMESTAMPS',
+              'table', 'a', 'aggregation', 'of', 'column', 'per']
+
+
+def make_words(n, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(VOCABULARY) for _ in range(n)]
+
+
+def tokens(chunker, words):
+    return sum(chunker.token_counts(words))
+
+
+def check_windows(chunker, words, windows):
+    """Windows fit in chunk_tokens, cover the words in order and overlap by as much as overlap_tokens allows"""
+    # Numbered words, so each window's position in the text is unambiguous
+    assert len(set(words)) == len(words)
+    start = 0
+    for window, following in zip(windows, windows[1:] + [None]):
+        window = window.split()
+        end = start + len(window)
+        assert window == words[start:end]
+        assert tokens(chunker, window) <= chunker.chunk_tokens or len(window) == 1
+        if following is None:
+            assert end == len(words)
+            break
+        # Each window is as long as it can be
+        assert tokens(chunker, words[start:end + 1]) > chunker.chunk_tokens
+        
+        next_start = words.index(following.split()[0])
+        assert start < next_start <= end
+        assert tokens(chunker, words[next_start:end]) <= chunker.overlap_tokens
+        # ... and repeats as much of the previous one as the overlap allows
+        if next_start > start + 1:
+            assert tokens(chunker, words[next_start - 1:end]) > chunker.overlap_tokens
+        start = next_start
+
+
+def numbered(words):
+    return [f"{word}{i}" for i, word in enumerate(words)]
+
+
+def test_short_text_is_one_window():
+    chunker = agent.TextChunker(chunk_tokens=50, overlap_tokens=10)
+    text = "DATEDIFF  returns\nthe days between two dates"
+    assert chunker.split(text) == [text]
+
+
+@pytest.mark.parametrize('chunk_tokens, overlap_tokens', [(20, 0), (20, 5), (50, 10), (250, 50), (64, 63)])
+def test_windows_respect_size_and_overlap(chunk_tokens, overlap_tokens):
+    chunker = agent.TextChunker(chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens)
+    words = numbered(make_words(600))
+    windows = chunker.split(' '.join(words))
+    assert len(windows) > 1
+    check_windows(chunker, words, windows)
+    if overlap_tokens == 0:
+        assert sum(len(window.split()) for window in windows) == len(words)
+
+
+def test_windows_are_sized_by_the_tokenizer(monkeypatch):
+    class CharacterTokenizer:
+        def __call__(self, words, add_special_tokens=True):
+            return {'input_ids': [list(word) for word in words]}
+
+    monkeypatch.setattr(agent, 'get_chunk_tokenizer', lambda model_name: CharacterTokenizer())
+    chunker = agent.TextChunker(chunk_tokens=30, overlap_tokens=8)
+    words = numbered(make_words(200, seed=1))
+    windows = chunker.split(' '.join(words))
+    assert all(len(window.replace(' ', '')) <= 30 for window in windows)
+    check_windows(chunker, words, windows)
+
+
+def test_oversized_words_still_make_progress():
+    chunker = agent.TextChunker(chunk_tokens=4, overlap_tokens=2)
+    words = ['x' * 40, 'short', 'y' * 40, 'a', 'b']
+    windows = chunker.split(' '.join(words))
+    assert windows[0] == 'x' * 40 and 'y' * 40 in windows
+    assert windows[-1].split()[-1] == 'b'
+
+
+@pytest.mark.parametrize('chunk_tokens, overlap_tokens', [(50, 50), (50, 80), (50, -1)])
+def test_invalid_overlap_is_rejected(chunk_tokens, overlap_tokens):
+    with pytest.raises(ValueError):
+        agent.TextChunker(chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens)
+
+
+def chunk(chunk_id, words):
+    return agent.DocumentChunk(' '.join(words), f"https://docs/{chunk_id}", 'PQL', 'Section', chunk_id,
+                               datetime(2025, 6, 1))
+
+
+def jaccard(dedup, a, b):
+    def shingles(words):
+        n = dedup.shingle_size
+        return {' '.join(words[i:i + n]) for i in range(len(words) - n + 1)}
+    return len(shingles(a) & shingles(b)) / len(shingles(a) | shingles(b))
+
+
+def test_near_duplicates_are_dropped_in_favour_of_the_first():
+    dedup = agent.NearDuplicateFilter(threshold=0.9)
+    words = make_words(300)
+    edited = list(words)
+    edited[150] = 'CASE WHEN'
+    other = make_words(300, seed=2)
+    chunks = [chunk('a', words), chunk('b', other), chunk('c', words), chunk('d', edited)]
+
+    assert [kept.chunk_id for kept in dedup.filter(chunks)] == ['a', 'b']
+    assert dedup.duplicates == {'c': 'a', 'd': 'a'}
+    # Filtering carries on from the chunks kept in earlier batches
+    assert dedup.filter([chunk('e', [word.upper() for word in edited])]) == []
+    assert dedup.duplicates['e'] == 'a'
+
+
+def test_similarity_is_compared_against_the_threshold():
+    words = make_words(400)
+    # Rewrite a tail of the text, so about 80% of the shingles are shared
+    rewritten = words[:360] + make_words(40, seed=3)
+    similarity = jaccard(agent.NearDuplicateFilter(), words, rewritten)
+    assert 0.75 < similarity < 0.85
+
+    strict = agent.NearDuplicateFilter(threshold=0.9)
+    assert len(strict.filter([chunk('a', words), chunk('b', rewritten)])) == 2
+    loose = agent.NearDuplicateFilter(threshold=0.6)
+    assert len(loose.filter([chunk('a', words), chunk('b', rewritten)])) == 1
+
+
+def test_a_chunk_is_not_a_duplicate_of_itself():
+    dedup = agent.NearDuplicateFilter()
+    words = make_words(200)
+    dedup.add(chunk('a', words))
+    # An edited version of a chunk already ingested replaces it rather than being dropped
+    edited = words[:100] + ['COUNT'] + words[100:]
+    assert len(dedup.filter([chunk('a', edited)])) == 1
+    assert dedup.filter([chunk('b', edited)]) == []
+
+
+def test_signatures_depend_only_on_shingles():
+    dedup = agent.NearDuplicateFilter()
+    words = make_words(50)
+    assert (dedup.signature(' '.join(words)) == dedup.signature('  '.join(word.lower() for word in words))).all()
+    assert (dedup.signature(' '.join(words)) != dedup.signature(' '.join(reversed(words)))).any()
+    # Text shorter than a shingle still gets a signature
+    assert dedup.signature('COUNT').shape == (128,)
+
+    with pytest.raises(ValueError):
+        agent.NearDuplicateFilter(num_perm=100, bands=16)
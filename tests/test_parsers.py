@@ -0,0 +1,67 @@
+import pytest
+
+import benchmark
+import celonis_pql_agent as agent
+
+pytestmark = pytest.mark.skipif(not agent.LXML_AVAILABLE, reason="lxml is not installed")
+
+URL = 'https://docs.celonis.com/en/pql-functions.html'
+
+EDGE_CASES = {
+    'headings nested in divs': b"""<html><head><title>Nested</title></head><body><main>
+        <div class="section"><h2>DATEDIFF</h2><p>Days between two dates.</p></div>
+        <div class="section"><h2>VARIANT</h2><p>Activity sequence.</p><div><h3>Example</h3><p>VARIANT(x)</p></div></div>
+        </main></body></html>""",
+    'tail text': b"""<html><head><title>Tails</title></head><body><main>
+        <h2>COUNT</h2>Counts values<p>of a column</p>and ignores nulls.<br>Also DISTINCT.
+        <h2>SUM</h2>Adds values.</main></body></html>""",
+    'comments and scripts': b"""<html><head><title>Comments</title><style>p {}</style></head><body><main>
+        <h2>FILTER</h2><!-- internal note --><p>Restricts rows.</p><!-- x -->after the comment
+        <script>var x = 1;</script>after the script<h2>SOURCE</h2><p>Source event.</p></main></body></html>""",
+    'no main element': b"""<html><head><title>Body</title></head><body><nav>Docs</nav>
+        <h1>Intro</h1><p>PQL basics.</p><h2>Intro</h2><p>Repeated heading.</p>
+        <a href="/pql-guide.html">guide</a><a href="#top">top</a><A HREF="https://docs.celonis.com/x">x</A></body></html>""",
+    'class content and entities': """<html><head><meta charset="iso-8859-1"><title>Caf\xe9 &amp; PQL</title></head>
+        <body><div class="page content"><h2>REMAP_VALUES &lt;map&gt;</h2><p>Caf\xe9 na\xefve &nbsp; text</p>
+        <h2></h2><p>Untitled section</p></div></body></html>""".encode('iso-8859-1'),
+    'long section': ("<html><head><title>Long</title></head><body><article><h2>THROUGHPUT</h2><p>"
+                     + ' '.join(f"word{i}" for i in range(2000)) + "</p></article></body></html>").encode(),
+}
+
+
+def comparable(result):
+    chunks, links = result
+    return [(c.content, c.url, c.title, c.section, c.chunk_id) for c in chunks], links
+
+
+def assert_same_output(html):
+    fast = comparable(agent.CelonisDocScraper._parse_page_lxml(html, URL))
+    reference = comparable(agent.CelonisDocScraper._parse_page_bs4(html, URL))
+    assert fast == reference
+    assert agent.CelonisDocScraper.check_fast_parser(html, URL)
+
+
+@pytest.mark.parametrize('name', sorted(EDGE_CASES))
+def test_lxml_matches_bs4_on_edge_cases(name):
+    assert_same_output(EDGE_CASES[name])
+
+
+def test_lxml_matches_bs4_on_generated_site():
+    for html in benchmark.generate_site(25).values():
+        assert_same_output(html)
+
+
+def test_parse_pool_is_spawned_and_matches_in_process_parsing(monkeypatch):
+    # Spawned workers re-import the module without the test fixtures; keep them off the network
+    monkeypatch.setenv('HF_HUB_OFFLINE', '1')
+    scraper = agent.CelonisDocScraper(parse_workers=1)
+    try:
+        pool = scraper._get_parse_pool()
+        assert pool._mp_context.get_start_method() == 'spawn'
+        html = EDGE_CASES['headings nested in divs']
+        assert comparable(scraper._parse_page(html, URL)) == comparable(
+            agent.CelonisDocScraper.parse_html(html, URL, scraper.fast_parser, scraper.chunker))
+        # A failure would have switched the scraper to in-process parsing
+        assert scraper._parse_pool is pool
+    finally:
+        scraper._disable_parse_pool()
@@ -0,0 +1,68 @@
+from collections import Counter
+
+import pytest
+
+import benchmark
+import celonis_pql_agent as agent
+
+N_PAGES = 60
+
+
+@pytest.fixture
+def site(monkeypatch):
+    monkeypatch.setattr(benchmark.SiteHandler, 'pages', benchmark.generate_site(N_PAGES))
+    server = benchmark.start_server(benchmark.SiteHandler)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    # Every tenth page is a seed; the rest are reached through the links between pages
+    yield {f"seed_{i}": f"{url}/pql-function-{i}.html" for i in range(0, N_PAGES, 10)}
+    server.shutdown()
+    server.server_close()
+
+
+def make_pipeline(path, duplicate_threshold):
+    scraper = agent.CelonisDocScraper(max_workers=4, requests_per_second=1e6, burst=1e6, cache_path=None,
+                                      max_pages=N_PAGES, parse_workers=0)
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    return agent.IngestionPipeline(scraper, store, path, fetch_workers=4, parse_workers=2, embed_batch_size=32,
+                                   queue_size=4, checkpoint_every=10,
+                                   duplicate_threshold=duplicate_threshold)
+
+
+@pytest.mark.parametrize('duplicate_threshold', [None, 0.9])
+def test_interrupted_ingestion_resumes_from_its_checkpoint(site, tmp_path, duplicate_threshold):
+    fresh = make_pipeline(str(tmp_path / 'fresh'), duplicate_threshold)
+    fresh_stats = fresh.run(site, max_depth=10)
+    assert fresh_stats['pages'] == N_PAGES and fresh_stats['resumed_pages'] == 0
+
+    # Crash on the first batch written after the first checkpoint
+    path = str(tmp_path / 'kb')
+    crashing = make_pipeline(path, duplicate_threshold)
+    checkpoint = crashing._checkpoint
+
+    def checkpoint_then_fail():
+        checkpoint()
+        crashing.vector_store.upsert_documents = fail
+
+    def fail(*args):
+        raise RuntimeError("disk full")
+
+    crashing._checkpoint = checkpoint_then_fail
+    with pytest.raises(RuntimeError, match="disk full"):
+        crashing.run(site, max_depth=10)
+
+    resumed = make_pipeline(path, duplicate_threshold)
+    stats = resumed.run(site, max_depth=10)
+    assert 0 < stats['resumed_pages'] < N_PAGES
+    assert stats['pages'] == N_PAGES
+
+    # The resumed store matches a fresh run, and the checkpoint is gone. Pages share some sections,
+    # and which page's copy survives the near-duplicate filter depends on crawl order
+    expected = fresh.vector_store.content_hashes()
+    loaded = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    loaded.load(path)
+    for found in (resumed.vector_store.content_hashes(), loaded.content_hashes()):
+        if duplicate_threshold is None:
+            assert found == expected
+        else:
+            assert Counter(found.values()) == Counter(expected.values())
+    assert not (tmp_path / 'kb.partial').exists() and not (tmp_path / 'kb.checkpoint.json').exists()
@@ -0,0 +1,48 @@
+from collections import Counter
+
+import celonis_pql_agent as agent
+
+URL = 'https://docs.celonis.com/en/release-notes.html'
+
+RELEASE_NOTES = b"""<html><head><title>Release notes</title></head><body><main>
+<h2>June 2025</h2>
+<h3>New features</h3><p>Feature A adds a PU_COUNT shortcut.</p>
+<h3>Fixes</h3><p>Fixed the variant explorer.</p>
+<h2>May 2025</h2>
+<h3>New features</h3><p>Feature B adds REMAP_VALUES defaults.</p>
+<h3>Fixes</h3><p>Fixed conformance checking.</p>
+</main></body></html>"""
+
+
+def parse(html, fast):
+    return agent.CelonisDocScraper.parse_html(html, URL, fast)
+
+
+def test_repeated_headings_get_distinct_chunk_ids():
+    for fast in (True, False):
+        chunks, _ = parse(RELEASE_NOTES, fast)
+        ids = Counter(chunk.chunk_id for chunk in chunks)
+        assert len(chunks) == 4
+        assert max(ids.values()) == 1
+
+
+def test_first_occurrence_keeps_its_id():
+    chunks, _ = parse(RELEASE_NOTES, True)
+    first = next(chunk for chunk in chunks if chunk.section == 'New features')
+    assert first.chunk_id == agent.hashlib.md5(f"{URL}_New features".encode()).hexdigest()
+
+
+def test_colliding_ids_are_rekeyed():
+    chunks = [agent.DocumentChunk('a', URL, 't', 's', 'same', None),
+              agent.DocumentChunk('b', URL, 't', 's', 'same', None)]
+    agent.CelonisDocScraper._check_unique_ids(chunks, URL)
+    assert chunks[0].chunk_id == 'same'
+    assert chunks[1].chunk_id != 'same'
+
+
+def test_sync_keeps_sections_with_the_same_heading(store):
+    chunks, _ = parse(RELEASE_NOTES, True)
+    report = store.sync_documents(chunks)
+    assert report['added'] == 4
+    assert any('Feature A' in chunk.content for chunk in store.documents)
+    assert any('Feature B' in chunk.content for chunk in store.documents)
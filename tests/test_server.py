@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pytest
+
+import celonis_pql_agent as agent
+
+pytest.importorskip('httpx')
+if not agent.SERVER_AVAILABLE:
+    pytest.skip("starlette is not installed", allow_module_level=True)
+
+from starlette.testclient import TestClient
+
+
+@pytest.fixture
+def client(store):
+    store.add_documents([
+        agent.DocumentChunk(f"DATEDIFF example {i} computes days", f"https://docs/{i}", 'PQL', f"Section {i}",
+                            f"chunk-{i}", datetime(2025, 6, 1))
+        for i in range(5)
+    ])
+    service = agent.QAService(store, workers=2, answer_cache=agent.AnswerCache())
+    with TestClient(agent.create_app(service)) as client:
+        yield client
+
+
+@pytest.mark.parametrize('body', [
+    [],
+    {},
+    {'question': ''},
+    {'question': '   '},
+    {'question': 42},
+    {'question': ['DATEDIFF']},
+    {'question': 'DATEDIFF?', 'max_context_tokens': 0},
+    {'question': 'DATEDIFF?', 'max_context_tokens': '1500'},
+    {'question': 'DATEDIFF?', 'max_context_tokens': 1.5},
+    {'question': 'DATEDIFF?', 'max_context_tokens': True},
+    {'question': 'DATEDIFF?', 'max_context_tokens': agent.MAX_CONTEXT_TOKENS + 1},
+    {'question': 'DATEDIFF?', 'filters': 'PQL'},
+])
+def test_answer_rejects_invalid_bodies(client, body):
+    response = client.post('/answer', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.json()
+
+
+@pytest.mark.parametrize('body', [
+    {'query': None},
+    {'query': 'DATEDIFF', 'k': -1},
+    {'query': 'DATEDIFF', 'k': 10 ** 9},
+    {'query': 'DATEDIFF', 'k': False},
+    {'query': 'DATEDIFF', 'k': '5'},
+    {'query': 'DATEDIFF', 'filters': {'category': 5}},
+    {'query': 'DATEDIFF', 'filters': {'since': 2025}},
+])
+def test_search_rejects_invalid_bodies(client, body):
+    response = client.post('/search', json=body)
+    assert response.status_code == 400
+
+
+def test_search_accepts_bounded_k(client):
+    response = client.post('/search', json={'query': 'DATEDIFF days', 'k': 3})
+    assert response.status_code == 200
+    assert len(response.json()['results']) == 3
+
+
+def test_answer_rejects_non_json_body(client):
+    assert client.post('/answer', content=b'not json').status_code == 400
+
+
+@pytest.mark.parametrize('n', ['abc', '-5', '0', '1.5', '', str(10 ** 9)])
+def test_traces_rejects_invalid_counts(client, n):
+    assert client.get('/traces', params={'n': n}).status_code == 400
+
+
+def test_traces_returns_the_latest_spans(client, monkeypatch):
+    monkeypatch.setattr(agent.METRICS, 'spans', agent.deque([{'name': f"span{i}"} for i in range(10)], maxlen=50))
+    response = client.get('/traces', params={'n': 3})
+    assert response.status_code == 200
+    assert [span['name'] for span in response.json()['spans']] == ['span7', 'span8', 'span9']
+    assert len(client.get('/traces').json()['spans']) == 10
@@ -0,0 +1,121 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import celonis_pql_agent as agent
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June']
+
+
+def make_chunks():
+    chunks = []
+    for i in range(240):
+        if i % 3 == 0:
+            url, title, section = "https://docs/release-notes", "Release Notes", f"{MONTHS[i // 3 % 6]} 2025"
+        else:
+            url, title, section = f"https://docs/pql/{i % 10}", "PQL Functions", f"Section {i}"
+        chunks.append(agent.DocumentChunk(f"entry {i} covers topic{i % 11} and topic{i % 5}", url, title, section,
+                                          f"chunk-{i}", datetime(2025, 6, 1)))
+    return chunks
+
+
+def build_store(index_type='flat'):
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=index_type,
+                              hybrid=False, use_symbols=False)
+    store.add_documents(make_chunks())
+    return store
+
+
+def check_exact(results, store, query, k, keep):
+    """Results are the exact top-k among the chunks keep() accepts (ties may come in any order)"""
+    assert all(keep(chunk) for chunk, _ in results)
+    allowed = [i for i, chunk in enumerate(store.documents) if keep(chunk)]
+    scores = np.sort(store.embeddings[allowed] @ store.encode_texts([query])[0])[::-1][:k]
+    assert np.allclose([score for _, score in results], scores, atol=1e-5)
+
+
+def is_june_release_note(chunk):
+    return agent.ShardMap.metadata(chunk) == ('release_notes', '2025-06')
+
+
+def test_filters_from_question():
+    assert agent.ShardMap.filters_from_question("What changed in the June 2025 release notes?") == {
+        'since': '2025-06', 'until': '2025-06', 'category': 'release_notes'}
+    assert agent.ShardMap.filters_from_question("Which features were in the 2024 release?") == {
+        'since': '2024', 'until': '2024'}
+    # A bare year in a PQL question is data, not a filter
+    assert agent.ShardMap.filters_from_question("Count cases created in 2024 with DATEDIFF") == {}
+    assert agent.ShardMap.filters_from_question("How does PU_SUM work?") == {}
+
+
+@pytest.mark.parametrize('filters', [
+    {'category': 5},
+    {'category': ['release_notes', 3]},
+    {'category': {'name': 'docs'}},
+    {'since': 2025},
+    {'until': ['2025']},
+    {'since': '2025-13'},
+    {'until': 'June 2025'},
+    {'version': '2025'},
+])
+def test_invalid_filters_raise_value_error(filters):
+    with pytest.raises(ValueError):
+        agent.ShardMap().select(filters)
+
+
+def spy(monkeypatch, store, name):
+    """Record the calls to one of the store's search paths"""
+    calls = []
+    method = getattr(store, name)
+    monkeypatch.setattr(store, name, lambda *args: calls.append(args) or method(*args))
+    return calls
+
+
+def in_months(first, last):
+    return lambda chunk: (agent.ShardMap.metadata(chunk)[0] == 'release_notes'
+                          and first <= agent.ShardMap.metadata(chunk)[1] <= last)
+
+
+def test_flat_filtered_search_scans_the_selected_rows(monkeypatch):
+    store = build_store()
+    calls = spy(monkeypatch, store, '_exact_search_ids')
+    query = "entry covers topic3 and topic1"
+    # June release notes are a small slice, so their rows are gathered and scanned
+    results = store.search(query, k=5, filters={'category': 'release_notes', 'since': '2025-06', 'until': '2025-06'})
+    assert len(calls) == 1
+    check_exact(results, store, query, 5, is_june_release_note)
+
+
+def test_flat_filtered_search_masks_large_selections(monkeypatch):
+    store = build_store()
+    calls = spy(monkeypatch, store, '_exact_search')
+    query = "entry covers topic7 and topic2"
+    # Two thirds of the store: scanned in place through a row mask
+    results = store.search(query, k=8, filters={'category': ['docs']})
+    assert len(calls) == 1 and calls[0][2].sum() == 160
+    check_exact(results, store, query, 8, lambda chunk: agent.ShardMap.metadata(chunk)[0] == 'docs')
+
+
+def test_parallel_shard_scans_are_merged(monkeypatch):
+    store = build_store('hnsw')
+    store.SHARD_PARALLEL_MIN = 0
+    calls = spy(monkeypatch, store, '_exact_search_ids')
+    query = "entry covers topic4"
+    results = store.search(query, k=6, filters={'category': 'release_notes', 'since': '2025-02', 'until': '2025-05'})
+    # One exact scan per month shard, merged into one top-k
+    assert len(calls) == 4
+    check_exact(results, store, query, 6, in_months('2025-02', '2025-05'))
+
+
+@pytest.mark.parametrize('index_type', ['hnsw', 'ivf'])
+def test_ann_filtered_search_uses_an_id_selector(monkeypatch, index_type):
+    store = build_store(index_type)
+    # Force the IDSelector path, which large stores take past FILTER_SCAN_MAX documents
+    store.FILTER_SCAN_MAX = 0
+    calls = spy(monkeypatch, store, '_selector_search')
+    query = "entry covers topic3 and topic1"
+    results = store.search(query, k=5, filters={'category': 'release_notes', 'since': '2025-06'})
+    assert len(calls) == 1
+    # 40 allowed vectors out of 240: the widened search still finds the exact top 5
+    check_exact(results, store, query, 5, is_june_release_note)
@@ -0,0 +1,187 @@
+from datetime import datetime
+
+import numpy as np
+
+import celonis_pql_agent as agent
+
+
+def make_chunks(n, prefix='chunk'):
+    return [agent.DocumentChunk(f"{prefix} {i} text about topic{i % 7}", f"https://docs/{i % 10}", 'Title',
+                                f"Section {i}", f"{prefix}-{i}", datetime(2025, 6, 1)) for i in range(n)]
+
+
+def unit_vectors(n, dim=64, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_hnsw_removal_leaves_tombstones_until_threshold():
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type='hnsw',
+                              hybrid=False, use_symbols=False)
+    vectors = unit_vectors(400)
+    store._append(vectors, make_chunks(400))
+    index = store.index
+    
+    store.remove_ids([0, 1, 2])
+    assert store.index is index
+    assert store._tombstones() == 3
+    # Extra neighbours are fetched so the tombstones don't crowd out live hits
+    _, ids = store._index_search(vectors[:1], 5)
+    assert sum(doc_id in store._docs for doc_id in ids[0]) >= 5
+    
+    store.remove_ids(list(range(3, 120)))
+    assert store._tombstones() == 0
+    assert store.index.ntotal == 280
+
+
+def test_hnsw_search_skips_removed_documents():
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type='hnsw',
+                              hybrid=False, use_symbols=False)
+    chunks = make_chunks(200)
+    store.add_documents(chunks)
+    target = chunks[5]
+    assert store.search(target.content, k=1)[0][0].chunk_id == target.chunk_id
+    store.remove_chunks([target.chunk_id])
+    assert store._tombstones() == 1
+    results = store.search(target.content, k=5)
+    assert len(results) == 5
+    assert target.chunk_id not in [chunk.chunk_id for chunk, _ in results]
+
+
+def test_trained_indexes_are_retrained_as_the_store_grows(tmp_path):
+    vectors, chunks = unit_vectors(3005), make_chunks(3005)
+    for kind, dtype in (('ivf', 'float32'), ('ivfpq', 'float32'), ('hnsw', 'int8')):
+        store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind,
+                                  vector_dtype=dtype, hybrid=False, use_symbols=False)
+        store._append(vectors[:5], chunks[:5])
+        assert store._trained_size == 5
+        for start in range(5, 3005, 500):
+            store._append(vectors[start:start + 500], chunks[start:start + 500])
+            assert len(store) <= store.RETRAIN_GROWTH * store._trained_size
+        assert store._trained_size > 500
+        inner = store._inner_index()
+        if kind != 'hnsw':
+            assert inner.nlist == max(1, min(int(4 * np.sqrt(store._trained_size)), store._trained_size // 39))
+        if kind == 'ivfpq':
+            assert inner.pq.nbits == 8
+        
+        store.save(str(tmp_path / kind))
+        loaded = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind, vector_dtype=dtype)
+        loaded.load(str(tmp_path / kind))
+        assert loaded._trained_size == store._trained_size
+    
+    # Shrinking below what the IVF lists need retrains with fewer lists
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type='ivf',
+                              hybrid=False, use_symbols=False)
+    store._append(vectors, chunks)
+    nlist = store._inner_index().nlist
+    store.remove_ids(list(range(2900)))
+    assert store._inner_index().nlist < nlist
+    assert store._inner_index().nlist <= max(1, len(store) // 39)
+
+
+def test_loaded_store_can_be_modified(tmp_path):
+    chunks = make_chunks(300)
+    vectors = unit_vectors(300)
+    for kind in ('flat', 'hnsw', 'ivf', 'ivfpq'):
+        path = str(tmp_path / kind)
+        store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind)
+        store._append(vectors, chunks)
+        store.save(path)
+        
+        loaded = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind)
+        loaded.load(path)
+        edited = [agent.DocumentChunk(f"{chunk.content} edited", chunk.url, chunk.title, chunk.section,
+                                      chunk.chunk_id, chunk.timestamp) for chunk in chunks[:5]]
+        report = loaded.sync_documents(edited + chunks[5:250] + make_chunks(3, prefix='new'))
+        assert report == {'added': 3, 'updated': 5, 'unchanged': 245, 'deleted': 50}, kind
+        assert len(loaded) == 253
+        assert loaded.search('new 1 text about topic1', k=1)[0][0].chunk_id == 'new-1'
+
+
+def test_served_store_keeps_its_own_files_after_a_new_save(tmp_path):
+    path = str(tmp_path / 'kb')
+    for kind in ('flat', 'ivf'):
+        store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind)
+        store._append(unit_vectors(50), make_chunks(50))
+        store.save(path)
+        served = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind)
+        served.load(path)
+        
+        # A refresh or the ingest CLI saves a bigger store over the served one's directory
+        newer = agent.VectorStore(embedding_cache_path=None, query_cache_size=0, index_type=kind)
+        newer._append(unit_vectors(200, seed=1), make_chunks(200, prefix='newer'))
+        newer.save(path)
+        
+        assert served.lexical_index.n_docs == 50
+        assert len(served.symbol_index.doc_symbols) <= 50
+        results = served.search("chunk 7 text about topic0", k=5, filters={'category': 'docs'})
+        assert results and all(chunk.chunk_id.startswith('chunk-') for chunk, _ in results)
+        
+        served.remove_chunks(['chunk-0'])
+        assert len(served) == 49
+        if kind == 'ivf':
+            assert served.index.ntotal == 49
+
+
+def test_loaded_store_tracks_keys_of_old_and_new_chunks(tmp_path):
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    store.add_documents(make_chunks(20))
+    store.save(str(tmp_path / 'kb'))
+    
+    loaded = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    loaded.load(str(tmp_path / 'kb'))
+    loaded.add_documents(make_chunks(2, prefix='new'))
+    assert loaded._docs.id_for_chunk('chunk-3') is not None
+    assert loaded._docs.id_for_chunk('new-1') is not None
+    assert loaded.sync_documents(make_chunks(20) + make_chunks(2, prefix='new')) == \
+        {'added': 0, 'updated': 0, 'unchanged': 22, 'deleted': 0}
+
+
+def symbol_store():
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    store.add_documents([
+        agent.DocumentChunk('COUNT(table.column) returns the number of non-null values.', 'https://docs/count',
+                            'Aggregations', 'COUNT', 'count', datetime(2025, 6, 1)),
+        agent.DocumentChunk('PU_SUM sums child rows per parent: PU_SUM("Cases", "Items"."Amount").',
+                            'https://docs/pu', 'Pull up', 'PU_SUM', 'pu_sum', datetime(2025, 6, 1)),
+        agent.DocumentChunk('Group activities per month with ROUND_MONTH and show how many activities occur.',
+                            'https://docs/month', 'Dates', 'Monthly activities', 'month', datetime(2025, 6, 1)),
+    ])
+    return store
+
+
+def test_plain_words_are_not_symbols():
+    assert agent.SymbolIndex.query_symbols("How do I count activities per month?") == set()
+    assert agent.SymbolIndex.query_symbols("filter by source and year") == set()
+    assert agent.SymbolIndex.query_symbols("What does COUNT return?") == {'COUNT'}
+    assert agent.SymbolIndex.query_symbols("how to use pu_sum") == {'PU_SUM'}
+    assert agent.SymbolIndex.query_symbols("is count(x) null-safe") == {'COUNT'}
+    assert agent.SymbolIndex.query_symbols("CASE WHEN with FILTER") >= {"CASE WHEN", "FILTER"}
+
+
+def test_symbol_hits_are_fused_not_prepended():
+    store = symbol_store()
+    results = store.search("How do I count activities per month?", k=3)
+    assert results[0][0].chunk_id == 'month'
+    results = store.search("What does PU_SUM return?", k=3)
+    assert results[0][0].chunk_id == 'pu_sum'
+
+
+def test_pruning_a_duplicate_keeps_the_live_chunks_symbols(tmp_path):
+    store = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    old = agent.DocumentChunk("DATEDIFF(day, a, b) returns days", "https://docs/1", 'PQL', 'DATEDIFF', 'datediff',
+                              datetime(2025, 6, 1))
+    live = agent.DocumentChunk("DATEDIFF(day, a, b) returns the days between two dates", "https://docs/1", 'PQL',
+                               'DATEDIFF', 'datediff', datetime(2025, 6, 1))
+    stale_id, live_id = store.add_documents([old, live])
+    
+    store.prune_documents({'datediff'})
+    assert list(store._docs) == [live_id]
+    assert store.symbols_for(live_id) == ['DATEDIFF']
+    assert store.symbol_index.symbols['DATEDIFF'] == {live_id: True}
+    
+    store.save(str(tmp_path / 'kb'))
+    loaded = agent.VectorStore(embedding_cache_path=None, query_cache_size=0)
+    loaded.load(str(tmp_path / 'kb'))
+    assert loaded.symbols_for(live_id) == ['DATEDIFF']